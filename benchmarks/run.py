@@ -0,0 +1,206 @@
+import os
+os.environ['USE_PYGEOS'] = '0'
+import sys
+import json
+import time
+import socket
+import platform
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+import subprocess
+import numpy as np
+import pandas as pd
+from mobref import synthetic, instrument
+from mobref.instrument import _max_rss
+from mobref.network import Network
+from mobref.graph_utils import create_pdn_graph
+from mobref.vrp import solve_vrp
+from mobref.assignment import static_assignment
+
+GENERATORS = {"grid": lambda n, mode, seed: synthetic.grid_network(int(round(np.sqrt(n))), mode=mode, seed=seed),
+              "geometric": lambda n, mode, seed: synthetic.random_geometric_network(
+                  n, extent=np.sqrt(n) * 150, mode=mode, seed=seed)}
+
+
+def measure(results, stage, function, *args, repeat=1, trace=False, **kwargs):
+    """
+    Run a stage and record its wall time, CPU time and memory.
+
+    Args:
+        results (list): List the stage record is appended to.
+        stage (dict): Description of the stage (name, kind, size...), copied into the record.
+        function (callable): Function to benchmark.
+        repeat (int, optional): Number of runs, the best wall time is kept. Default is 1.
+        trace (bool, optional): If True, also record the peak of Python allocations with
+            tracemalloc, which slows the stage down. Default is False.
+
+    Returns:
+        object: Result of the last call of function.
+    """
+    walls, cpus = [], []
+    rss_before = _max_rss()
+    if trace:
+        tracemalloc.start()
+    for _ in range(repeat):
+        wall, cpu = time.perf_counter(), time.process_time()
+        res = function(*args, **kwargs)
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+    record = dict(stage, wall=min(walls), cpu=min(cpus), repeat=repeat,
+                  max_rss_mb=_max_rss(),
+                  max_rss_growth_mb=None if rss_before is None else _max_rss() - rss_before)
+    if trace:
+        record["python_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    results.append(record)
+    print(f"{stage['kind']:>9} {stage['size']:>8} {stage['name']:<20} {record['wall']:9.3f}s")
+    return res
+
+
+def random_points(nodes, n, seed):
+    """
+    Random POIs with 'lon' and 'lat' columns inside the bounding box of the nodes.
+    """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({"lon": rng.uniform(nodes.x.min(), nodes.x.max(), n),
+                         "lat": rng.uniform(nodes.y.min(), nodes.y.max(), n)})
+
+
+def run_size(kind, size, args, results):
+    """
+    Benchmark every stage on one synthetic network.
+    """
+    with tempfile.TemporaryDirectory() as processed_path:
+        nodes, edges = GENERATORS[kind](size, "drive", args.seed)
+        area = synthetic.write_area(processed_path, nodes)
+        synthetic.write_network(processed_path, nodes, edges, "drive")
+        stage = {"kind": kind, "size": len(nodes), "edges": len(edges)}
+
+        def run(name, function, *a, repeat=1, **kw):
+            return measure(results, dict(stage, name=name), function, *a,
+                           repeat=repeat, trace=args.trace, **kw)
+
+        network = run("network_build", Network, area, "drive", processed_path)
+        run("pdn_precompute", create_pdn_graph, network.nodes, network.edges)
+
+        pois = random_points(nodes, args.pois, args.seed)
+        r1, r2 = pois.iloc[0].to_dict(), pois.iloc[1].to_dict()
+        run("shortest_path", network.shortest_path, r1, r2, repeat=args.repeat)
+        run("get_matrices", network.get_matrices, pois, repeat=args.repeat)
+        run("get_matrices_sparse", network.get_matrices, pois, maxtime=300, repeat=args.repeat)
+        run("get_matrices_csr", network.get_matrices, pois, backend="csr", repeat=args.repeat)
+        run("travel_time_trees", network.get_travel_time_trees, pois, repeat=args.repeat)
+        run("find_closest", network.find_closest, pois, maxtime=600, maxitems=5, repeat=args.repeat)
+        run("accessibility", network.get_accessibility, pois, time=300, repeat=args.repeat)
+
+        zones = pois.iloc[:args.zones]
+        demand = np.random.default_rng(args.seed).uniform(0, 20, (len(zones), len(zones)))
+        run("static_assignment", static_assignment, network, zones, demand, max_iterations=10)
+
+        if args.vrp:
+            vehicles = random_points(nodes, args.vehicles, args.seed + 1)
+            jobs = random_points(nodes, args.jobs, args.seed + 2)
+            run("solve_vrp", solve_vrp, network, vehicles, jobs, exploration_level=1, nb_threads=1)
+
+        if args.transit:
+            walk_nodes, walk_edges = GENERATORS[kind](size, "walk", args.seed)
+            synthetic.write_network(processed_path, walk_nodes, walk_edges, "walk")
+            gtfs_path = f"{processed_path}/gtfs"
+            synthetic.write_gtfs(gtfs_path, walk_nodes, n_routes=args.routes, seed=args.seed)
+            transit = run("transit_integration", Network, area, "transit", processed_path, gtfs_path)
+            run("transit_matrices", transit.get_matrices, pois, repeat=args.repeat)
+
+
+def metadata():
+    """
+    Describe the code version and the machine the benchmark ran on.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    try:
+        from importlib.metadata import version
+        mobref_version = version("Mobility Referential")
+    except Exception:
+        mobref_version = None
+    return {"version": mobref_version,
+            "commit": commit,
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "host": socket.gethostname(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count()}
+
+
+def compare(baseline_path, candidate_path, threshold=1.1):
+    """
+    Print the wall time ratio of every stage between two result files.
+
+    Returns:
+        pandas.DataFrame: Stages with both timings, their ratio and whether it regressed.
+    """
+    frames = []
+    for path in (baseline_path, candidate_path):
+        with open(path) as file:
+            frames.append(pd.DataFrame(json.load(file)["results"]).set_index(["kind", "size", "name"]).wall)
+    report = pd.concat(frames, axis=1, keys=["baseline", "candidate"]).dropna()
+    report["ratio"] = report.candidate / report.baseline
+    report["regression"] = report.ratio > threshold
+    print(report.to_string(float_format=lambda x: f"{x:.3f}"))
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run",
+                                     description="Benchmark mobref on synthetic networks, offline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="run the benchmarks and save the results as JSON")
+    run.add_argument("--sizes", type=int, nargs="+", default=[2500, 10000, 40000],
+                     help="approximate number of nodes of the networks")
+    run.add_argument("--kinds", nargs="+", default=["grid", "geometric"], choices=list(GENERATORS))
+    run.add_argument("--pois", type=int, default=300)
+    run.add_argument("--repeat", type=int, default=3)
+    run.add_argument("--zones", type=int, default=100, help="number of POIs used as assignment zones")
+    run.add_argument("--vehicles", type=int, default=5)
+    run.add_argument("--jobs", type=int, default=100)
+    run.add_argument("--routes", type=int, default=10, help="number of synthetic transit routes")
+    run.add_argument("--no-vrp", dest="vrp", action="store_false")
+    run.add_argument("--no-transit", dest="transit", action="store_false")
+    run.add_argument("--trace", action="store_true", help="record Python allocation peaks with tracemalloc")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--quiet", action="store_true", help="silence the progress messages of mobref")
+    run.add_argument("--output", default="benchmark.json")
+
+    comp = subparsers.add_parser("compare", help="compare two result files")
+    comp.add_argument("baseline")
+    comp.add_argument("candidate")
+    comp.add_argument("--threshold", type=float, default=1.1,
+                      help="wall time ratio above which a stage is a regression")
+
+    args = parser.parse_args(argv)
+    if args.command == "compare":
+        report = compare(args.baseline, args.candidate, args.threshold)
+        return 1 if report.regression.any() else 0
+
+    instrument.configure(quiet=args.quiet)
+    results, stages = [], []
+    # the internal stages of mobref, such as pdn.precompute inside network_build
+    instrument.add_hook(stages.append)
+    for kind in args.kinds:
+        for size in args.sizes:
+            run_size(kind, size, args, results)
+    instrument.remove_hook(stages.append)
+    with open(args.output, "w") as file:
+        json.dump({"meta": metadata(), "parameters": vars(args), "results": results, "stages": stages},
+                  file, indent=2, default=str)
+    print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -9,6 +9,7 @@ from shapely.ops import nearest_points
 import random
 from pandana.loaders import osm
 import pandas as pd
+from mobref import instrument
 
 class Area():
 
@@ -28,6 +29,24 @@ class Area():
         self.bbox = tuple(self.gdf.dissolve().to_crs(4326).bounds.iloc[0])
         self.polygon = self.gdf.dissolve().to_crs(4326).geometry[0]
 
+    @classmethod
+    def from_gdf(cls, processed_path, gdf):
+        """
+        Create an Area from municipalities already selected, such as the tiles of a TiledArea.
+
+        Args:
+        processed_path (str): Path to processed data, where the area is saved.
+        gdf (geopandas.GeoDataFrame): Municipalities with an 'insee' column.
+
+        Returns:
+        Area: Area object.
+        """
+        os.makedirs(processed_path, exist_ok=True)
+        area_path = f"{processed_path}/area.feather"
+        if not os.path.exists(area_path):
+            gdf.to_crs(4326).reset_index(drop=True).to_feather(area_path)
+        return cls(processed_path, None, None)
+
     def make_gdf(self):
         """
         Load or process geographical data and store it in a GeoDataFrame (gdf).
@@ -40,16 +59,20 @@ class Area():
         """
         area_path = f"{self.processed_path}/area.feather"
         if os.path.exists(area_path):
-            print("Loading area...")
-            gdf = gpd.read_feather(area_path)
+            instrument.log("Loading area...")
+            with instrument.stage("area.load") as record:
+                gdf = gpd.read_feather(area_path)
+                record["rows"] = len(gdf)
         else:
-            print("Processing area...")
-            muni = open(self.municipalities_path).read().split("\n")
-            gdf = gpd.read_file(self.administrative_cutting_path).to_crs(4326)
-            gdf = gdf[gdf["insee"].isin(muni)]
-            gdf.reset_index(drop=True).to_feather(area_path)
+            instrument.log("Processing area...")
+            with instrument.stage("area.process") as record:
+                muni = open(self.municipalities_path).read().split("\n")
+                gdf = gpd.read_file(self.administrative_cutting_path).to_crs(4326)
+                gdf = gdf[gdf["insee"].isin(muni)]
+                gdf.reset_index(drop=True).to_feather(area_path)
+                record["rows"] = len(gdf)
         self.gdf = gdf
-        print() #cleaner stdout
+        instrument.log() #cleaner stdout
 
     def make_grid(self, grid_size):
         """
@@ -60,44 +83,46 @@ class Area():
         """
 
         grid_path = f"{self.processed_path}/grid.feather"
-        if os.path.exists(grid_path):
-            print("Loading grid...")
-            grid = gpd.read_feather(grid_path)
-        else:
-            print("Processing grid...")
-            min_lon, min_lat, max_lon, max_lat = self.gdf.total_bounds
-            size = max(max_lon-min_lon, max_lat-min_lat)/grid_size
-            # compute the longitudes and latitudes top left corner coordinates
-            longitudes = np.arange(min_lon+size/2, max_lon, size)
-            latitudes = np.arange(min_lat+size/2, max_lat, size)
-            # create the grid centroids
-            points = []
-            for coords in product(longitudes, latitudes):
-                points.append(Point(coords[0], coords[1]))
-            points = gpd.GeoDataFrame({'geometry':points})
-            points.crs=4326
-            # clip to geometries
-            #grid = gpd.clip(gpd.GeoDataFrame({'geometry':points}, crs=2154), gdf)
-            grid = gpd.clip(points, self.gdf)
-            #grid = pd.DataFrame({"geometry":grid.geometry, "x":grid.geometry.x, "y":grid.geometry.y})
-            grid = grid.reset_index(drop=True)
-            """
-            #Interpolate the grid to the existing nodes
-            grid["id"]=ox.distance.nearest_nodes(graph, grid.geometry.x,
-                                                   grid.geometry.y, return_dist=False)
-            nodes, roads = ox.graph_to_gdfs(graph)
-            grid = grid[["id"]].merge(nodes[["geometry"]],
-                                                        left_on="id",
-                                                        right_on="osmid",
-                                                        how="left")
-            """
-            grid = gpd.GeoDataFrame(grid)
-            grid.reset_index(drop=True).to_feather(grid_path)
+        with instrument.stage("area.grid", grid_size=grid_size) as record:
+            if os.path.exists(grid_path):
+                instrument.log("Loading grid...")
+                grid = gpd.read_feather(grid_path)
+            else:
+                instrument.log("Processing grid...")
+                min_lon, min_lat, max_lon, max_lat = self.gdf.total_bounds
+                size = max(max_lon-min_lon, max_lat-min_lat)/grid_size
+                # compute the longitudes and latitudes top left corner coordinates
+                longitudes = np.arange(min_lon+size/2, max_lon, size)
+                latitudes = np.arange(min_lat+size/2, max_lat, size)
+                # create the grid centroids
+                points = []
+                for coords in product(longitudes, latitudes):
+                    points.append(Point(coords[0], coords[1]))
+                points = gpd.GeoDataFrame({'geometry':points})
+                points.crs=4326
+                # clip to geometries
+                #grid = gpd.clip(gpd.GeoDataFrame({'geometry':points}, crs=2154), gdf)
+                grid = gpd.clip(points, self.gdf)
+                #grid = pd.DataFrame({"geometry":grid.geometry, "x":grid.geometry.x, "y":grid.geometry.y})
+                grid = grid.reset_index(drop=True)
+                """
+                #Interpolate the grid to the existing nodes
+                grid["id"]=ox.distance.nearest_nodes(graph, grid.geometry.x,
+                                                       grid.geometry.y, return_dist=False)
+                nodes, roads = ox.graph_to_gdfs(graph)
+                grid = grid[["id"]].merge(nodes[["geometry"]],
+                                                            left_on="id",
+                                                            right_on="osmid",
+                                                            how="left")
+                """
+                grid = gpd.GeoDataFrame(grid)
+                grid.reset_index(drop=True).to_feather(grid_path)
+            record["rows"] = len(grid)
         self.grid = grid
 
 
     def plot_grid(self, net):
-        roads = net.nodes
+        roads = net.geometry.nodes
         ax = self.gdf.plot()
         roads.plot(ax=ax, color="white", linewidth=1, alpha=0.2, zorder=3)
         self.grid.plot(ax=ax, color="red", markersize=5, zorder=10)
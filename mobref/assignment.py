@@ -0,0 +1,253 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from mobref import instrument
+from mobref.graph_utils import _first
+from mobref.profiles import profile_column
+
+# capacity in vehicles per hour and per lane, by road class
+LANE_CAPACITIES = {"motorway": 2000, "trunk": 1800, "primary": 1200, "secondary": 1000,
+                   "tertiary": 800, "unclassified": 600, "residential": 600, "living_street": 300,
+                   "default": 600}
+# lanes in each direction when the 'lanes' tag is missing
+DEFAULT_LANES = {"motorway": 2, "trunk": 2, "default": 1}
+
+
+def edge_capacities(edges):
+    """
+    Hourly capacity of every edge, from its road class and its number of lanes.
+
+    Args:
+        edges (pandas.DataFrame): Drive edges with 'highway' and optionally 'lanes' and 'oneway'.
+            A 'capacity' column, if any, is used as is.
+
+    Returns:
+        numpy.ndarray: Capacities in vehicles per hour.
+    """
+    if "capacity" in edges.columns:
+        return edges["capacity"].values.astype(float)
+    classes = edges["highway"].map(_first).str.replace("_link", "", regex=False)
+    per_lane = classes.map(LANE_CAPACITIES).fillna(LANE_CAPACITIES["default"]).values
+    default_lanes = classes.map(DEFAULT_LANES).fillna(DEFAULT_LANES["default"]).values
+    if "lanes" not in edges.columns:
+        return per_lane * default_lanes
+    lanes = pd.to_numeric(edges["lanes"].map(_first), errors="coerce").values
+    if "oneway" in edges.columns:
+        # the lanes tag of a two-way street counts both directions
+        two_way = ~edges["oneway"].map(_first).fillna(False).astype(bool).values
+        lanes = np.where(two_way, lanes / 2, lanes)
+    lanes = np.where(np.isfinite(lanes) & (lanes > 0), np.maximum(lanes, 1), default_lanes)
+    return per_lane * lanes
+
+
+def bpr(free_flow_time, flow, capacity, alpha=0.15, beta=4):
+    """
+    Bureau of Public Roads link performance function: congested travel time of a flow.
+    """
+    return free_flow_time * (1 + alpha * (flow / capacity) ** beta)
+
+
+def _beckmann_slope(free_flow_time, flow, direction, capacity, step, alpha, beta):
+    return (bpr(free_flow_time, flow + step * direction, capacity, alpha, beta) * direction).sum()
+
+
+def _line_search(free_flow_time, flow, direction, capacity, alpha, beta, iterations=30):
+    """
+    Step minimizing the Beckmann objective between flow and flow + direction, by bisection.
+    """
+    if _beckmann_slope(free_flow_time, flow, direction, capacity, 1, alpha, beta) <= 0:
+        return 1.0
+    low, high = 0.0, 1.0
+    for _ in range(iterations):
+        step = (low + high) / 2
+        if _beckmann_slope(free_flow_time, flow, direction, capacity, step, alpha, beta) > 0:
+            high = step
+        else:
+            low = step
+    return (low + high) / 2
+
+
+def _load_batch(matrix, sources, dests, demand, pair_keys):
+    """
+    All-or-nothing loading of the demand of a batch of origins on their shortest path trees.
+
+    Every (origin, destination) pair walks up its predecessor tree one edge per
+    step, all pairs of the batch together, adding its demand to the edge it crosses.
+
+    Returns:
+        numpy.ndarray, float, float: Flow of every node pair, cost of the loaded
+        demand at the current travel times, and demand without any path.
+    """
+    n = matrix.shape[0]
+    dist, pred = dijkstra(matrix, directed=True, indices=sources, return_predecessors=True)
+    rows, cols = np.nonzero(demand)
+    volumes = demand[rows, cols]
+    nodes = dests[cols]
+    times = dist[rows, nodes]
+    reachable = np.isfinite(times)
+    cost = (volumes[reachable] * times[reachable]).sum()
+    unassigned = volumes[~reachable].sum()
+    rows, nodes, volumes = rows[reachable], nodes[reachable], volumes[reachable]
+    flows = np.zeros(len(pair_keys))
+    active = nodes != sources[rows]
+    rows, nodes, volumes = rows[active], nodes[active], volumes[active]
+    while len(nodes):
+        parents = pred[rows, nodes]
+        pairs = np.searchsorted(pair_keys, parents.astype(np.int64) * n + nodes)
+        flows += np.bincount(pairs, weights=volumes, minlength=len(pair_keys))
+        active = parents != sources[rows]
+        rows, nodes, volumes = rows[active], parents[active], volumes[active]
+    return flows, cost, unassigned
+
+
+# graph of the worker processes, sent once by _init_worker: the pair travel times live in
+# shared memory, updated by the main process before every all-or-nothing loading
+_worker_graph = None
+
+
+def _init_worker(name, indices, indptr, dests, pair_keys):
+    global _worker_graph
+    memory = SharedMemory(name=name)
+    times = np.ndarray(len(indices), dtype=np.float64, buffer=memory.buf)
+    _worker_graph = memory, times, indices, indptr, dests, pair_keys
+
+
+def _load_worker(sources, demand):
+    _, times, indices, indptr, dests, pair_keys = _worker_graph
+    n = len(indptr) - 1
+    matrix = csr_matrix((times, indices, indptr), shape=(n, n))
+    return _load_batch(matrix, sources, dests, demand, pair_keys)
+
+
+def static_assignment(network, pois, demand, method="frank-wolfe", max_iterations=50, gap=1e-4,
+                      alpha=0.15, beta=4, hour=None, batch_size=64, workers=None):
+    """
+    Static user equilibrium assignment of a demand matrix on the drive network.
+
+    Travel times follow the BPR function of the edge flows. Each iteration loads
+    the demand all-or-nothing on the shortest path trees of the origins, computed
+    by batches in parallel worker processes, then moves the flows towards this
+    loading, with the Frank-Wolfe line search or the method of successive averages.
+
+    Args:
+        network: Drive Network object.
+        pois (pandas.DataFrame): Zones with columns 'lon' and 'lat', such as Area.grid.
+        demand (pandas.DataFrame or numpy.ndarray): Trips per hour from zone to zone,
+            indexed and with columns like pois, such as the output of get_matrices.
+        method (str, optional): "frank-wolfe" or "msa". Default is "frank-wolfe".
+        max_iterations (int, optional): Maximum number of iterations. Default is 50.
+        gap (float, optional): Relative gap at which the assignment stops. Default is 1e-4.
+        alpha (float, optional): BPR alpha. Default is 0.15.
+        beta (float, optional): BPR beta. Default is 4.
+        hour (int, optional): If set, the congested travel times are added to the network
+            as the speed profile of this hour, see Network.set_speed_profiles. Default is None.
+        batch_size (int, optional): Number of origins per shortest path batch. Default is 64.
+        workers (int, optional): Number of worker processes, 1 runs in this process.
+            Defaults to the number of CPUs.
+
+    Returns:
+        dict: A dictionary containing the following keys:
+        - "edges" (DataFrame): 'flow', 'capacity', 'free_flow_time', 'travel_time' and 'voc'
+          (flow over capacity) indexed like the network edges.
+        - "gaps" (list): Relative gap of every iteration.
+        - "unassigned" (float): Trips between zones without any path.
+    """
+    if network.mode != "drive":
+        raise ValueError(f"Static assignment only applies to the drive network, not {network.mode}")
+    if method not in ("frank-wolfe", "msa"):
+        raise ValueError(f"Unknown assignment method {method}")
+    edges = network.edges
+    edges = edges[edges["from_int"].isin(network.nodes.index) & edges["to_int"].isin(network.nodes.index)]
+    ids = pd.Index(network.nodes.index)
+    n = len(ids)
+    u = ids.get_indexer(edges["from_int"].values)
+    v = ids.get_indexer(edges["to_int"].values)
+    # parallel edges share a node pair, each pair is routed on its fastest edge
+    keys = u.astype(np.int64) * n + v
+    pair_keys, edge_pairs = np.unique(keys, return_inverse=True)
+    pair_u, pair_v = pair_keys // n, pair_keys % n
+
+    free_flow_time = edges["weight"].values.astype(float)
+    capacity = edge_capacities(edges)
+
+    # zones snapped to the same node are merged
+    demand = np.asarray(demand, dtype=float)
+    zone_nodes = ids.get_indexer(network.pdn.get_node_ids(pois.lon, pois.lat).values)
+    origins, orig_inverse = np.unique(zone_nodes, return_inverse=True)
+    od = np.zeros((len(origins), len(origins)))
+    np.add.at(od, (orig_inverse[:, None], orig_inverse[None, :]), demand)
+    np.fill_diagonal(od, 0)
+    has_demand = od.sum(axis=1) > 0
+    origins, od = origins[has_demand], od[has_demand]
+    dests = np.unique(zone_nodes)
+    starts = range(0, len(origins), batch_size)
+    workers = workers or os.cpu_count()
+
+    # pair keys are sorted by from then to node, which is the CSR order of the pairs
+    indices = pair_v.astype(np.int32)
+    indptr = np.r_[0, np.cumsum(np.bincount(pair_u, minlength=n))].astype(np.int32)
+
+    def all_or_nothing(times):
+        pair_times[:] = pd.Series(times).groupby(edge_pairs).min().values
+        # flows go to the fastest edge of every pair
+        order = np.lexsort((times, edge_pairs))
+        fastest = order[np.r_[True, edge_pairs[order][1:] != edge_pairs[order][:-1]]]
+        if executor is not None:
+            results = executor.map(_load_worker, [origins[s:s + batch_size] for s in starts],
+                                   [od[s:s + batch_size] for s in starts])
+        else:
+            matrix = csr_matrix((pair_times, indices, indptr), shape=(n, n))
+            results = (_load_batch(matrix, origins[s:s + batch_size], dests, od[s:s + batch_size], pair_keys)
+                       for s in starts)
+        pair_flows, cost, unassigned = np.zeros(len(pair_keys)), 0, 0
+        for flows, batch_cost, batch_unassigned in results:
+            pair_flows += flows
+            cost += batch_cost
+            unassigned += batch_unassigned
+        edge_flows = np.zeros(len(edges))
+        edge_flows[fastest] = pair_flows[edge_pairs[fastest]]
+        return edge_flows, cost, unassigned
+
+    # the graph structure is sent once to the workers, only the travel times change between iterations
+    memory = SharedMemory(create=True, size=max(1, len(pair_keys) * 8))
+    pair_times = np.ndarray(len(pair_keys), dtype=np.float64, buffer=memory.buf)
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                   initargs=(memory.name, indices, indptr, dests, pair_keys)) \
+        if workers > 1 and len(starts) > 1 else None
+    gaps = []
+    iteration = 0
+    try:
+        with instrument.stage("assignment.solve", method=method, zones=len(pois)) as record:
+            flow, _, unassigned = all_or_nothing(free_flow_time)
+            for iteration in range(1, max_iterations + 1):
+                times = bpr(free_flow_time, flow, capacity, alpha, beta)
+                target, shortest_cost, unassigned = all_or_nothing(times)
+                total_cost = (times * flow).sum()
+                gaps.append((total_cost - shortest_cost) / total_cost if total_cost > 0 else 0)
+                instrument.log(f"Assignment iteration {iteration}, relative gap {gaps[-1]:.2e}")
+                if gaps[-1] <= gap:
+                    break
+                direction = target - flow
+                if method == "msa":
+                    step = 1 / (iteration + 1)
+                else:
+                    step = _line_search(free_flow_time, flow, direction, capacity, alpha, beta)
+                flow = flow + step * direction
+            record["rows"] = len(edges) * iteration
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        del pair_times
+        memory.close()
+        memory.unlink()
+
+    times = bpr(free_flow_time, flow, capacity, alpha, beta)
+    res = pd.DataFrame({"flow": flow, "capacity": capacity, "free_flow_time": free_flow_time,
+                        "travel_time": times, "voc": flow / capacity}, index=edges.index)
+    if hour is not None:
+        network.set_speed_profiles(res[["travel_time"]].rename(columns={"travel_time": profile_column(hour)}))
+    return {"edges": res, "gaps": gaps, "unassigned": unassigned}
@@ -0,0 +1,156 @@
+import os
+os.environ['USE_PYGEOS'] = '0'
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+from mobref.config import load_config, load_area, load_networks
+from mobref.network import UNREACHABLE
+from mobref import instrument
+
+
+def read_od_chunks(input_path, chunksize, columns=None):
+    """
+    Read an OD file chunk by chunk.
+
+    Args:
+        input_path (str): Path to a CSV or Parquet file.
+        chunksize (int): Number of rows per chunk.
+        columns (list, optional): Columns to read. Defaults to all columns.
+
+    Returns:
+        iterator: DataFrames of at most chunksize rows.
+    """
+    if input_path.endswith(".parquet") or input_path.endswith(".pq"):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(input_path)
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(input_path, chunksize=chunksize, usecols=columns)
+
+
+def route_od(network, od, columns=("o_lon", "o_lat", "d_lon", "d_lat"), hour=None):
+    """
+    Compute travel times and distances for a DataFrame of OD pairs.
+
+    Args:
+        network: Network object representing the transportation network.
+        od (pandas.DataFrame): DataFrame of OD pairs.
+        columns (tuple, optional): Names of the origin lon, origin lat, destination lon
+            and destination lat columns. Default is ("o_lon", "o_lat", "d_lon", "d_lat").
+        hour (int, optional): Departure hour of the drive speed profiles. Defaults to None, the free flow travel times.
+
+    Returns:
+        pandas.DataFrame: 'travel_time' (s) and 'distance' (m) of each pair, NaN when unreachable.
+    """
+    o_lon, o_lat, d_lon, d_lat = columns
+    origs = network.pdn.get_node_ids(od[o_lon], od[o_lat]).values
+    dests = network.pdn.get_node_ids(od[d_lon], od[d_lat]).values
+    res = pd.DataFrame(index=od.index)
+    for name, impedence in (("travel_time", network.impedence_at(hour)), ("distance", "length")):
+        lengths = np.asarray(network.get_pdn(impedence).shortest_path_lengths(origs, dests, imp_name=impedence))
+        res[name] = np.where(lengths >= UNREACHABLE, np.nan, lengths)
+    return res
+
+
+def batch_route(network, input_path, output_path, chunksize=1000000, columns=("o_lon", "o_lat", "d_lon", "d_lat"),
+                keep=(), output_format="parquet", hour=None):
+    """
+    Route every OD pair of a file and stream the results to disk with bounded memory.
+
+    The input is read chunk by chunk and each chunk is written as its own part
+    file, {output_path}/part-{chunk:06d}.{format}, moved into place only once
+    complete. Running the same command again after an interruption skips the
+    chunks whose part already exists.
+
+    Args:
+        network: Network object representing the transportation network.
+        input_path (str): Path to a CSV or Parquet OD file.
+        output_path (str): Directory where the part files are written.
+        chunksize (int, optional): Number of OD pairs per chunk. Default is 1000000.
+        columns (tuple, optional): Names of the origin lon, origin lat, destination lon
+            and destination lat columns. Default is ("o_lon", "o_lat", "d_lon", "d_lat").
+        keep (tuple, optional): Input columns copied to the output, such as an OD id. Default is ().
+        output_format (str, optional): "parquet" or "csv". Default is "parquet".
+        hour (int, optional): Departure hour of the drive speed profiles. Defaults to None, the free flow travel times.
+
+    Returns:
+        int: Number of chunks routed during this run.
+    """
+    if output_format not in ("parquet", "csv"):
+        raise ValueError(f"Unknown output format {output_format}")
+    os.makedirs(output_path, exist_ok=True)
+    routed = 0
+    for i, od in enumerate(read_od_chunks(input_path, chunksize, list(columns) + list(keep))):
+        part = f"{output_path}/part-{i:06d}.{output_format}"
+        if os.path.exists(part):
+            continue
+        with instrument.stage("batch.chunk", mode=network.mode, chunk=i) as record:
+            res = pd.concat([od[list(keep)], route_od(network, od, columns, hour)], axis=1)
+            record["rows"] = len(od)
+        tmp = f"{part}.tmp"
+        if output_format == "parquet":
+            res.reset_index(drop=True).to_parquet(tmp, index=False)
+        else:
+            res.to_csv(tmp, index=False)
+        os.replace(tmp, part)
+        routed += 1
+        instrument.log(f"Routed chunk {i} ({len(od)} pairs)")
+    return routed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="mobref", description="Mobility referential command line tool.")
+    parser.add_argument("--trace", help="append the timing and memory of every stage to this JSON lines file")
+    parser.add_argument("--quiet", action="store_true", help="do not print progress messages")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    batch = subparsers.add_parser("batch", help="route the OD pairs of a CSV or Parquet file")
+    batch.add_argument("configuration_file")
+    batch.add_argument("input", help="CSV or Parquet file of OD pairs")
+    batch.add_argument("output", help="directory of the result part files")
+    batch.add_argument("--mode", default="drive", choices=["drive", "walk", "bike", "transit"])
+    batch.add_argument("--chunksize", type=int, default=1000000)
+    batch.add_argument("--columns", nargs=4, default=["o_lon", "o_lat", "d_lon", "d_lat"],
+                       metavar=("O_LON", "O_LAT", "D_LON", "D_LAT"))
+    batch.add_argument("--keep", nargs="*", default=[], help="input columns copied to the output")
+    batch.add_argument("--format", default="parquet", choices=["parquet", "csv"])
+    batch.add_argument("--hour", type=int, help="departure hour of the drive speed profiles")
+
+    grid = subparsers.add_parser("grid", help="compute grid to grid matrices as a resumable sharded job")
+    grid.add_argument("configuration_file")
+    grid.add_argument("job_path", help="job directory, may be shared by several machines")
+    grid.add_argument("--mode", default="drive", choices=["drive", "walk", "bike", "transit"])
+    grid.add_argument("--grid-size", type=float, default=100)
+    grid.add_argument("--shard-size", type=int, default=500)
+    grid.add_argument("--merge", action="store_true", help="merge the shards once all are computed")
+
+    serve = subparsers.add_parser("serve", help="serve networks over HTTP, see mobref.server")
+    serve.add_argument("arguments", nargs=argparse.REMAINDER)
+
+    args = parser.parse_args(argv)
+    instrument.configure(trace_path=args.trace, quiet=args.quiet or None)
+    if args.command == "serve":
+        from mobref import server
+        server.main(args.arguments)
+    elif args.command == "batch":
+        cfg = load_config(args.configuration_file)
+        area = load_area(cfg)
+        network = load_networks(cfg, area, [args.mode])[args.mode]
+        batch_route(network, args.input, args.output, args.chunksize, tuple(args.columns),
+                    tuple(args.keep), args.format, args.hour)
+    elif args.command == "grid":
+        from mobref.matrix_jobs import GridMatrixJob
+        cfg = load_config(args.configuration_file)
+        area = load_area(cfg)
+        area.make_grid(args.grid_size)
+        network = load_networks(cfg, area, [args.mode])[args.mode]
+        job = GridMatrixJob(network, args.job_path, shard_size=args.shard_size)
+        job.run()
+        if args.merge and job.is_complete():
+            job.merge()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,85 @@
+import os
+import yaml
+from mobref.area import Area
+from mobref.network import Network
+from mobref.pbf import clear_cache
+from mobref.profiles import read_table, profiles_from_factors, profiles_from_speed_table
+
+
+def load_config(yml_path):
+    """
+    Load a mobref YAML configuration file (see conf-example.yml).
+
+    Args:
+        yml_path (str): Path to the configuration file.
+
+    Returns:
+        dict: Configuration, with the processed data directory created if needed.
+    """
+    with open(yml_path, "r") as yml_file:
+        cfg = yaml.safe_load(yml_file)
+    if not os.path.isdir(cfg["processed_path"]):
+        os.mkdir(cfg["processed_path"])
+    return cfg
+
+
+def load_area(cfg):
+    """
+    Create the Area described by a configuration.
+
+    Args:
+        cfg (dict): Configuration loaded with load_config.
+
+    Returns:
+        Area: Area object.
+    """
+    return Area(cfg["processed_path"], cfg["municipalities_path"], cfg["administrative_cutting_path"])
+
+
+def load_tiled_area(cfg):
+    """
+    Create the TiledArea described by a configuration, with its tile_size and
+    tile_buffer in meters (10000 and 2000 by default).
+
+    Args:
+        cfg (dict): Configuration loaded with load_config.
+
+    Returns:
+        TiledArea: TiledArea object.
+    """
+    from mobref.tiles import TiledArea
+    return TiledArea(cfg["processed_path"], cfg["municipalities_path"], cfg["administrative_cutting_path"],
+                     cfg.get("tile_size", 10000), cfg.get("tile_buffer", 2000))
+
+
+def load_networks(cfg, area, modes=None):
+    """
+    Create the Networks described by a configuration.
+
+    Args:
+        cfg (dict): Configuration loaded with load_config.
+        area (Area): Area object.
+        modes (list, optional): Modes to load. Defaults to drive, walk, bike, and
+            transit when a gtfs_path is configured. Street networks are read from
+            pbf_path when it is configured, otherwise downloaded. Bike and walk
+            travel times follow the topography when dem_path is configured, and the
+            drive network gets hourly speed profiles when speed_table_path or
+            congestion_factors_path is configured.
+
+    Returns:
+        dict: Network objects keyed by mode.
+    """
+    gtfs_path = cfg.get("gtfs_path")
+    if modes is None:
+        modes = ["drive", "walk", "bike"] + (["transit"] if gtfs_path else [])
+    networks = {mode: Network(area, mode, cfg["processed_path"], gtfs_path, cfg.get("pbf_path"),
+                              cfg.get("dem_path")) for mode in modes}
+    clear_cache()
+    if "drive" in networks:
+        drive = networks["drive"]
+        if cfg.get("speed_table_path"):
+            drive.set_speed_profiles(profiles_from_speed_table(drive.edges, read_table(cfg["speed_table_path"])))
+        elif cfg.get("congestion_factors_path"):
+            factors = read_table(cfg["congestion_factors_path"]).set_index("highway")
+            drive.set_speed_profiles(profiles_from_factors(drive.edges, factors))
+    return networks
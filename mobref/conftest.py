@@ -0,0 +1,21 @@
+import pytest
+from mobref import synthetic
+from mobref.network import Network
+
+
+def _drive_network(processed_path, nodes, edges):
+    area = synthetic.write_area(processed_path, nodes)
+    synthetic.write_network(processed_path, nodes, edges, "drive")
+    return Network(area, "drive", processed_path)
+
+
+@pytest.fixture(scope="session")
+def grid_network(tmp_path_factory):
+    return _drive_network(str(tmp_path_factory.mktemp("grid")), *synthetic.grid_network(20))
+
+
+@pytest.fixture(scope="session")
+def geometric_network(tmp_path_factory):
+    # sparse enough to have several components, hence unreachable pairs
+    nodes, edges = synthetic.random_geometric_network(400, radius=220, extent=3000)
+    return _drive_network(str(tmp_path_factory.mktemp("geometric")), nodes, edges)
@@ -0,0 +1,128 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse.csgraph import dijkstra
+from mobref import instrument
+from mobref.graph_utils import to_csr
+from mobref.matrices import UNREACHABLE
+
+# adjacency matrix of the worker processes, sent once by _init_worker
+_worker_matrix = None
+
+
+def _init_worker(matrix):
+    global _worker_matrix
+    _worker_matrix = matrix
+
+
+def _dijkstra(matrix, sources, dests, limit, dtype):
+    """
+    Multi-source Dijkstra from a batch of node positions, keeping the destination columns.
+    """
+    dist = dijkstra(matrix, directed=True, indices=sources, limit=limit)
+    if dests is not None:
+        dist = dist[:, dests]
+    return dist.astype(dtype, copy=False)
+
+
+def _dijkstra_worker(sources, dests, limit, dtype):
+    return _dijkstra(_worker_matrix, sources, dests, limit, dtype)
+
+
+class CSRRouter():
+
+    def __init__(self, nodes, edges, impedence="weight"):
+        """
+        One-to-all routing backend running Dijkstra on a CSR graph with scipy.sparse.csgraph.
+
+        pandana answers point-to-point queries quickly through its contraction
+        hierarchy, but has no cheap way to get the full travel time tree of an
+        origin. CSRRouter computes these trees, for many origins at once, in
+        batches run in parallel worker processes.
+
+        Args:
+            nodes (pandas.DataFrame): DataFrame containing node information.
+            edges (pandas.DataFrame): DataFrame containing edge information.
+            impedence (str, optional): Edge attribute used as impedance. Default is "weight".
+        """
+        self.impedence = impedence
+        self.matrix, self.ids = to_csr(nodes, edges, impedence)
+
+    def positions(self, node_ids):
+        """
+        Positions in the CSR matrix of network node ids.
+
+        Raises:
+            KeyError: If a node id is not in the network.
+        """
+        positions = self.ids.get_indexer(np.asarray(node_ids))
+        if (positions < 0).any():
+            raise KeyError(f"Unknown node ids {np.asarray(node_ids)[positions < 0][:10]}")
+        return positions
+
+    def iter_one_to_all(self, orig_nodes, dest_nodes=None, limit=np.inf, batch_size=256,
+                        workers=None, dtype=np.float32):
+        """
+        Compute the shortest path lengths from origins to all nodes, batch by batch.
+
+        Args:
+            orig_nodes (array-like): Network node ids of the origins.
+            dest_nodes (array-like, optional): Network node ids of the columns to keep. Defaults to all nodes.
+            limit (float, optional): Lengths above limit are not explored and returned as inf. Default is inf.
+            batch_size (int, optional): Number of origins per Dijkstra call. Default is 256.
+            workers (int, optional): Number of worker processes, 1 runs in this process.
+                Defaults to the number of CPUs.
+            dtype (numpy.dtype, optional): Type of the returned lengths. Default is float32.
+
+        Yields:
+            int, numpy.ndarray: Position of the first origin of the batch and its
+            (batch, destinations) lengths, inf when unreachable, in origin order.
+        """
+        sources = self.positions(orig_nodes)
+        dests = None if dest_nodes is None else self.positions(dest_nodes)
+        starts = range(0, len(sources), batch_size)
+        workers = workers or os.cpu_count()
+        if workers == 1 or len(starts) == 1:
+            for start in starts:
+                yield start, _dijkstra(self.matrix, sources[start:start + batch_size], dests, limit, dtype)
+            return
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(self.matrix,)) as executor:
+            futures = [executor.submit(_dijkstra_worker, sources[start:start + batch_size], dests, limit, dtype)
+                       for start in starts]
+            for start, future in zip(starts, futures):
+                yield start, future.result()
+
+    def one_to_all(self, orig_nodes, dest_nodes=None, limit=np.inf, batch_size=256, workers=None,
+                   dtype=np.float32):
+        """
+        Compute the shortest path lengths from origins to all nodes (or to dest_nodes).
+
+        Args:
+            See iter_one_to_all.
+
+        Returns:
+            numpy.ndarray: (len(orig_nodes), destinations) lengths, inf when unreachable.
+        """
+        n_dests = len(self.ids) if dest_nodes is None else len(dest_nodes)
+        res = np.empty((len(orig_nodes), n_dests), dtype=dtype)
+        with instrument.stage("csr.one_to_all", impedence=self.impedence) as record:
+            for start, dist in self.iter_one_to_all(orig_nodes, dest_nodes, limit, batch_size, workers, dtype):
+                res[start:start + len(dist)] = dist
+            record["rows"] = res.size
+        return res
+
+    def nodes_matrix(self, orig_nodes, dest_nodes, batch_size=256, workers=None):
+        """
+        Matrix of shortest path lengths between two sets of nodes, in the format of
+        Network.get_nodes_matrix, so that both backends are interchangeable.
+
+        Returns:
+            numpy.ndarray: (len(orig_nodes), len(dest_nodes)) float64 matrix, unreachable pairs are set to UNREACHABLE.
+        """
+        orig_nodes = np.asarray(orig_nodes)
+        # one tree per distinct origin
+        unique, inverse = np.unique(orig_nodes, return_inverse=True)
+        dist = self.one_to_all(unique, dest_nodes, batch_size=batch_size, workers=workers, dtype=np.float64)
+        dist[np.isinf(dist)] = UNREACHABLE
+        return dist[inverse]
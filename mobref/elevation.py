@@ -0,0 +1,171 @@
+import os
+import numpy as np
+import shapely
+import rasterio
+from rasterio.windows import Window
+from pyproj import Transformer
+from mobref import instrument
+
+# flat speeds in km/h, as used by Network.create_network
+FLAT_SPEEDS = {"bike": 20, "walk": 4.8}
+
+
+def bike_speed(grade):
+    """
+    Cycling speed in km/h on a slope: slower uphill, faster downhill up to 30 km/h.
+
+    Args:
+        grade (numpy.ndarray): Rise over run, positive uphill.
+
+    Returns:
+        numpy.ndarray: Speeds in km/h.
+    """
+    flat = FLAT_SPEEDS["bike"]
+    return np.where(grade > 0, flat / (1 + 10 * grade), np.minimum(flat * (1 - 5 * grade), 30))
+
+
+def walk_speed(grade):
+    """
+    Walking speed in km/h on a slope, Tobler's hiking function scaled to the flat walking speed.
+
+    Args:
+        grade (numpy.ndarray): Rise over run, positive uphill.
+
+    Returns:
+        numpy.ndarray: Speeds in km/h.
+    """
+    return FLAT_SPEEDS["walk"] * np.exp(-3.5 * np.abs(grade + 0.05)) / np.exp(-3.5 * 0.05)
+
+
+SPEED_FUNCTIONS = {"bike": bike_speed, "walk": walk_speed}
+
+
+def sample_dem(dem_path, xs, ys, crs="epsg:4326"):
+    """
+    Read the elevation of many points from a DEM, reading only the raster blocks holding points.
+
+    Points are grouped by raster block, and each block is read once with a
+    windowed read, so a regional DEM is never loaded whole into memory.
+
+    Args:
+        dem_path (str): Path to a single band DEM, such as a GeoTIFF.
+        xs (numpy.ndarray): X coordinates of the points.
+        ys (numpy.ndarray): Y coordinates of the points.
+        crs (optional): CRS of the coordinates. Default is "epsg:4326".
+
+    Returns:
+        numpy.ndarray: float32 elevations, NaN outside the DEM or on nodata cells.
+    """
+    elevations = np.full(len(xs), np.nan, dtype=np.float32)
+    with rasterio.open(dem_path) as dem:
+        if dem.crs is not None and dem.crs != crs:
+            xs, ys = Transformer.from_crs(crs, dem.crs, always_xy=True).transform(xs, ys)
+        cols, rows = ~dem.transform * (np.asarray(xs), np.asarray(ys))
+        rows, cols = np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64)
+        inside = np.flatnonzero((rows >= 0) & (rows < dem.height) & (cols >= 0) & (cols < dem.width))
+        block_height, block_width = dem.block_shapes[0]
+        blocks = (rows[inside] // block_height) * ((dem.width + block_width - 1) // block_width) \
+            + cols[inside] // block_width
+        order = np.argsort(blocks, kind="stable")
+        inside, blocks = inside[order], blocks[order]
+        bounds = np.flatnonzero(np.diff(blocks)) + 1
+        for points in np.split(inside, bounds):
+            if not len(points):
+                continue
+            row0 = rows[points[0]] // block_height * block_height
+            col0 = cols[points[0]] // block_width * block_width
+            window = Window(col0, row0, min(block_width, dem.width - col0), min(block_height, dem.height - row0))
+            block = dem.read(1, window=window, masked=True).astype(np.float32).filled(np.nan)
+            elevations[points] = block[rows[points] - row0, cols[points] - col0]
+    return elevations
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def edge_profiles(edges, dem_path, cache_path=None, step=20):
+    """
+    Sample the elevation profile of every edge, every step meters along its geometry.
+
+    The profiles are cached in cache_path with the DEM signature and the edge
+    ids, so rebuilding a network on the same edges never reads the raster again.
+
+    Args:
+        edges (geopandas.GeoDataFrame): Edges with a geometry, indexed by (u, v, key).
+        dem_path (str): Path to the DEM.
+        cache_path (str, optional): .npz file caching the profiles. Defaults to no cache.
+        step (float, optional): Sampling distance in meters. Default is 20.
+
+    Returns:
+        numpy.ndarray, numpy.ndarray, numpy.ndarray: Edge position of every sampled
+        point, distance in meters from the previous point of the same edge, and elevation.
+    """
+    metric = edges.geometry.to_crs(edges.estimate_utm_crs())
+    points = shapely.segmentize(metric.values, step)
+    coords, edge_index = shapely.get_coordinates(points, return_index=True)
+    steps = np.hypot(*np.diff(coords, axis=0, prepend=coords[:1]).T)
+    steps[np.r_[True, edge_index[1:] != edge_index[:-1]]] = 0
+
+    signature = _file_signature(dem_path)
+    ids = np.asarray(edges.index.to_frame().iloc[:, :2], dtype=np.int64)
+    if cache_path is not None and os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            if (cache["step"] == step and np.array_equal(cache["signature"], signature)
+                    and np.array_equal(cache["ids"], ids) and len(cache["elevations"]) == len(coords)):
+                return edge_index, steps, cache["elevations"]
+
+    with instrument.stage("elevation.sample") as record:
+        lon, lat = Transformer.from_crs(metric.crs, "epsg:4326", always_xy=True).transform(coords[:, 0], coords[:, 1])
+        elevations = sample_dem(dem_path, lon, lat)
+        record["rows"] = len(elevations)
+    if cache_path is not None:
+        tmp = f"{cache_path}.tmp.npz"
+        np.savez(tmp, step=step, signature=signature, ids=ids, elevations=elevations)
+        os.replace(tmp, cache_path)
+    return edge_index, steps, elevations
+
+
+def add_edge_topography(edges, dem_path, mode, cache_path=None, step=20):
+    """
+    Add the grade of every edge and adapt bike or walk travel times to the topography.
+
+    Every edge is cut into steps of its elevation profile, each step gets the
+    speed of its own grade, so climbing then descending costs more than a flat
+    edge, and opposite edges, whose geometries run in opposite directions, get
+    different travel times.
+
+    Args:
+        edges (geopandas.GeoDataFrame): Edges with 'length' and a geometry.
+        dem_path (str): Path to the DEM.
+        mode (str): "bike" or "walk".
+        cache_path (str, optional): .npz file caching the elevation profiles.
+        step (float, optional): Sampling distance in meters. Default is 20.
+
+    Returns:
+        geopandas.GeoDataFrame: Edges with 'grade' (end to end), 'climb' (meters
+        ascended) and updated 'travel_time' and 'weight'.
+    """
+    edge_index, steps, elevations = edge_profiles(edges, dem_path, cache_path, step)
+    rise = np.diff(elevations, prepend=np.nan)
+    rise[steps == 0] = 0
+    # unknown elevations count as flat
+    rise = np.nan_to_num(rise)
+    grade = np.divide(rise, steps, out=np.zeros_like(steps), where=steps > 0)
+
+    geometry_length = np.bincount(edge_index, weights=steps, minlength=len(edges))
+    # scale to the network lengths, geometries are simplified
+    scale = np.divide(edges["length"].values, geometry_length, out=np.ones(len(edges)), where=geometry_length > 0)
+    time = steps * scale[edge_index] / (SPEED_FUNCTIONS[mode](grade) / 3.6)
+    travel_time = np.bincount(edge_index, weights=time, minlength=len(edges))
+    flat = edges["length"].values / (FLAT_SPEEDS[mode] / 3.6)
+
+    edges = edges.copy()
+    edges["climb"] = np.bincount(edge_index, weights=np.maximum(rise, 0), minlength=len(edges))
+    total_rise = np.bincount(edge_index, weights=rise, minlength=len(edges))
+    edges["grade"] = np.divide(total_rise, geometry_length, out=np.zeros(len(edges)), where=geometry_length > 0)
+    # edges without geometry length keep their flat travel time
+    edges["travel_time"] = np.where(geometry_length > 0, travel_time, flat)
+    edges["weight"] = edges["travel_time"]
+    return edges
@@ -0,0 +1,300 @@
+import os
+import json
+import pickle
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from mobref import instrument
+from mobref.graph_utils import load_graph, _first
+
+# edge columns kept in the routing core of a Network, the other ones go to the GeometryStore
+EDGE_ROUTING_COLUMNS = ["from_int", "to_int", "length", "distance", "speed_kph", "travel_time", "weight",
+                        "grade", "climb", "highway", "oneway", "lanes", "net_type", "unique_route_id",
+                        "unique_trip_id", "sequence", "mean"]
+NODE_ROUTING_COLUMNS = ["x", "y", "id", "net_type"]
+# columns holding a few distinct values, stored as categoricals
+CATEGORICAL_COLUMNS = ["highway", "net_type", "unique_route_id", "unique_trip_id"]
+
+
+def _compact(frame, columns):
+    """
+    Routing columns of a frame, with float32 costs, categorical strings and downcast integer ids.
+    """
+    columns = [c for c in frame.columns if c in columns or c.startswith("weight_h")]
+    core = pd.DataFrame(index=frame.index)
+    for column in columns:
+        values = frame[column]
+        if column in CATEGORICAL_COLUMNS:
+            values = values.map(_first).astype("category")
+        elif column == "oneway":
+            values = values.map(_first).fillna(False).astype(bool)
+        elif column == "lanes":
+            values = pd.to_numeric(values.map(_first), errors="coerce").astype(np.float32)
+        elif column in ("x", "y"):
+            # snapping needs full precision coordinates
+            values = values.astype(np.float64)
+        elif pd.api.types.is_integer_dtype(values):
+            values = pd.to_numeric(values, downcast="integer")
+        elif pd.api.types.is_numeric_dtype(values):
+            values = values.astype(np.float32)
+        core[column] = values
+    return core
+
+
+def split_graph(nodes, edges):
+    """
+    Split a graph into its compact routing core and its geometries and tags.
+
+    Args:
+        nodes (pandas.DataFrame): DataFrame containing node information.
+        edges (pandas.DataFrame): DataFrame containing edge information.
+
+    Returns:
+        tuple: (nodes, edges) routing core, without geometry, and (nodes, edges)
+        holding the geometry and tag columns, indexed like the core.
+    """
+    core_nodes = _compact(nodes, NODE_ROUTING_COLUMNS)
+    core_edges = _compact(edges, EDGE_ROUTING_COLUMNS)
+    store_nodes = nodes[[c for c in nodes.columns if c not in core_nodes.columns]]
+    store_edges = edges[[c for c in edges.columns if c not in core_edges.columns]]
+    return (core_nodes, core_edges), (store_nodes, store_edges)
+
+
+class GeometryStore():
+
+    def __init__(self, path):
+        """
+        Geometries and OSM tags of a network, read from disk on first use.
+
+        Routing only needs the compact core of a Network, so geometries and tags
+        are kept out of memory until something draws or exports the network.
+
+        Args:
+            path (str): Path of the store, written by save.
+        """
+        self.path = path
+        self._nodes = None
+        self._edges = None
+        self._route_index = None
+
+    def save(self, nodes, edges):
+        """
+        Write the geometry and tag columns of nodes and edges, see split_graph.
+        """
+        # unlike save_graph, the store of a graph may have no column at all, such as transit nodes
+        with open(self.path, "wb") as file:
+            pickle.dump({"nodes": nodes, "edges": edges}, file)
+        self._nodes, self._edges, self._route_index = None, None, None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        if self._edges is None:
+            with instrument.stage("geometry.load") as record:
+                self._nodes, self._edges = load_graph(self.path)
+                record["rows"] = len(self._edges)
+
+    @property
+    def nodes(self):
+        """
+        GeoDataFrame of the node geometries and tags.
+        """
+        self.load()
+        return self._nodes
+
+    @property
+    def edges(self):
+        """
+        GeoDataFrame of the edge geometries and tags.
+        """
+        self.load()
+        return self._edges
+
+    def release(self):
+        """
+        Free the geometries and tags, they are read again on next use.
+        """
+        self._nodes, self._edges, self._route_index = None, None, None
+
+    def join(self, nodes, edges):
+        """
+        Full graph, as built before split_graph, from a routing core and this store.
+
+        Args:
+            nodes (pandas.DataFrame): Core nodes.
+            edges (pandas.DataFrame): Core edges.
+
+        Returns:
+            geopandas.GeoDataFrame, geopandas.GeoDataFrame: Nodes and edges with every column.
+        """
+        full_nodes = nodes.join(self.nodes)
+        full_edges = edges.join(self.edges)
+        if "geometry" in full_nodes.columns:
+            full_nodes = gpd.GeoDataFrame(full_nodes, geometry="geometry", crs=self.nodes.crs)
+        if "geometry" in full_edges.columns:
+            full_edges = gpd.GeoDataFrame(full_edges, geometry="geometry", crs=self.edges.crs)
+        return full_nodes, full_edges
+
+    def route_index(self, nodes, edges):
+        """
+        Lon/lat coordinates of every edge geometry, flattened once for route_geometries.
+
+        Args:
+            nodes (pandas.DataFrame): Core nodes, whose coordinates draw the edges without geometry.
+            edges (pandas.DataFrame): Core edges.
+
+        Returns:
+            pandas.MultiIndex, numpy.ndarray, numpy.ndarray: (from_int, to_int) of the
+            fastest edge of every node pair, the (n, 2) coordinates and the offset of
+            the first coordinate of every pair, followed by the total.
+        """
+        if self._route_index is not None:
+            return self._route_index
+        with instrument.stage("geometry.route_index") as record:
+            edges = edges.sort_values("weight", kind="stable")
+            edges = edges[~edges.duplicated(["from_int", "to_int"])]
+            geometries = None
+            if "geometry" in self.edges.columns:
+                geometries = self.edges.geometry.reindex(edges.index)
+                if geometries.crs is not None and not geometries.crs.equals("epsg:4326"):
+                    geometries = geometries.to_crs("epsg:4326")
+                geometries = geometries.values
+            # transit edges have no geometry, they are drawn as straight lines
+            straight = shapely.linestrings(np.stack([
+                nodes["x"].reindex(edges["from_int"]).values, nodes["y"].reindex(edges["from_int"]).values,
+                nodes["x"].reindex(edges["to_int"]).values, nodes["y"].reindex(edges["to_int"]).values],
+                axis=1).reshape(-1, 2, 2))
+            if geometries is None:
+                geometries = straight
+            else:
+                missing = shapely.is_missing(geometries) | shapely.is_empty(geometries)
+                geometries = np.where(missing, straight, geometries)
+            coords, index = shapely.get_coordinates(geometries, return_index=True)
+            offsets = np.searchsorted(index, np.arange(len(edges) + 1))
+            pairs = pd.MultiIndex.from_arrays([edges["from_int"].values, edges["to_int"].values])
+            record["rows"] = len(coords)
+        self._route_index = pairs, coords, offsets
+        return self._route_index
+
+    def route_coordinates(self, nodes, edges, paths):
+        """
+        Gather the coordinates of many node paths at once.
+
+        Args:
+            nodes (pandas.DataFrame): Core nodes.
+            edges (pandas.DataFrame): Core edges.
+            paths (list): Node id paths, such as the output of pandana shortest_paths.
+
+        Returns:
+            numpy.ndarray, numpy.ndarray: (n, 2) lon/lat coordinates of every path, one after
+            the other, and the path position of every coordinate. Paths without edge have none.
+
+        Raises:
+            KeyError: If two consecutive nodes of a path are not linked by an edge.
+        """
+        pairs, coords, offsets = self.route_index(nodes, edges)
+        lengths = np.fromiter((len(p) for p in paths), dtype=np.int64, count=len(paths))
+        flat = np.concatenate([np.asarray(p, dtype=np.int64) for p in paths]) if len(paths) else \
+            np.empty(0, dtype=np.int64)
+        node_path = np.repeat(np.arange(len(paths)), lengths)
+        step = node_path[:-1] == node_path[1:]
+        edge_path = node_path[:-1][step]
+        edge = pairs.get_indexer(pd.MultiIndex.from_arrays([flat[:-1][step], flat[1:][step]]))
+        if (edge < 0).any():
+            raise KeyError(f"No edge between nodes {flat[:-1][step][edge < 0][:10]}")
+        # the first point of an edge is the last point of the previous edge of the same path
+        first = np.r_[True, edge_path[1:] != edge_path[:-1]]
+        starts = offsets[edge] + ~first
+        counts = offsets[edge + 1] - starts
+        total = counts.sum()
+        gather = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+        return coords[gather], np.repeat(edge_path, counts)
+
+    def route_geometries(self, nodes, edges, paths):
+        """
+        LineStrings of many node paths, see route_coordinates.
+
+        Returns:
+            numpy.ndarray: shapely LineStrings in lon/lat, None for paths without edge.
+        """
+        coords, point_path = self.route_coordinates(nodes, edges, paths)
+        geometries = np.full(len(paths), None, dtype=object)
+        if len(coords):
+            lines, indices = np.unique(point_path, return_inverse=True)
+            geometries[lines] = shapely.linestrings(coords, indices=indices)
+        return geometries
+
+    def route_polylines(self, nodes, edges, paths, precision=5):
+        """
+        Google encoded polylines of many node paths, see route_coordinates.
+
+        Args:
+            precision (int, optional): Number of decimals of the coordinates. Default is 5.
+
+        Returns:
+            list: Encoded polylines, empty strings for paths without edge.
+        """
+        coords, point_path = self.route_coordinates(nodes, edges, paths)
+        return encode_polylines(coords, point_path, len(paths), precision)
+
+
+def encode_polylines(coords, point_path, n_paths, precision=5):
+    """
+    Encode lon/lat coordinates as Google polylines, all paths at once.
+
+    Args:
+        coords (numpy.ndarray): (n, 2) lon/lat coordinates of the paths, one after the other.
+        point_path (numpy.ndarray): Path position of every coordinate, sorted.
+        n_paths (int): Number of paths.
+        precision (int, optional): Number of decimals of the coordinates. Default is 5.
+
+    Returns:
+        list: One encoded polyline per path.
+    """
+    values = np.rint(coords[:, ::-1] * 10**precision).astype(np.int64)
+    first = np.r_[True, point_path[1:] != point_path[:-1]]
+    deltas = values.copy()
+    deltas[1:] -= values[:-1]
+    deltas[first] = values[first]
+    deltas = deltas.ravel()
+    zigzag = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    # 5 bit chunks, least significant first, all but the last one flagged with 0x20
+    shifts = np.arange(7) * 5
+    chunks = (zigzag[:, None] >> shifts) & 31
+    n_chunks = np.maximum((zigzag[:, None] >> shifts > 0).sum(axis=1), 1)
+    used = shifts < (n_chunks[:, None] * 5)
+    more = shifts < ((n_chunks[:, None] - 1) * 5)
+    chars = (chunks | np.where(more, 0x20, 0)) + 63
+    chars = chars[used].astype(np.uint8).tobytes()
+    char_path = np.repeat(np.repeat(point_path, 2), n_chunks)
+    bounds = np.searchsorted(char_path, np.arange(n_paths + 1))
+    return [chars[bounds[i]:bounds[i + 1]].decode("ascii") for i in range(n_paths)]
+
+
+def write_routes(path, geometries, properties=None, polylines=None):
+    """
+    Write routes to a GeoParquet file (.parquet) or a GeoJSON text sequence (any other extension).
+
+    Args:
+        path (str): Output path.
+        geometries (array-like): Route LineStrings in lon/lat, see route_geometries.
+        properties (pandas.DataFrame, optional): Route attributes, one row per route.
+        polylines (list, optional): Encoded polylines, written as a 'polyline' property.
+    """
+    properties = pd.DataFrame(index=range(len(geometries))) if properties is None \
+        else properties.reset_index(drop=True)
+    if polylines is not None:
+        properties = properties.assign(polyline=polylines)
+    with instrument.stage("geometry.write_routes") as record:
+        if path.endswith(".parquet"):
+            gpd.GeoDataFrame(properties, geometry=np.asarray(geometries), crs="epsg:4326").to_parquet(path)
+        else:
+            features = shapely.to_geojson(np.asarray(geometries))
+            records = json.loads(properties.to_json(orient="records"))
+            with open(path, "w") as file:
+                for geometry, attributes in zip(features, records):
+                    file.write(f'\x1e{{"type":"Feature","properties":{json.dumps(attributes)},'
+                               f'"geometry":{geometry or "null"}}}\n')
+        record["rows"] = len(properties)
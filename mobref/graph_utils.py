@@ -1,47 +1,152 @@
+import os
+import shutil
+import tempfile
+import subprocess
 import osmium
+import shapely
+import numpy as np
+import pandas as pd
+from scipy import sparse
 import geopandas as gpd
 import networkx as nx
 import osmnx as ox
 import pandana as pdn
 import urbanaccess as ua
 from urbanaccess.network import ua_network
-from mobref.patched_ua import integrate_network
+from pyproj import Geod
+from mobref.patched_ua import integrate_network, _add_headway_impedance, _nearest_neighbor, _route_id_to_node
+from mobref import instrument
 import pickle
 
-# Convert the .osm file to .osm.pbf format using osmium
-class OSMToPBFHandler(osmium.SimpleHandler):
+# walk layer of the integrated transit network, in the processed data directory
+WALK_LAYER = "transit_walk_layer.pkl"
+
+
+def _first(value):
+    # simplified osmnx edges hold lists when the merged ways differ
+    return value[0] if isinstance(value, list) else value
+
+
+def _extract(graph_input, graph_output, bbox=None, polygon=None):
     """
-    OSMToPBFHandler is a handler class for converting OSM data to PBF format.
+    Clip an OSM file to a bbox or polygon with osmium-tool, which runs the whole
+    extract in C++: tagged nodes inside, ways with a node inside, relations with
+    one of these as member, and the nodes of the selected ways.
 
-    This class inherits from osmium.SimpleHandler and overrides methods to process OSM data types
-    (nodes, ways, relations) and write them to a PBF file using the provided writer.
+    Raises:
+        FileNotFoundError: If the osmium command of osmium-tool is not installed.
+    """
+    if shutil.which("osmium") is None:
+        raise FileNotFoundError("Clipping OSM files needs the osmium command of osmium-tool")
+    command = ["osmium", "extract", "--strategy", "simple", "--output-format", "pbf",
+               "--output", graph_output, graph_input]
+    with tempfile.TemporaryDirectory() as tmp:
+        if polygon is not None:
+            path = f"{tmp}/polygon.geojson"
+            with open(path, "w") as file:
+                file.write(f'{{"type":"FeatureCollection","features":[{{"type":"Feature","properties":{{}},'
+                           f'"geometry":{shapely.to_geojson(polygon)}}}]}}')
+            command[2:2] = ["--polygon", path]
+        else:
+            command[2:2] = ["--bbox", ",".join(str(c) for c in bbox)]
+        subprocess.run(command, check=True, capture_output=True)
+
+
+def osm_to_pbf(graph_input, graph_output, bbox=None, polygon=None):
     """
+    Convert an OSM file (XML or PBF) to PBF format, optionally clipped to a bbox or polygon.
 
-    def __init__(self, writer):
-        super(OSMToPBFHandler, self).__init__()
-        self.writer = writer
-    def node(self, n):
-        self.writer.add_node(n)
-    def way(self, w):
-        self.writer.add_way(w)
-    def relation(self, r):
-        self.writer.add_relation(r)
+    Without clipping, the file is copied by osmium without any Python callback.
+    Clipping runs osmium extract (see _extract), which must be installed.
 
-def osm_to_pbf(graph_input, graph_output):
+    Args:
+        graph_input (str): The path to the input OSM file.
+        graph_output (str): The path to the output PBF file, which must not exist.
+        bbox (tuple, optional): (min_lon, min_lat, max_lon, max_lat) to clip to.
+        polygon (shapely.geometry.Polygon, optional): Polygon in lon/lat to clip to, such as Area.polygon.
+    """
+    if os.path.exists(graph_output):
+        raise FileExistsError(f"{graph_output} already exists")
+    clip = bbox is not None or polygon is not None
+    with instrument.stage("pbf.convert", clip=clip):
+        if clip:
+            _extract(graph_input, graph_output, bbox, polygon)
+            return
+        writer = osmium.WriteHandler(graph_output)
+        try:
+            osmium.apply(graph_input, writer)
+        finally:
+            writer.close()
+
+
+def graph_to_pbf(nodes, edges, path):
     """
-    Convert OSM data to PBF format.
+    Write a street network, such as a cached processed graph, to a PBF file.
 
-    This function takes an input OSM file, processes its data using the OSMToPBFHandler,
-    and writes the result to an output PBF file.
+    Every pair of opposite edges becomes one way, an edge without its opposite a
+    oneway, and so is every self-loop. Intermediate points of the edge geometries
+    are written as new nodes, numbered after the largest node id, so that way
+    shapes and lengths are kept. Transit edges of integrated networks are skipped.
 
     Args:
-        graph_input (str): The path to the input OSM file.
-        graph_output (str): The path to the output PBF file.
+        nodes (pandas.DataFrame): DataFrame containing node information, indexed by node id with 'x' and 'y'.
+        edges (pandas.DataFrame): DataFrame containing edge information, indexed by (u, v, key).
+        path (str): Path to the output PBF file, which must not exist.
     """
-    writer = osmium.SimpleWriter(graph_output)
-    handler = OSMToPBFHandler(writer)
-    handler.apply_file(graph_input)
-    writer.close()
+    if os.path.exists(path):
+        raise FileExistsError(f"{path} already exists")
+    if "net_type" in edges.columns:
+        edges = edges[edges["net_type"] == "walk"]
+    u = edges.index.get_level_values(0)
+    v = edges.index.get_level_values(1)
+    pairs = pd.MultiIndex.from_arrays([u, v])
+    reverse = pd.MultiIndex.from_arrays([v, u])
+    # a self-loop is its own reverse, every one of them is written with its direction
+    two_way = reverse.isin(pairs) & (u != v)
+    # keep one edge of every two way pair
+    keep = ~two_way | (u < v)
+    edges, two_way = edges[keep], two_way[keep]
+    # bike and transit walk edges are projected, OSM locations are lon/lat
+    crs = getattr(edges, "crs", None)
+    if crs is not None and not crs.equals("epsg:4326"):
+        edges = edges.to_crs("epsg:4326")
+
+    next_id = int(nodes.index.max()) + 1
+    with instrument.stage("pbf.export") as record:
+        writer = osmium.SimpleWriter(path)
+        try:
+            for n, x, y in zip(nodes.index, nodes["x"], nodes["y"]):
+                writer.add_node(osmium.osm.mutable.Node(id=int(n), location=(x, y)))
+            ways = []
+            geometries = edges.geometry if "geometry" in edges.columns else [None] * len(edges)
+            for (a, b), geometry in zip(zip(edges.index.get_level_values(0), edges.index.get_level_values(1)),
+                                        geometries):
+                refs = [int(a)]
+                if geometry is not None:
+                    for x, y in list(geometry.coords)[1:-1]:
+                        writer.add_node(osmium.osm.mutable.Node(id=next_id, location=(x, y)))
+                        refs.append(next_id)
+                        next_id += 1
+                refs.append(int(b))
+                ways.append(refs)
+            columns = {c: edges[c].tolist() for c in ("highway", "maxspeed", "name") if c in edges.columns}
+            for i, (refs, both) in enumerate(zip(ways, two_way)):
+                tags = {}
+                for c, values in columns.items():
+                    value = values[i]
+                    # simplified osmnx edges hold lists when the merged ways differ
+                    if isinstance(value, list):
+                        value = value[0]
+                    if isinstance(value, str):
+                        tags[c] = value
+                if "highway" not in tags:
+                    tags["highway"] = "road"
+                if not both:
+                    tags["oneway"] = "yes"
+                writer.add_way(osmium.osm.mutable.Way(id=i + 1, nodes=refs, tags=tags))
+            record["rows"] = len(ways)
+        finally:
+            writer.close()
 
 
 def save_graph(nodes, edges, path):
@@ -58,8 +163,11 @@ def save_graph(nodes, edges, path):
     """
     if edges.empty or nodes.empty:
         raise ValueError("Net_edges or net_nodes are empty.")
-    nodes = gpd.GeoDataFrame(nodes)
-    edges = gpd.GeoDataFrame(edges)
+    # the routing core of a Network has no geometry, see mobref.geometry
+    if "geometry" in nodes.columns:
+        nodes = gpd.GeoDataFrame(nodes)
+    if "geometry" in edges.columns:
+        edges = gpd.GeoDataFrame(edges)
     graph = {"nodes": nodes, "edges": edges}
     with open(path, "wb") as file:
         pickle.dump(graph, file)
@@ -86,6 +194,9 @@ def create_nx_graph(nodes, edges, retain_all=False, bidirectional=False):
     """
     Create a NetworkX graph from nodes and edges DataFrames.
 
+    Nodes and edges are added in bulk from their columns. Edge lengths are read
+    from 'distance' (integrated transit networks) or else from 'length'.
+
     Args:
         nodes (pandas.DataFrame): DataFrame containing node information.
         edges (pandas.DataFrame): DataFrame containing edge information.
@@ -103,16 +214,16 @@ def create_nx_graph(nodes, edges, retain_all=False, bidirectional=False):
     # Remove edges with uknown nodes
     edges = edges[edges["to_int"].isin(nodes.index) & edges["from_int"].isin(nodes.index)]
 
-    # Add nodes from the nodes DataFrame
-    for id, row in nodes.iterrows():
-        G.add_node(id, orig_id=row["id"], x=row["x"], y=row["y"])
+    orig_ids = nodes["id"] if "id" in nodes.columns else nodes.index
+    G.add_nodes_from(zip(nodes.index.tolist(),
+                         ({"orig_id": o, "x": x, "y": y}
+                          for o, x, y in zip(orig_ids.tolist(), nodes["x"].tolist(), nodes["y"].tolist()))))
 
-    # Add edges from the edges DataFrame
-    for _, row in edges.iterrows():
-        G.add_edge(row["from_int"],
-                   row["to_int"],
-                   travel_time=row["weight"],
-                   length=row["distance"])
+    length = edges["distance"] if "distance" in edges.columns else edges["length"]
+    G.add_edges_from(zip(edges["from_int"].tolist(),
+                         edges["to_int"].tolist(),
+                         ({"travel_time": t, "length": l}
+                          for t, l in zip(edges["weight"].tolist(), length.tolist()))))
 
     # retain only the largest connected component if retain_all is False
     if not retain_all:
@@ -121,6 +232,40 @@ def create_nx_graph(nodes, edges, retain_all=False, bidirectional=False):
     return G
 
 
+def to_csr(nodes, edges, impedence="weight"):
+    """
+    Export a graph to a SciPy sparse adjacency matrix, for scipy.sparse.csgraph
+    algorithms or custom code working on compact arrays.
+
+    Parallel edges are reduced to the one of smallest impedance. Zero impedance
+    edges are kept as explicit zeros, which scipy.sparse.csgraph treats as edges.
+
+    Args:
+        nodes (pandas.DataFrame): DataFrame containing node information.
+        edges (pandas.DataFrame): DataFrame containing edge information.
+        impedence (str, optional): Edge attribute used as weight. Default is "weight".
+
+    Returns:
+        scipy.sparse.csr_matrix, pandas.Index: (n, n) matrix whose entry (i, j) is the
+        impedance of the edge from node ids[i] to node ids[j], and the node ids, so that
+        ids[i] maps a position to an id and ids.get_indexer(node_ids) ids to positions.
+    """
+    ids = pd.Index(nodes.index)
+    rows = ids.get_indexer(edges["from_int"])
+    cols = ids.get_indexer(edges["to_int"])
+    weights = edges[impedence].to_numpy(dtype=np.float64)
+    # Remove edges with uknown nodes or without impedance
+    valid = (rows >= 0) & (cols >= 0) & ~np.isnan(weights)
+    rows, cols, weights = rows[valid], cols[valid], weights[valid]
+    # keep the lightest of parallel edges: sort by weight, then the first of each pair
+    order = np.lexsort((weights, cols, rows))
+    rows, cols, weights = rows[order], cols[order], weights[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    matrix = sparse.csr_matrix((weights[first], (rows[first], cols[first])), shape=(len(ids), len(ids)))
+    return matrix, ids
+
+
 def create_pdn_graph(nodes, edges, impedence="weight"):
     """
 
@@ -131,21 +276,27 @@ def create_pdn_graph(nodes, edges, impedence="weight"):
     Args:
         nodes (pandas.DataFrame): DataFrame containing node information.
         edges (pandas.DataFrame): DataFrame containing edge information.
-        impedance (str, optional): Edge attribute representing impedance for path calculations. Default is "weight".
+        impedance (str or list, optional): Edge attribute representing impedance for path calculations,
+            or a list of them sharing the same graph (queries then pick one with imp_name). Default is "weight".
 
     Returns:
         pdn.Network: pandana graph created from nodes and edges DataFrames.
     """
+    impedences = [impedence] if isinstance(impedence, str) else list(impedence)
 
     # Remove edges with uknown nodes
     edges = edges[edges["to_int"].isin(nodes.index) & edges["from_int"].isin(nodes.index)]
-    network = pdn.Network(nodes["x"],
-                           nodes["y"],
-                           edges["from_int"],
-                           edges["to_int"],
-                           edges[[impedence]],
-                           twoway=False)
-    network.precompute(3000)
+    with instrument.stage("pdn.build", impedence=impedence) as record:
+        network = pdn.Network(nodes["x"],
+                               nodes["y"],
+                               edges["from_int"],
+                               edges["to_int"],
+                               edges[impedences],
+                               twoway=False)
+        record["rows"] = len(edges)
+    with instrument.stage("pdn.precompute", impedence=impedence) as record:
+        network.precompute(3000)
+        record["rows"] = len(nodes)
     return network
 
 
@@ -164,7 +315,7 @@ def get_integrated_graph(area, nodes, edges, processed_path, gtfs_path):
     Returns:
         pandas.DataFrame, pandas.DataFrame: Integrated network nodes and edges DataFrames.
     """
-    print("Building integrated network")
+    instrument.log("Building integrated network")
     nodes["id"]=nodes.index
 
     edges = edges.to_crs("epsg:32633")
@@ -182,16 +333,41 @@ def get_integrated_graph(area, nodes, edges, processed_path, gtfs_path):
     ua_network.osm_nodes = nodes
     ua_network.osm_edges = edges
 
-    loaded_feeds = ua.gtfs.load.gtfsfeed_to_df(gtfs_path,
-                                               validation=True,
-                                               verbose=True,
-                                               bbox=area.bbox,
-                                               remove_stops_outsidebbox=True,
-                                               append_definitions=True)
+    loaded_feeds = _load_transit_feeds(area, gtfs_path)
+
+    with instrument.stage("transit.integrate") as record, instrument.silenced():
+        integrate_network(urbanaccess_network=ua_network,
+                                 headways=True,
+                                 urbanaccess_gtfsfeeds_df=loaded_feeds,
+                                 headway_statistic="mean")
+        record["rows"] = len(ua_network.net_edges)
+    net_nodes = ua_network.net_nodes[["id", "x", "y"]]
+    net_edges = _format_integrated_edges(ua_network.net_edges)
+    # the walk layer does not depend on the GTFS, it is kept for update_integrated_graph
+    walk_nodes = net_nodes[~net_nodes["id"].isin(ua_network.transit_nodes["id"].astype(str))]
+    save_graph(walk_nodes, net_edges[net_edges["net_type"] == "walk"], f"{processed_path}/{WALK_LAYER}")
+    return net_nodes, net_edges
+
+
+def _load_transit_feeds(area, gtfs_path):
+    """
+    Load the GTFS feed inside the area and create the urbanaccess transit network and headways.
+
+    Returns:
+        urbanaccess_gtfs_df: Loaded feeds, the transit nodes and edges are set on ua_network.
+    """
+    with instrument.stage("gtfs.load") as record, instrument.silenced():
+        loaded_feeds = ua.gtfs.load.gtfsfeed_to_df(gtfs_path,
+                                                   validation=True,
+                                                   verbose=True,
+                                                   bbox=area.bbox,
+                                                   remove_stops_outsidebbox=True,
+                                                   append_definitions=True)
+        record["rows"] = len(loaded_feeds.stop_times)
     #Simplify transit feeds
     stops_inside_box = []
     loaded_feeds.stops["geometry"] = gpd.points_from_xy(loaded_feeds.stops.stop_lon, loaded_feeds.stops.stop_lat)
-    print("Removing stops that are outside area")
+    instrument.log("Removing stops that are outside area")
     for id, s in loaded_feeds.stops.iterrows():
         if area.polygon.contains(s.geometry):
             stops_inside_box.append(s.stop_id)
@@ -200,25 +376,107 @@ def get_integrated_graph(area, nodes, edges, processed_path, gtfs_path):
     loaded_feeds.stop_times = loaded_feeds.stop_times[loaded_feeds.
                                 stop_times["stop_id"].isin(stops_inside_box)]
 
-    ua.gtfs.network.create_transit_net(gtfsfeeds_dfs=loaded_feeds,
-                                       day="monday",
-                                       timerange=["07:00:00", "10:00:00"],
-                                       calendar_dates_lookup=None)
-    ua.gtfs.headways.headways(gtfsfeeds_df=loaded_feeds,
-                              headway_timerange=["07:00:00","10:00:00"])
-
-    integrate_network(urbanaccess_network=ua_network,
-                             headways=True,
-                             urbanaccess_gtfsfeeds_df=loaded_feeds,
-                             headway_statistic="mean")
-    ua_network.net_nodes = ua_network.net_nodes[["id", "x", "y"]]
-    ua_network.net_edges = ua_network.net_edges[["weight", "unique_trip_id",
+    with instrument.stage("transit.create") as record, instrument.silenced():
+        ua.gtfs.network.create_transit_net(gtfsfeeds_dfs=loaded_feeds,
+                                           day="monday",
+                                           timerange=["07:00:00", "10:00:00"],
+                                           calendar_dates_lookup=None)
+        record["rows"] = len(ua_network.transit_edges)
+    with instrument.stage("transit.headways") as record, instrument.silenced():
+        ua.gtfs.headways.headways(gtfsfeeds_df=loaded_feeds,
+                                  headway_timerange=["07:00:00","10:00:00"])
+        record["rows"] = len(loaded_feeds.headways)
+    return loaded_feeds
+
+
+def _format_integrated_edges(net_edges):
+    """
+    Keep the routing columns of integrated edges, in seconds, indexed like osmnx edges.
+    """
+    net_edges = net_edges.reindex(columns=["weight", "unique_trip_id",
     "sequence", "unique_route_id", "net_type", "from", "to", "from_int", "to_int", "length",
-    "service", "distance", "mean"]]
-    ua_network.net_edges["weight"] *= 60 #to convert time in seconds
-    ua_network.net_edges["travel_time"] = ua_network.net_edges["weight"]
-    ua_network.net_edges["key"] = 0 #for consistancy with osmnx
-    ua_network.net_edges.set_index(["from", "to", "key"], drop=False, inplace=True)
-    duplicates = ua_network.net_edges.index.duplicated(keep='first')
-    ua_network.net_edges = ua_network.net_edges[~duplicates].set_index(["from", "to", "key"])
-    return ua_network.net_nodes, ua_network.net_edges
+    "service", "distance", "mean"])
+    net_edges["weight"] *= 60 #to convert time in seconds
+    net_edges["travel_time"] = net_edges["weight"]
+    net_edges["key"] = 0 #for consistancy with osmnx
+    net_edges.set_index(["from", "to", "key"], drop=False, inplace=True)
+    duplicates = net_edges.index.duplicated(keep='first')
+    return net_edges[~duplicates].set_index(["from", "to", "key"])
+
+
+def _connector_edges(walk_nodes, transit_nodes, travel_speed_kph=4.8):
+    """
+    Walking edges in both directions between every transit node and its nearest walk node,
+    as urbanaccess builds them but with vectorized geodesic distances.
+
+    Args:
+        walk_nodes (pandas.DataFrame): Walk nodes with 'id', 'x' and 'y', indexed by integer id.
+        transit_nodes (pandas.DataFrame): Transit nodes with 'id', 'x' and 'y', indexed by integer id.
+
+    Returns:
+        pandas.DataFrame: Edges with 'from', 'to', 'from_int', 'to_int', 'weight' (minutes) and 'net_type'.
+    """
+    nearest = _nearest_neighbor(walk_nodes[["x", "y"]], transit_nodes[["x", "y"]]).ravel()
+    osm = walk_nodes.loc[nearest]
+    _, _, distance = Geod(ellps="WGS84").inv(transit_nodes["x"].values, transit_nodes["y"].values,
+                                             osm["x"].values, osm["y"].values)
+    minutes = distance / 1000 / travel_speed_kph * 60
+    to_osm = pd.DataFrame({"from": transit_nodes["id"].values, "to": osm["id"].values,
+                           "from_int": transit_nodes.index.values, "to_int": nearest,
+                           "weight": minutes, "net_type": "transit to osm"})
+    to_transit = pd.DataFrame({"from": osm["id"].values, "to": transit_nodes["id"].values,
+                               "from_int": nearest, "to_int": transit_nodes.index.values,
+                               "weight": minutes, "net_type": "osm to transit"})
+    return pd.concat([to_osm, to_transit], ignore_index=True)
+
+
+def update_integrated_graph(area, processed_path, gtfs_path):
+    """
+    Rebuild the transit layer of an integrated network on a new GTFS feed, keeping its walk layer.
+
+    The walk nodes and edges saved by get_integrated_graph keep their integer ids,
+    only the transit edges, the route level transit nodes, the connectors and
+    their headway weights are computed again, then appended to the walk layer.
+
+    Args:
+        area: Area object representing the specified geographic area.
+        processed_path (str): Path to the processed data directory, holding the walk layer.
+        gtfs_path (str): Path to the GTFS (General Transit Feed Specification) data.
+
+    Returns:
+        pandas.DataFrame, pandas.DataFrame: Integrated network nodes and edges DataFrames.
+
+    Raises:
+        FileNotFoundError: If no integrated network was built in processed_path yet.
+    """
+    walk_nodes, walk_edges = load_graph(f"{processed_path}/{WALK_LAYER}")
+    loaded_feeds = _load_transit_feeds(area, gtfs_path)
+    with instrument.stage("transit.update") as record:
+        transit_edges = ua_network.transit_edges.copy()
+        routes = transit_edges["unique_route_id"].astype(str)
+        transit_edges["node_id_route_from"] = transit_edges["node_id_from"].str.cat(routes, sep="_")
+        transit_edges["node_id_route_to"] = transit_edges["node_id_to"].str.cat(routes, sep="_")
+        with instrument.silenced():
+            transit_nodes = _route_id_to_node(loaded_feeds.stops, transit_edges)
+        # transit ids follow the walk layer, whose ids never change
+        transit_nodes = transit_nodes.reset_index().rename(columns={"node_id_route": "id"})
+        transit_nodes.index = pd.RangeIndex(walk_nodes.index.max() + 1,
+                                            walk_nodes.index.max() + 1 + len(transit_nodes))
+        transit_nodes["id"] = transit_nodes["id"].astype(str)
+        ids = pd.Series(transit_nodes.index.values, index=transit_nodes["id"].values)
+
+        transit_edges = transit_edges.drop(columns=["node_id_from", "node_id_to"]).rename(
+            columns={"node_id_route_from": "from", "node_id_route_to": "to"})
+        transit_edges["from_int"] = ids.reindex(transit_edges["from"].values).values
+        transit_edges["to_int"] = ids.reindex(transit_edges["to"].values).values
+        connectors = _connector_edges(walk_nodes, transit_nodes)
+        with instrument.silenced():
+            connectors = _add_headway_impedance(connectors, loaded_feeds.headways, "mean")
+        new_edges = pd.concat([transit_edges, connectors], ignore_index=True)
+        for column in new_edges.select_dtypes(include=["object"]).columns:
+            new_edges[column] = new_edges[column].astype(str)
+        new_edges = _format_integrated_edges(new_edges)
+        nodes = pd.concat([transit_nodes[["id", "x", "y"]], walk_nodes[["id", "x", "y"]]])
+        edges = pd.concat([new_edges, walk_edges])
+        record["rows"] = len(new_edges)
+    return nodes, edges
@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+import contextlib
+from collections import deque
+import pandas as pd
+
+# Stages are recorded in memory (last MAX_RECORDS), appended as JSON lines to
+# the trace file and passed to the hooks. Both can be set from the environment
+# so production builds are instrumented without code changes.
+MAX_RECORDS = 10000
+
+_settings = {"trace_path": os.environ.get("MOBREF_TRACE"),
+             "quiet": os.environ.get("MOBREF_QUIET", "0") not in ("", "0", "false", "False")}
+_hooks = []
+_lock = threading.Lock()
+_local = threading.local()
+records = deque(maxlen=MAX_RECORDS)
+
+
+def configure(trace_path=None, quiet=None):
+    """
+    Set where stage records are written and whether progress messages are printed.
+
+    Args:
+        trace_path (str, optional): JSON lines file every stage record is appended to.
+            Pass "" to stop writing. Defaults to unchanged (MOBREF_TRACE at import).
+        quiet (bool, optional): If True, silence the console output of mobref and
+            urbanaccess. Defaults to unchanged (MOBREF_QUIET at import).
+    """
+    if trace_path is not None:
+        _settings["trace_path"] = trace_path or None
+    if quiet is not None:
+        _settings["quiet"] = quiet
+
+
+def is_quiet():
+    return _settings["quiet"]
+
+
+def add_hook(hook):
+    """
+    Register a callback called with the record (dict) of every finished stage.
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def log(message=""):
+    """
+    Print a progress message unless instrumentation is quiet.
+    """
+    if not _settings["quiet"]:
+        print(message)
+
+
+@contextlib.contextmanager
+def silenced():
+    """
+    Context manager discarding the standard output when instrumentation is quiet,
+    for third party libraries printing progress such as urbanaccess.
+    """
+    if not _settings["quiet"]:
+        yield
+        return
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def _max_rss():
+    """
+    Peak resident set size of the process in megabytes, None where the resource module
+    is not available, such as on Windows.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+def _rss():
+    """
+    Current resident set size in megabytes, None where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """
+    Record the wall time, CPU time, memory and row count of a pipeline stage or query.
+
+    The CPU time of the record, "cpu", is the one of the calling thread, so that the
+    requests of a threaded server do not count each other's work. "process_cpu" is the
+    CPU time of the whole process, which includes the native threads of pandana but
+    also any other thread running meanwhile.
+
+    Stages can be nested, the record then holds the path of its parents, such as
+    "network.create/pdn.precompute". The row count is set by the caller on the
+    yielded record.
+
+    Example:
+        with instrument.stage("network.load", mode="drive") as record:
+            nodes, edges = load_graph(path)
+            record["rows"] = len(edges)
+
+    Args:
+        name (str): Name of the stage.
+        **fields: Extra fields copied into the record, such as the mode.
+
+    Yields:
+        dict: The record, completed when the stage exits.
+    """
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    record = {"stage": name, "path": "/".join(stack + [name]), "rows": None}
+    record.update(fields)
+    stack.append(name)
+    rss_before, peak_before = _rss(), _max_rss()
+    start = datetime.datetime.now().isoformat(timespec="milliseconds")
+    wall, cpu, process_cpu = time.perf_counter(), time.thread_time(), time.process_time()
+    error = None
+    try:
+        yield record
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        stack.pop()
+        rss, peak = _rss(), _max_rss()
+        record.update(start=start,
+                      wall=time.perf_counter() - wall,
+                      cpu=time.thread_time() - cpu,
+                      process_cpu=time.process_time() - process_cpu,
+                      rss_mb=rss,
+                      rss_growth_mb=None if rss is None or rss_before is None else rss - rss_before,
+                      # ru_maxrss is the peak of the whole process, its growth is the part due to this stage
+                      process_peak_rss_mb=peak,
+                      peak_rss_growth_mb=None if peak is None else peak - peak_before,
+                      thread=threading.current_thread().name,
+                      error=error)
+        _emit(record)
+
+
+def _emit(record):
+    with _lock:
+        records.append(record)
+        if _settings["trace_path"]:
+            with open(_settings["trace_path"], "a") as file:
+                file.write(json.dumps(record, default=str) + "\n")
+    for hook in list(_hooks):
+        hook(record)
+
+
+def read_trace(path):
+    """
+    Load a trace file.
+
+    Args:
+        path (str): JSON lines file written by the instrumentation.
+
+    Returns:
+        pandas.DataFrame: One row per stage record.
+    """
+    return pd.read_json(path, lines=True)
+
+
+def summary(stage_records=None):
+    """
+    Aggregate stage records by path.
+
+    Args:
+        stage_records (iterable, optional): Records or DataFrame from read_trace.
+            Defaults to the records kept in memory.
+
+    Returns:
+        pandas.DataFrame: Count, total and mean wall time, total thread and process CPU time, total rows,
+        process peak RSS and largest growth of this peak per stage path, slowest first.
+    """
+    if stage_records is None:
+        stage_records = list(records)
+    df = pd.DataFrame(stage_records)
+    if df.empty:
+        return df
+    # traces written by older versions lack the newer fields
+    for column in ("process_cpu", "process_peak_rss_mb", "peak_rss_growth_mb"):
+        if column not in df.columns:
+            df[column] = None
+    return (df.groupby("path")
+              .agg(count=("wall", "size"), wall=("wall", "sum"), mean_wall=("wall", "mean"),
+                   cpu=("cpu", "sum"), process_cpu=("process_cpu", "sum"), rows=("rows", "sum"),
+                   process_peak_rss_mb=("process_peak_rss_mb", "max"),
+                   peak_rss_growth_mb=("peak_rss_growth_mb", "max"))
+              .sort_values("wall", ascending=False))
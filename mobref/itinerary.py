@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+from mobref import instrument
+
+LEG_TYPES = np.array(["walk", "wait", "ride", "transfer"])
+WALK, WAIT, RIDE, TRANSFER = range(4)
+# leg type of every urbanaccess edge net_type, boarding connectors become waits or transfers
+EDGE_LEG_TYPES = {"walk": WALK, "transit to osm": WALK, "osm to transit": WAIT, "transit": RIDE}
+
+
+class ItineraryDecoder():
+
+    def __init__(self, edges):
+        """
+        Decode node paths of an integrated transit network into walk, wait, ride and transfer legs.
+
+        Edge attributes are looked up once into arrays, so that decoding many paths
+        only takes array indexing and grouping, without any loop over the nodes.
+
+        Args:
+            edges (pandas.DataFrame): Integrated network edges with 'from_int', 'to_int',
+                'net_type', 'unique_route_id', 'weight' and 'distance' (or 'length').
+        """
+        # pandana takes the cheapest of parallel edges
+        edges = edges.sort_values("weight", kind="stable")
+        edges = edges[~edges.duplicated(["from_int", "to_int"])]
+        self.pairs = pd.MultiIndex.from_arrays([edges["from_int"].values, edges["to_int"].values])
+        self.leg_types = edges["net_type"].astype(str).map(EDGE_LEG_TYPES).fillna(WALK).values.astype(np.int8)
+        routes = pd.Categorical(edges["unique_route_id"] if "unique_route_id" in edges.columns
+                                else np.full(len(edges), np.nan))
+        self.route_codes = routes.codes
+        # code -1, edges without route, picks the trailing None
+        self.route_names = np.append(np.asarray(routes.categories, dtype=object), None)
+        self.times = edges["weight"].values.astype(np.float64)
+        distance = edges["distance"] if "distance" in edges.columns else edges["length"]
+        self.distances = np.nan_to_num(distance.values.astype(np.float64))
+        headways = edges["mean"].values.astype(np.float64) if "mean" in edges.columns else np.full(len(edges), np.nan)
+        # boarding connectors hold half the route headway, in minutes, on top of the walk time
+        self.waits = np.where(self.leg_types == WAIT, np.nan_to_num(headways) * 60 / 2, 0)
+
+    def decode(self, paths):
+        """
+        Legs of many node paths.
+
+        Args:
+            paths (list): Node id paths, such as the output of Network.get_shortest_paths.
+
+        Returns:
+            pandas.DataFrame: One row per leg, in path order, with 'path' (position in paths),
+            'leg', 'type', 'route' (unique_route_id of rides, and of the ride that follows a
+            wait or transfer), 'from_node', 'to_node', 'travel_time', 'wait' (seconds of
+            headway included in the travel time) and 'distance'.
+
+        Raises:
+            KeyError: If two consecutive nodes of a path are not linked by an edge.
+        """
+        with instrument.stage("itinerary.decode") as record:
+            lengths = np.fromiter((len(p) for p in paths), dtype=np.int64, count=len(paths))
+            flat = np.concatenate([np.asarray(p, dtype=np.int64) for p in paths]) if len(paths) else \
+                np.empty(0, dtype=np.int64)
+            node_path = np.repeat(np.arange(len(paths)), lengths)
+            step = node_path[:-1] == node_path[1:]
+            edge_path = node_path[:-1][step]
+            from_nodes, to_nodes = flat[:-1][step], flat[1:][step]
+            edge = self.pairs.get_indexer(pd.MultiIndex.from_arrays([from_nodes, to_nodes]))
+            if (edge < 0).any():
+                raise KeyError(f"No edge between nodes {from_nodes[edge < 0][:10]}")
+
+            types = self.leg_types[edge]
+            routes = self.route_codes[edge]
+            new_path = np.r_[True, edge_path[1:] != edge_path[:-1]]
+            # boarding after a ride of the same path is a transfer
+            rides_before = np.cumsum(types == RIDE) - (types == RIDE)
+            path_start = np.maximum.accumulate(np.where(new_path, np.arange(len(edge)), 0))
+            types = np.where((types == WAIT) & (rides_before > rides_before[path_start]), TRANSFER, types)
+            starts = new_path | (types != np.r_[-1, types[:-1]]) \
+                | ((types == RIDE) & (routes != np.r_[-1, routes[:-1]]))
+            starts[(types == WAIT) | (types == TRANSFER)] = True
+
+            first = np.flatnonzero(starts)
+            last = np.r_[first[1:], len(edge)] - 1
+            leg_types = types[first]
+            leg_routes = routes[first]
+            # waits and transfers take the route of the ride they board
+            leg_path = edge_path[first]
+            boarding = np.flatnonzero(np.isin(leg_types, (WAIT, TRANSFER)))
+            boarding = boarding[boarding + 1 < len(first)]
+            boarding = boarding[leg_path[boarding + 1] == leg_path[boarding]]
+            leg_routes[boarding] = leg_routes[boarding + 1]
+            leg_routes[leg_types == WALK] = -1
+            legs = pd.DataFrame({
+                "path": leg_path,
+                "leg": np.arange(len(first)) - np.searchsorted(leg_path, leg_path),
+                "type": LEG_TYPES[leg_types],
+                "route": self.route_names[leg_routes],
+                "from_node": from_nodes[first],
+                "to_node": to_nodes[last],
+                "travel_time": np.add.reduceat(self.times[edge], first) if len(first) else [],
+                "wait": np.add.reduceat(self.waits[edge], first) if len(first) else [],
+                "distance": np.add.reduceat(self.distances[edge], first) if len(first) else []})
+            record["rows"] = len(legs)
+        return legs
@@ -0,0 +1,356 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# value returned by pandana for unreachable destinations
+UNREACHABLE = 4294967.295
+
+
+class SparseMatrix():
+
+    def __init__(self, csr, ids):
+        """
+        Matrix between POIs storing only the reachable pairs, in CSR form.
+
+        A pair is reachable when it is stored, even with a value of 0 (a POI to
+        itself), so lookups rely on the sparsity structure and return NaN for
+        pairs that are not stored. A CSC copy is built on the first column lookup.
+
+        Args:
+            csr (scipy.sparse.csr_matrix): Square matrix with sorted indices.
+            ids (array-like): POI ids of the rows and columns.
+        """
+        self.csr = csr
+        self.csr.has_sorted_indices = False
+        self.csr.sort_indices()
+        self.ids = pd.Index(ids)
+        self._csc = None
+
+    @classmethod
+    def from_pairs(cls, rows, cols, values, ids):
+        """
+        Build a SparseMatrix from the positions and values of the reachable pairs.
+
+        Args:
+            rows (numpy.ndarray): Row positions.
+            cols (numpy.ndarray): Column positions.
+            values (numpy.ndarray): Values of the pairs.
+            ids (array-like): POI ids of the rows and columns.
+
+        Returns:
+            SparseMatrix: Sparse matrix.
+        """
+        n = len(ids)
+        csr = sparse.csr_matrix((values, (rows, cols)), shape=(n, n))
+        return cls(csr, ids)
+
+    @property
+    def csc(self):
+        if self._csc is None:
+            self._csc = self.csr.tocsc()
+            self._csc.sort_indices()
+        return self._csc
+
+    @property
+    def nnz(self):
+        return self.csr.nnz
+
+    def save(self, path):
+        """
+        Save the matrix to an .npz file.
+
+        Args:
+            path (str): Path to the file.
+        """
+        np.savez(path, data=self.csr.data, indices=self.csr.indices, indptr=self.csr.indptr,
+                 shape=np.array(self.csr.shape), ids=self.ids.values)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a matrix saved with save.
+
+        Args:
+            path (str): Path to the file.
+
+        Returns:
+            SparseMatrix: Loaded matrix.
+        """
+        with np.load(path, allow_pickle=True) as f:
+            csr = sparse.csr_matrix((f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"]))
+            return cls(csr, f["ids"])
+
+    def get(self, origin, destination):
+        """
+        Value between two POIs.
+
+        Args:
+            origin: Origin POI id.
+            destination: Destination POI id.
+
+        Returns:
+            float: Value of the pair, NaN if not reachable.
+        """
+        i, j = self.ids.get_loc(origin), self.ids.get_loc(destination)
+        start, end = self.csr.indptr[i], self.csr.indptr[i + 1]
+        k = start + np.searchsorted(self.csr.indices[start:end], j)
+        if k < end and self.csr.indices[k] == j:
+            return float(self.csr.data[k])
+        return np.nan
+
+    def row(self, origin):
+        """
+        Reachable destinations from a POI.
+
+        Args:
+            origin: Origin POI id.
+
+        Returns:
+            pandas.Series: Values indexed by destination POI id.
+        """
+        i = self.ids.get_loc(origin)
+        start, end = self.csr.indptr[i], self.csr.indptr[i + 1]
+        return pd.Series(self.csr.data[start:end], index=self.ids[self.csr.indices[start:end]])
+
+    def column(self, destination):
+        """
+        Origins reaching a POI.
+
+        Args:
+            destination: Destination POI id.
+
+        Returns:
+            pandas.Series: Values indexed by origin POI id.
+        """
+        j = self.ids.get_loc(destination)
+        start, end = self.csc.indptr[j], self.csc.indptr[j + 1]
+        return pd.Series(self.csc.data[start:end], index=self.ids[self.csc.indices[start:end]])
+
+    def to_dense(self):
+        """
+        Returns:
+            pandas.DataFrame: Dense matrix, NaN for unreachable pairs.
+        """
+        dense = np.full(self.csr.shape, np.nan)
+        coo = self.csr.tocoo()
+        dense[coo.row, coo.col] = coo.data
+        return pd.DataFrame(dense, index=self.ids, columns=self.ids)
+
+
+def _expand(groups, order, starts, counts):
+    """
+    For each element of groups, enumerate the members of the group.
+
+    Args:
+        groups (numpy.ndarray): Group index of each element.
+        order (numpy.ndarray): Members sorted by group.
+        starts (numpy.ndarray): Position in order of the first member of each group.
+        counts (numpy.ndarray): Number of members of each group.
+
+    Returns:
+        numpy.ndarray, numpy.ndarray: Element index and member of every (element, member) pair.
+    """
+    sizes = counts[groups]
+    element = np.repeat(np.arange(len(groups)), sizes)
+    offsets = np.arange(len(element)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    return element, order[starts[groups][element] + offsets]
+
+
+def get_sparse_matrices(network, pois, maxtime, impedence="weight"):
+    """
+    Computes sparse matrices of travel times and distances between POIs reachable within a maximum time.
+
+    A bounded search is run from each network node holding a POI, so the cost
+    and the memory depend on the number of reachable pairs instead of the
+    square of the number of POIs. Distances are only computed for the
+    reachable pairs.
+
+    Args:
+        network: Network object representing the transportation network.
+        pois (DataFrame): DataFrame containing POI locations with columns 'lon' and 'lat'.
+        maxtime (float): Maximum travel time in seconds.
+        impedence (str, optional): Travel time impedance, such as an hourly profile. Default is "weight".
+
+    Returns:
+        dict: A dictionary containing the following keys:
+        - "time" (SparseMatrix): Travel times between POIs reachable within maxtime.
+        - "distance" (SparseMatrix): Distances between the same pairs.
+    """
+    pois_nodes = network.pdn.get_node_ids(pois.lon, pois.lat).values
+    nodes, group, counts = np.unique(pois_nodes, return_inverse=True, return_counts=True)
+    order = np.argsort(group, kind="stable")
+    starts = np.cumsum(counts) - counts
+
+    in_range = network.get_pdn(impedence).nodes_in_range(nodes, maxtime, imp_name=impedence)
+    in_range = in_range[in_range["destination"].isin(nodes)]
+    src = np.searchsorted(nodes, in_range["source"].values)
+    dst = np.searchsorted(nodes, in_range["destination"].values)
+    times = in_range[impedence].values
+    distances = np.asarray(network.get_pdn("length").shortest_path_lengths(
+        nodes[src], nodes[dst], imp_name="length"))
+
+    # a node pair stands for every pair of POIs snapped on these nodes
+    pair, rows = _expand(src, order, starts, counts)
+    element, cols = _expand(dst[pair], order, starts, counts)
+    pair, rows = pair[element], rows[element]
+    return {"time": SparseMatrix.from_pairs(rows, cols, times[pair], pois.index),
+            "distance": SparseMatrix.from_pairs(rows, cols, distances[pair], pois.index)}
+
+
+class MatrixStore():
+
+    def __init__(self, path, mode="r"):
+        """
+        Compact on-disk store of travel time and distance matrices with memory-mapped lookups.
+
+        A store is a directory holding index.json (shape, dtypes and markers),
+        origins.npy and destinations.npy (the ids), and time.npy and
+        distance.npy. Times are quantized to whole seconds (uint16 or uint32),
+        distances to whole meters (uint32), and unreachable pairs hold the
+        maximum value of the dtype. The matrices are opened as memory maps, so
+        looking up cells, rows or blocks only reads the pages involved.
+
+        Args:
+            path (str): Directory of the store, created with MatrixStore.create.
+            mode (str, optional): Memory map mode, "r" or "r+". Default is "r".
+        """
+        self.path = path
+        with open(f"{path}/index.json") as file:
+            self.index = json.load(file)
+        self.origins = pd.Index(np.load(f"{path}/origins.npy"))
+        self.destinations = pd.Index(np.load(f"{path}/destinations.npy"))
+        self.matrices = {name: np.load(f"{path}/{name}.npy", mmap_mode=mode)
+                         for name in self.index["dtypes"]}
+
+    @classmethod
+    def create(cls, path, origins, destinations, time_dtype="uint16", distance=True):
+        """
+        Create an empty store, to be filled with write_rows.
+
+        Args:
+            path (str): Directory of the store.
+            origins (array-like): Origin ids.
+            destinations (array-like): Destination ids.
+            time_dtype (str, optional): "uint16" (up to 18h12) or "uint32". Default is "uint16".
+            distance (bool, optional): If False, only times are stored. Default is True.
+
+        Returns:
+            MatrixStore: Writable store.
+        """
+        if time_dtype not in ("uint16", "uint32"):
+            raise ValueError(f"Unsupported time dtype {time_dtype}")
+        os.makedirs(path, exist_ok=True)
+        dtypes = {"time": time_dtype}
+        if distance:
+            dtypes["distance"] = "uint32"
+        shape = (len(origins), len(destinations))
+        for name, dtype in dtypes.items():
+            matrix = np.lib.format.open_memmap(f"{path}/{name}.npy", mode="w+", dtype=dtype, shape=shape)
+            matrix[:] = np.iinfo(dtype).max
+            matrix.flush()
+            del matrix
+        for name, ids in (("origins", origins), ("destinations", destinations)):
+            ids = np.asarray(ids)
+            if ids.dtype == object:
+                ids = ids.astype(str)
+            np.save(f"{path}/{name}.npy", ids)
+        with open(f"{path}/index.json", "w") as file:
+            json.dump({"shape": shape, "dtypes": dtypes,
+                       "units": {"time": "s", "distance": "m"},
+                       "unreachable": {name: int(np.iinfo(dtype).max) for name, dtype in dtypes.items()}},
+                      file)
+        return cls(path, mode="r+")
+
+    @classmethod
+    def from_matrices(cls, path, matrices, time_dtype="uint16"):
+        """
+        Create a store from the output of Network.get_matrices.
+
+        Args:
+            path (str): Directory of the store.
+            matrices (dict): "time" and "distance" DataFrames, distance may be None.
+            time_dtype (str, optional): "uint16" or "uint32". Default is "uint16".
+
+        Returns:
+            MatrixStore: Store opened read-only.
+        """
+        time = matrices["time"]
+        distance = matrices.get("distance")
+        store = cls.create(path, time.index, time.columns, time_dtype, distance is not None)
+        store.write_rows(0, time.values, None if distance is None else distance.values)
+        store.flush()
+        return cls(path)
+
+    def _quantize(self, name, values):
+        values = np.asarray(values, dtype=float)
+        marker = np.iinfo(self.index["dtypes"][name]).max
+        # pandana lengths may come as float32, which rounds UNREACHABLE up to 4294967.5
+        unreachable = ~np.isfinite(values) | (values >= UNREACHABLE - 0.5)
+        values = np.rint(np.where(unreachable, 0, values))
+        if (values >= marker).any():
+            raise ValueError(f"{name} values exceed the {self.index['dtypes'][name]} range")
+        return np.where(unreachable, marker, values).astype(self.index["dtypes"][name])
+
+    def write_rows(self, start, time, distance=None):
+        """
+        Write a block of full rows.
+
+        Args:
+            start (int): Position of the first row.
+            time (numpy.ndarray): Travel times in seconds, unreachable pairs as NaN, inf or UNREACHABLE.
+            distance (numpy.ndarray, optional): Distances in meters. Default is None.
+        """
+        for name, values in (("time", time), ("distance", distance)):
+            if values is not None:
+                self.matrices[name][start:start + len(values)] = self._quantize(name, values)
+
+    def flush(self):
+        for matrix in self.matrices.values():
+            matrix.flush()
+
+    def _decode(self, name, values):
+        marker = np.iinfo(self.index["dtypes"][name]).max
+        return np.where(values == marker, np.nan, values.astype(float))
+
+    def get(self, origin, destination):
+        """
+        Travel time and distance between two ids.
+
+        Returns:
+            dict: "time" and "distance" of the pair, NaN if unreachable.
+        """
+        i, j = self.origins.get_loc(origin), self.destinations.get_loc(destination)
+        return {name: float(self._decode(name, matrix[i, j])) for name, matrix in self.matrices.items()}
+
+    def row(self, origin):
+        """
+        Travel times and distances from one origin to every destination.
+
+        Returns:
+            pandas.DataFrame: One column per stored matrix, indexed by destination id.
+        """
+        i = self.origins.get_loc(origin)
+        return pd.DataFrame({name: self._decode(name, matrix[i]) for name, matrix in self.matrices.items()},
+                            index=self.destinations)
+
+    def block(self, origins, destinations):
+        """
+        Sub-matrices between some origins and destinations.
+
+        Returns:
+            dict: "time" and "distance" DataFrames, NaN where unreachable.
+        """
+        rows = self.origins.get_indexer(origins)
+        cols = self.destinations.get_indexer(destinations)
+        if (rows < 0).any() or (cols < 0).any():
+            raise KeyError("Unknown origin or destination ids")
+        order = np.argsort(rows)
+        block = {}
+        for name, matrix in self.matrices.items():
+            # sorted rows read the memory map sequentially
+            values = np.empty((len(rows), len(cols)))
+            values[order] = self._decode(name, matrix[rows[order]][:, cols])
+            block[name] = pd.DataFrame(values, index=origins, columns=destinations)
+        return block
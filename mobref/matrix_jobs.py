@@ -0,0 +1,283 @@
+import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+from contextlib import suppress
+from mobref.matrices import UNREACHABLE, MatrixStore
+from mobref import instrument
+
+MEASURES = {"time": "weight", "distance": "length"}
+
+
+def _coordinates(points):
+    """
+    Longitudes and latitudes of a DataFrame with 'lon' and 'lat' columns or of a GeoDataFrame of points.
+    """
+    if "lon" in points.columns:
+        return points.lon.values, points.lat.values
+    return points.geometry.x.values, points.geometry.y.values
+
+
+def _fingerprint(points):
+    """
+    Hash of the ids and coordinates of points, to tell whether a restarted job uses the same ones.
+    """
+    lon, lat = _coordinates(points)
+    frame = pd.DataFrame({"id": points.index.astype(str), "lon": lon, "lat": lat})
+    return hashlib.sha1(pd.util.hash_pandas_object(frame, index=False).values.tobytes()).hexdigest()
+
+
+def _max_time(times):
+    """
+    Longest reachable travel time of a matrix, 0 if none is reachable.
+    """
+    times = np.asarray(times, dtype=float)
+    reachable = times[np.isfinite(times) & (times < UNREACHABLE - 0.5)]
+    return float(reachable.max()) if len(reachable) else 0.0
+
+
+class GridMatrixJob():
+
+    def __init__(self, network, job_path, origins=None, destinations=None, shard_size=500,
+                 lock_timeout=3600):
+        """
+        Resumable computation of the travel time and distance matrices between grid points.
+
+        Origins are split into shards of shard_size rows. Every finished shard is
+        written to {job_path}/shard-{i:06d}.npz, so an interrupted job restarts
+        where it stopped. Shards are claimed with lock files created atomically,
+        so several processes or machines sharing job_path can run the same job
+        at once. The owner of a lock touches it while computing its shard, so a
+        lock untouched for lock_timeout seconds is considered abandoned.
+
+        Args:
+            network: Network object representing the transportation network.
+            job_path (str): Directory holding the job manifest, shards and merged matrices.
+            origins (DataFrame, optional): Origin points. Defaults to the area grid.
+            destinations (DataFrame, optional): Destination points. Defaults to the origins.
+            shard_size (int, optional): Number of origins per shard. Default is 500.
+            lock_timeout (int, optional): Age in seconds after which a lock is stolen. Default is 3600.
+        """
+        if origins is None:
+            origins = network.area.grid
+        if destinations is None:
+            destinations = origins
+        self.network = network
+        self.job_path = job_path
+        self.origins = origins
+        self.destinations = destinations
+        self.shard_size = shard_size
+        self.lock_timeout = lock_timeout
+        os.makedirs(job_path, exist_ok=True)
+        self._check_manifest()
+
+    def _check_manifest(self):
+        """
+        Write the job manifest, or check that a restarted job has the same parameters.
+        """
+        manifest = {"mode": self.network.mode,
+                    "measures": MEASURES,
+                    "n_origins": len(self.origins),
+                    "n_destinations": len(self.destinations),
+                    "origins": _fingerprint(self.origins),
+                    "destinations": _fingerprint(self.destinations),
+                    "shard_size": self.shard_size}
+        path = f"{self.job_path}/manifest.json"
+        if os.path.exists(path):
+            with open(path) as file:
+                existing = json.load(file)
+            if existing != manifest:
+                raise ValueError(f"Job in {self.job_path} was started with other parameters: {existing}")
+        else:
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as file:
+                json.dump(manifest, file)
+            os.replace(tmp, path)
+
+    @property
+    def n_shards(self):
+        return int(np.ceil(len(self.origins) / self.shard_size))
+
+    def shard_path(self, i):
+        return f"{self.job_path}/shard-{i:06d}.npz"
+
+    def pending_shards(self):
+        """
+        Returns:
+            list: Indices of the shards not computed yet.
+        """
+        return [i for i in range(self.n_shards) if not os.path.exists(self.shard_path(i))]
+
+    def _lock_path(self, i):
+        return f"{self.shard_path(i)}.lock"
+
+    def _claim(self, i):
+        """
+        Try to take the lock of a shard, stealing it if it was abandoned.
+
+        Returns:
+            str: Token written in the lock if this process now owns the shard, else None.
+        """
+        lock = self._lock_path(i)
+        token = f"{socket.gethostname()} {os.getpid()} {uuid.uuid4().hex}"
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                with open(lock) as file:
+                    owner = file.read()
+                stale = time.time() - os.path.getmtime(lock) > self.lock_timeout
+            except FileNotFoundError:
+                return None
+            if not stale or not self._remove_lock(lock, owner):
+                return None
+            # the abandoned lock is gone, compete again for a fresh one
+            try:
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return None
+        with os.fdopen(fd, "w") as file:
+            file.write(token)
+        return token
+
+    def _remove_lock(self, lock, token):
+        """
+        Remove a lock only if it still holds token.
+
+        The lock is first renamed to a unique name, which only one worker can do,
+        then checked: a lock taken by another worker in between is put back.
+
+        Returns:
+            bool: True if the lock held token and was removed.
+        """
+        moved = f"{lock}.{uuid.uuid4().hex}.removed"
+        try:
+            os.rename(lock, moved)
+        except FileNotFoundError:
+            return False
+        with open(moved) as file:
+            owned = file.read() == token
+        if not owned:
+            with suppress(FileExistsError):
+                os.link(moved, lock)
+        with suppress(FileNotFoundError):
+            os.remove(moved)
+        return owned
+
+    def _heartbeat(self, lock, token, stop):
+        """
+        Touch a lock until stop is set, so that a long shard is not seen as abandoned.
+        """
+        while not stop.wait(self.lock_timeout / 4):
+            with suppress(FileNotFoundError):
+                with open(lock) as file:
+                    if file.read() != token:
+                        return
+                os.utime(lock)
+
+    def compute_shard(self, i):
+        """
+        Compute and write one shard.
+
+        Args:
+            i (int): Shard index.
+        """
+        start, end = i * self.shard_size, min((i + 1) * self.shard_size, len(self.origins))
+        lon, lat = _coordinates(self.origins.iloc[start:end])
+        orig_nodes = self.network.pdn.get_node_ids(lon, lat).values
+        lon, lat = _coordinates(self.destinations)
+        dest_nodes = self.network.pdn.get_node_ids(lon, lat).values
+        matrices = {name: self.network.get_nodes_matrix(orig_nodes, dest_nodes, impedence=impedence)
+                    for name, impedence in MEASURES.items()}
+        tmp = f"{self.shard_path(i)}.{socket.gethostname()}.{os.getpid()}.tmp.npz"
+        np.savez(tmp, max_time=_max_time(matrices["time"]), **matrices)
+        os.replace(tmp, self.shard_path(i))
+
+    def run(self, max_shards=None):
+        """
+        Compute the pending shards that no other worker is computing.
+
+        Args:
+            max_shards (int, optional): Stop after this number of shards. Defaults to all.
+
+        Returns:
+            int: Number of shards computed by this call.
+        """
+        done = 0
+        for i in self.pending_shards():
+            if max_shards is not None and done >= max_shards:
+                break
+            token = self._claim(i)
+            if token is None:
+                continue
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=self._heartbeat, args=(self._lock_path(i), token, stop), daemon=True)
+            heartbeat.start()
+            try:
+                if not os.path.exists(self.shard_path(i)):
+                    instrument.log(f"Computing shard {i+1}/{self.n_shards}")
+                    with instrument.stage("grid.shard", mode=self.network.mode, shard=i) as record:
+                        self.compute_shard(i)
+                        record["rows"] = min(self.shard_size, len(self.origins) - i * self.shard_size) \
+                            * len(self.destinations)
+                    done += 1
+            finally:
+                stop.set()
+                heartbeat.join()
+                self._remove_lock(self._lock_path(i), token)
+        return done
+
+    def is_complete(self):
+        return not self.pending_shards()
+
+    def max_time(self):
+        """
+        Returns:
+            float: Longest reachable travel time of the computed shards, in seconds.
+        """
+        times = [0.0]
+        for i in range(self.n_shards):
+            if os.path.exists(self.shard_path(i)):
+                with np.load(self.shard_path(i)) as shard:
+                    # shards written before max_time was recorded hold the times only
+                    times.append(float(shard["max_time"]) if "max_time" in shard.files
+                                 else _max_time(shard["time"]))
+        return max(times)
+
+    def merge(self, time_dtype=None):
+        """
+        Merge the shards into a MatrixStore in {job_path}/store.
+
+        Shards are written one after the other into the memory-mapped store, so
+        the full matrices never need to fit in memory.
+
+        Args:
+            time_dtype (str, optional): "uint16" or "uint32", see MatrixStore. Defaults
+                to uint16 when every time fits in it, uint32 otherwise.
+
+        Returns:
+            MatrixStore: The merged store, opened read-only.
+
+        Raises:
+            ValueError: If shards are pending, or if times exceed the range of time_dtype.
+        """
+        if not self.is_complete():
+            raise ValueError(f"{len(self.pending_shards())} shards are still pending")
+        max_time = self.max_time()
+        fits_uint16 = np.rint(max_time) < np.iinfo(np.uint16).max
+        if time_dtype is None:
+            time_dtype = "uint16" if fits_uint16 else "uint32"
+        elif time_dtype == "uint16" and not fits_uint16:
+            raise ValueError(f"Travel times up to {max_time:.0f} s exceed the uint16 range, use uint32")
+        path = f"{self.job_path}/store"
+        store = MatrixStore.create(path, self.origins.index, self.destinations.index, time_dtype)
+        for i in range(self.n_shards):
+            with np.load(self.shard_path(i)) as shard:
+                store.write_rows(i * self.shard_size, shard["time"], shard["distance"])
+        store.flush()
+        return MatrixStore(path)
@@ -0,0 +1,134 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from mobref import instrument
+from mobref.csr_routing import _dijkstra
+from mobref.matrices import UNREACHABLE
+
+# adjacency matrices of the worker processes keyed by (mode, impedance), sent once by _init_worker
+_worker_matrices = None
+
+
+def _init_worker(matrices):
+    global _worker_matrices
+    _worker_matrices = matrices
+
+
+def _dijkstra_worker(key, sources, dests):
+    return _dijkstra(_worker_matrices[key], sources, dests, np.inf, np.float64)
+
+
+def _snap(networks, pois, modes):
+    """
+    Network node of every POI and the distinct ones, once per mode.
+    """
+    snapped = {}
+    for mode in modes:
+        pois_nodes = networks[mode].pdn.get_node_ids(pois.lon, pois.lat).values
+        snapped[mode] = (pois_nodes,) + tuple(np.unique(pois_nodes, return_inverse=True))
+    return snapped
+
+
+def get_multimodal_matrices(networks, pois, modes=None, backend="csr", hour=None, batch_size=256, workers=None):
+    """
+    Computes the travel time and distance matrices between POIs for several modes at once.
+
+    POIs are snapped once per mode. With the "csr" backend, the Dijkstra batches of
+    every mode and impedance share one pool of worker processes, so all modes are
+    computed concurrently. With the "pandana" backend, modes run one after the other,
+    each query being parallelized by pandana itself.
+
+    Transit edges have no length, pandana counts them as zero while the csr backend
+    drops them, so transit distances are walking distances with the csr backend only.
+
+    Args:
+        networks (dict): Network objects keyed by mode, such as the output of config.load_networks.
+        pois (pandas.DataFrame): DataFrame containing POI locations with columns 'lon' and 'lat'.
+        modes (list, optional): Modes to compute. Defaults to every network.
+        backend (str, optional): "csr" or "pandana", see Network.get_nodes_matrix. Default is "csr".
+        hour (int, optional): Departure hour of the drive speed profiles. Defaults to None, the free flow travel times.
+        batch_size (int, optional): Number of origins per Dijkstra batch of the csr backend. Default is 256.
+        workers (int, optional): Number of worker processes of the csr backend, 1 runs in this process.
+            Defaults to the number of CPUs.
+
+    Returns:
+        dict: A dictionary containing the following keys:
+        - "modes" (list): Modes, in the order of the first axis of the matrices.
+        - "index" (pandas.Index): POI index, in the order of the other axes.
+        - "time" (numpy.ndarray): (modes, POIs, POIs) travel times, unreachable pairs are set to UNREACHABLE.
+        - "distance" (numpy.ndarray): (modes, POIs, POIs) distances, unreachable pairs are set to UNREACHABLE.
+    """
+    modes = list(networks) if modes is None else list(modes)
+    if backend not in ("csr", "pandana"):
+        raise ValueError(f"Unknown routing backend {backend}")
+    n = len(pois)
+    res = {"modes": modes, "index": pois.index,
+           "time": np.empty((len(modes), n, n)), "distance": np.empty((len(modes), n, n))}
+    with instrument.stage("query.multimodal_matrices", modes=len(modes), backend=backend) as record:
+        snapped = _snap(networks, pois, modes)
+        tasks = []
+        for i, mode in enumerate(modes):
+            network = networks[mode]
+            time_impedence = network.impedence_at(hour) if mode == "drive" else "weight"
+            tasks += [(i, mode, "time", time_impedence), (i, mode, "distance", "length")]
+
+        if backend == "pandana":
+            for i, mode, key, impedence in tasks:
+                pois_nodes, unique, inverse = snapped[mode]
+                matrix = networks[mode].get_nodes_matrix(unique, pois_nodes, impedence=impedence)
+                res[key][i] = matrix[inverse]
+        else:
+            workers = workers or os.cpu_count()
+            routers = {(mode, impedence): networks[mode].get_router(impedence) for _, mode, _, impedence in tasks}
+            # every graph is sent once to each worker, not with every batch
+            matrices = {key: router.matrix for key, router in routers.items()}
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                           initargs=(matrices,)) if workers > 1 else None
+            try:
+                futures = []
+                for i, mode, key, impedence in tasks:
+                    pois_nodes, unique, inverse = snapped[mode]
+                    router = routers[(mode, impedence)]
+                    sources = router.positions(unique)
+                    dests = router.positions(pois_nodes)
+                    for start in range(0, len(sources), batch_size):
+                        batch = sources[start:start + batch_size]
+                        if executor is not None:
+                            future = executor.submit(_dijkstra_worker, (mode, impedence), batch, dests)
+                        else:
+                            future = _dijkstra(router.matrix, batch, dests, np.inf, np.float64)
+                        futures.append((i, mode, key, start, future))
+                trees = {}
+                for i, mode, key, start, future in futures:
+                    dist = future.result() if executor is not None else future
+                    trees.setdefault((i, key), []).append(dist)
+            finally:
+                if executor is not None:
+                    executor.shutdown()
+            for i, mode, key, impedence in tasks:
+                _, _, inverse = snapped[mode]
+                dist = np.concatenate(trees[(i, key)])
+                dist[np.isinf(dist)] = UNREACHABLE
+                res[key][i] = dist[inverse]
+        record["rows"] = res["time"].size
+    return res
+
+
+def to_long(matrices):
+    """
+    Long format of get_multimodal_matrices, one row per mode, origin and destination.
+
+    Returns:
+        pandas.DataFrame: Columns 'mode', 'origin', 'destination', 'time' and 'distance',
+        unreachable pairs set to NaN.
+    """
+    modes, index = matrices["modes"], matrices["index"]
+    n = len(index)
+    time = matrices["time"].ravel()
+    distance = matrices["distance"].ravel()
+    return pd.DataFrame({"mode": pd.Categorical(np.repeat(modes, n * n), categories=modes),
+                         "origin": np.tile(np.repeat(index.values, n), len(modes)),
+                         "destination": np.tile(index.values, n * len(modes)),
+                         "time": np.where(time >= UNREACHABLE, np.nan, time),
+                         "distance": np.where(distance >= UNREACHABLE, np.nan, distance)})
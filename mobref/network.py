@@ -2,15 +2,22 @@ import osmnx as ox
 import pandas as pd
 import numpy as np
 import os
-from mobref.graph_utils import create_pdn_graph, get_integrated_graph, load_graph, save_graph
+from mobref.graph_utils import create_pdn_graph, get_integrated_graph, load_graph, save_graph, graph_to_pbf, to_csr
+from mobref.graph_utils import update_integrated_graph, WALK_LAYER
 import matplotlib
 from matplotlib import pyplot as plt
-import math
-import urbanaccess as ua
+from mobref import render, instrument
+from mobref.matrices import UNREACHABLE, get_sparse_matrices
+from mobref.pbf import graph_from_pbf
+from mobref.csr_routing import CSRRouter
+from mobref.elevation import add_edge_topography
+from mobref.profiles import HOURS, profile_column
+from mobref.geometry import GeometryStore, split_graph, write_routes
+from mobref.itinerary import ItineraryDecoder
 
 class Network():
 
-    def __init__(self, area, mode, processed_path, gtfs_path=None):
+    def __init__(self, area, mode, processed_path, gtfs_path=None, pbf_path=None, dem_path=None):
         """
         Initialize a transportation network for a specified area and mode.
 
@@ -19,6 +26,10 @@ class Network():
             mode (str): Mode of transportation (transit, drive, bike, or walk).
             processed_path (str): Path to the processed data directory.
             gtfs_path (str, optional): Path to the GTFS (General Transit Feed Specification) data. Required only for transit mode.
+            pbf_path (str, optional): Path to a local OSM PBF extract covering the area. If set, the street
+            network is built from it instead of being downloaded from Overpass.
+            dem_path (str, optional): Path to a local DEM (GeoTIFF) covering the area. If set, bike and walk
+            travel times depend on the grade of the edges.
         """
         if mode == "transit" and gtfs_path == None:
             raise Exception("No gtfs provided when mode is set to transit")
@@ -26,55 +37,213 @@ class Network():
         self.area = area
         self.mode = mode
         self.gtfs_path = gtfs_path
-        self.create_network()
+        self.pbf_path = pbf_path
+        self.dem_path = dem_path
+        self.geometry = GeometryStore(f"{processed_path}/{mode}_geometry.pkl")
+        with instrument.stage("network.create", mode=mode) as record:
+            self.create_network()
+            record["rows"] = len(self.edges)
 
 
     def create_network(self):
         """
         Create and integrate a transportation network based on the specified mode (transit, drive, bike, or walk).
 
+        Only the compact routing core of the network (see mobref.geometry) is kept in
+        the nodes and edges attributes, geometries and tags are saved to self.geometry.
+
         Returns:
         None: Integrated network nodes and edges are stored in the corresponding attributes.
         """
         path = f"{self.processed_path}/{self.mode}.pkl"
+        nodes = edges = None
         if os.path.exists(path):
-            print(f"Loading {self.mode} network...")
-            nodes, edges = load_graph(path)
-        else:
+            instrument.log(f"Loading {self.mode} network...")
+            with instrument.stage("network.load", mode=self.mode) as record:
+                nodes, edges = load_graph(path)
+                record["rows"] = len(edges)
+            if "geometry" in edges.columns:
+                # network saved with its geometries, before the routing core was split from them
+                nodes, edges = self.save_network(nodes, edges, path)
+            elif not self.geometry.exists():
+                # a routing core alone cannot give the geometries back
+                instrument.log(f"No geometries next to the {self.mode} network, building it again...")
+                nodes = edges = None
+        if edges is None:
             #cf = '["highway"~"motorway|trunk|primary|secondary"]'
-            if self.mode == "transit":
+            if self.mode == "transit" and os.path.exists(f"{self.processed_path}/{WALK_LAYER}"):
+                instrument.log("Rebuilding transit layer")
+                nodes, edges = update_integrated_graph(self.area, self.processed_path, self.gtfs_path)
+            elif self.mode == "transit":
                 graph_w_path = f"{self.processed_path}/walk.pkl"
                 if os.path.exists(graph_w_path):
-                    nodes, edges = load_graph(graph_w_path)
+                    with instrument.stage("network.load", mode="walk") as record:
+                        nodes, edges = load_graph(graph_w_path)
+                        walk_geometry = GeometryStore(f"{self.processed_path}/walk_geometry.pkl")
+                        if "geometry" not in edges.columns and walk_geometry.exists():
+                            nodes, edges = walk_geometry.join(nodes, edges)
+                        record["rows"] = len(edges)
                 else:
-                    print("Downloading walk network...")
-                    graph = ox.graph_from_polygon(self.area.polygon, network_type="walk")
-                    nodes, edges = ox.graph_to_gdfs(graph)
+                    with instrument.stage("network.download", mode="walk") as record:
+                        graph = self.graph_from_polygon("walk")
+                        nodes, edges = ox.graph_to_gdfs(graph)
+                        record["rows"] = len(edges)
                 nodes, edges = get_integrated_graph(self.area, nodes, edges, self.processed_path, self.gtfs_path)
             else:
-                print(f"Downloading {self.mode} network...")
-                graph = ox.graph_from_polygon(self.area.polygon, network_type=self.mode)
-                if self.mode=="drive":
-                    graph = ox.add_edge_speeds(graph)
-                    graph = ox.add_edge_travel_times(graph)
-                    nodes, edges = ox.graph_to_gdfs(graph)
-                elif self.mode=="bike":
-                    nodes, edges = ox.graph_to_gdfs(graph)
-                    edges = edges.to_crs("epsg:32633") #because bike network is projected
-                    travel_time = edges["length"] / (20/3.6) #TODO adapt bike speed to topography
-                    edges["travel_time"] = travel_time.values
-                elif self.mode=="walk":
-                    nodes, edges = ox.graph_to_gdfs(graph)
-                    travel_time =  edges["length"] / (4.8/3.6)
-                    edges["travel_time"] = travel_time.values
-                edges["weight"] = edges.travel_time
-                edges["from_int"]=edges.index.get_level_values(0)
-                edges["to_int"]=edges.index.get_level_values(1)
-            save_graph(nodes, edges, path)
+                with instrument.stage("network.download", mode=self.mode) as record:
+                    graph = self.graph_from_polygon(self.mode)
+                    record["rows"] = graph.number_of_edges()
+                with instrument.stage("network.impedance", mode=self.mode) as record:
+                    if self.mode=="drive":
+                        graph = ox.add_edge_speeds(graph)
+                        graph = ox.add_edge_travel_times(graph)
+                        nodes, edges = ox.graph_to_gdfs(graph)
+                    elif self.mode=="bike":
+                        nodes, edges = ox.graph_to_gdfs(graph)
+                        edges = edges.to_crs("epsg:32633") #because bike network is projected
+                        travel_time = edges["length"] / (20/3.6)
+                        edges["travel_time"] = travel_time.values
+                    elif self.mode=="walk":
+                        nodes, edges = ox.graph_to_gdfs(graph)
+                        travel_time =  edges["length"] / (4.8/3.6)
+                        edges["travel_time"] = travel_time.values
+                    edges["weight"] = edges.travel_time
+                    edges["from_int"]=edges.index.get_level_values(0)
+                    edges["to_int"]=edges.index.get_level_values(1)
+                    record["rows"] = len(edges)
+                if self.dem_path is not None and self.mode in ("bike", "walk"):
+                    with instrument.stage("network.topography", mode=self.mode) as record:
+                        cache_path = f"{self.processed_path}/elevation_{self.mode}.npz"
+                        edges = add_edge_topography(edges, self.dem_path, self.mode, cache_path)
+                        record["rows"] = len(edges)
+            nodes, edges = self.save_network(nodes, edges, path)
+        self.set_graph(nodes, edges)
+
+    def set_graph(self, nodes, edges):
+        """
+        Use new routing core nodes and edges, building the pandana graph and resetting the caches built on the previous ones.
+        """
         self.pdn = create_pdn_graph(nodes, edges)
+        self.pdns = {"weight": self.pdn}
+        self.routers = {}
+        self.decoder = None
         self.nodes = nodes
         self.edges= edges
-        print() #cleaner stdout
+        instrument.log() #cleaner stdout
+
+    def update_transit(self, gtfs_path=None):
+        """
+        Rebuild the transit layer on an updated GTFS feed, keeping the walk layer of the integrated
+        network, see graph_utils.update_integrated_graph. The pandana graph is built again.
+
+        Args:
+        gtfs_path (str, optional): Path to the new GTFS data. Defaults to the current one.
+        """
+        if self.mode != "transit":
+            raise ValueError(f"Only the transit network has a GTFS feed, not {self.mode}")
+        self.gtfs_path = gtfs_path or self.gtfs_path
+        with instrument.stage("network.update_transit", mode=self.mode) as record:
+            nodes, edges = update_integrated_graph(self.area, self.processed_path, self.gtfs_path)
+            nodes, edges = self.save_network(nodes, edges, f"{self.processed_path}/{self.mode}.pkl")
+            self.set_graph(nodes, edges)
+            record["rows"] = len(edges)
+
+    def save_network(self, nodes, edges, path):
+        """
+        Save the routing core of a network to path and its geometries and tags to self.geometry.
+
+        Args:
+        nodes (DataFrame): Full network nodes.
+        edges (DataFrame): Full network edges.
+        path (str): Path of the routing core.
+
+        Returns:
+        DataFrame, DataFrame: Routing core nodes and edges.
+        """
+        with instrument.stage("network.save", mode=self.mode) as record:
+            (nodes, edges), (store_nodes, store_edges) = split_graph(nodes, edges)
+            self.geometry.save(store_nodes, store_edges)
+            save_graph(nodes, edges, path)
+            record["rows"] = len(edges)
+        return nodes, edges
+
+    def graph_from_polygon(self, network_type):
+        """
+        Get the osmnx street network of the area, from the local PBF extract if one
+        was given, otherwise from Overpass.
+
+        Args:
+        network_type (str): osmnx network type (drive, bike, or walk).
+
+        Returns:
+        networkx.MultiDiGraph: Street network of the area.
+        """
+        if self.pbf_path is not None:
+            instrument.log(f"Reading {network_type} network from {self.pbf_path}...")
+            return graph_from_pbf(self.pbf_path, self.area.polygon, network_type=network_type)
+        instrument.log(f"Downloading {network_type} network...")
+        return ox.graph_from_polygon(self.area.polygon, network_type=network_type)
+
+    def to_pbf(self, path):
+        """
+        Export the street network to a PBF file, to feed R5 or other routing engines.
+
+        Args:
+        path (str): Path to the output PBF file, which must not exist.
+        """
+        graph_to_pbf(*self.geometry.join(self.nodes, self.edges), path)
+
+    def to_csr(self, impedence="weight"):
+        """
+        Export the network to a SciPy sparse adjacency matrix, see graph_utils.to_csr.
+
+        Args:
+        impedence (str, optional): Edge attribute used as weight. Defaults to "weight".
+
+        Returns:
+        scipy.sparse.csr_matrix, pandas.Index: Adjacency matrix and the node id of every row.
+        """
+        return to_csr(self.nodes, self.edges, impedence)
+
+    def set_speed_profiles(self, profiles):
+        """
+        Add hourly travel times to the drive network, see mobref.profiles.
+
+        All the hours share one pandana graph, built and contracted once, and are
+        then queried through the hour parameter of shortest_path, get_matrices, and
+        get_hourly_matrices, while "weight" keeps the free flow travel times.
+
+        Args:
+        profiles (DataFrame): Travel times in seconds indexed like the edges, with one
+        profile_column per hour, such as the output of profiles_from_factors.
+        """
+        if self.mode != "drive":
+            raise ValueError(f"Speed profiles only apply to the drive network, not {self.mode}")
+        columns = list(profiles.columns)
+        for column in columns:
+            self.edges[column] = profiles[column].reindex(self.edges.index).fillna(self.edges["weight"]) \
+                .values.astype(np.float32)
+        pdn = create_pdn_graph(self.nodes, self.edges, impedence=columns)
+        for column in columns:
+            self.pdns[column] = pdn
+        self.routers = {c: r for c, r in self.routers.items() if c not in columns}
+
+    def impedence_at(self, hour=None):
+        """
+        Name of the travel time impedance of a departure hour.
+
+        Args:
+        hour (int, optional): Departure hour, between 0 and 23. Defaults to None, the free flow travel times.
+
+        Returns:
+        str: "weight", or the profile column of the hour.
+        """
+        if hour is None:
+            return "weight"
+        column = profile_column(hour)
+        if column not in self.edges.columns:
+            raise ValueError(f"No speed profile for hour {hour}, see set_speed_profiles")
+        return column
 
     def convert_path_to_osmid(self, path):
         """
@@ -86,44 +255,118 @@ class Network():
         Returns:
         list: List of corresponding OSM IDs.
         """
-        path_osmid = []
-        for n in path:
-            path_osmid.append(self.nodes.loc[n].id)
-        return path_osmid
+        return self.nodes["id"].reindex(np.asarray(path)).tolist()
+
+    def get_itineraries(self, paths):
+        """
+        Decodes transit node paths into walk, wait, ride and transfer legs, see mobref.itinerary.
+
+        Args:
+        paths (list): pandana node id paths, such as the output of get_shortest_paths.
+
+        Returns:
+        DataFrame: One row per leg with 'path', 'leg', 'type', 'route', 'from_node', 'to_node',
+        'travel_time', 'wait' and 'distance'.
+        """
+        if self.mode != "transit":
+            raise ValueError(f"Itineraries only apply to the transit network, not {self.mode}")
+        if self.decoder is None:
+            self.decoder = ItineraryDecoder(self.edges)
+        return self.decoder.decode(paths)
 
 
-    def shortest_path(self, r1, r2):
+    def shortest_path(self, r1, r2, hour=None):
         """
         Finds the shortest path between two locations and returns route details.
 
         Args:
         r1 (dict): Dictionary with keys 'lon' and 'lat' representing the coordinates of the starting point.
         r2 (dict): Dictionary with keys 'lon' and 'lat' representing the coordinates of the destination.
+        hour (int, optional): Departure hour, see set_speed_profiles. Defaults to None, the free flow travel times.
 
         Returns:
         dict: A dictionary containing the following keys:
         - "shortest_path" (list): List of node IDs representing the shortest path.
         - "travel_time" (float): Total travel time along the shortest path.
         - "distance" (float): Total distance of the shortest path.
+        - "legs" (list): For transit, the legs of the path as dictionaries, see get_itineraries.
         """
-        req = pd.DataFrame([r1, r2], columns=["lon", "lat"])
-        nodes_ids = self.pdn.get_node_ids(req.lon, req.lat).values
-        shortest_path = self.pdn.shortest_path(nodes_ids[0], nodes_ids[1])
-        if self.mode == "transit":
-            shortest_path = self.convert_path_to_osmid(shortest_path)
-        route_details = self.get_route_details(list(shortest_path))
+        with instrument.stage("query.shortest_path", mode=self.mode) as record:
+            req = pd.DataFrame([r1, r2], columns=["lon", "lat"])
+            nodes_ids = self.pdn.get_node_ids(req.lon, req.lat).values
+            impedence = self.impedence_at(hour)
+            shortest_path = self.get_pdn(impedence).shortest_path(nodes_ids[0], nodes_ids[1], imp_name=impedence)
+            if self.mode == "transit":
+                legs = self.get_itineraries([shortest_path]).drop(columns="path").to_dict("records")
+                shortest_path = self.convert_path_to_osmid(shortest_path)
+            route_details = self.get_route_details(list(shortest_path), hour)
+            record["rows"] = len(shortest_path)
         res = { "shortest_path": shortest_path,
                 "travel_time"  : route_details["travel_time"],
                 "distance"     : route_details["distance"]}
+        if self.mode == "transit":
+            res["legs"] = legs
         return res
 
 
-    def get_route_details(self, route):
+    def get_shortest_paths(self, origins, destinations, hour=None):
+        """
+        Finds the shortest paths between pairs of locations, in one vectorized pandana query.
+
+        Args:
+        origins (DataFrame): DataFrame containing origin locations with columns 'lon' and 'lat'.
+        destinations (DataFrame): DataFrame containing destination locations, one per origin.
+        hour (int, optional): Departure hour, see set_speed_profiles. Defaults to None, the free flow travel times.
+
+        Returns:
+        list: Node id paths, one numpy array per pair.
+        """
+        with instrument.stage("query.shortest_paths", mode=self.mode) as record:
+            o = self.pdn.get_node_ids(origins.lon, origins.lat).values
+            d = self.pdn.get_node_ids(destinations.lon, destinations.lat).values
+            impedence = self.impedence_at(hour)
+            paths = self.get_pdn(impedence).shortest_paths(o, d, imp_name=impedence)
+            record["rows"] = len(paths)
+        return paths
+
+    def get_route_geometries(self, paths, polyline=False):
+        """
+        Geometries of many node paths, gathered from the pre-indexed edge geometries (see mobref.geometry).
+
+        Args:
+        paths (list): Node id paths, such as the output of get_shortest_paths.
+        polyline (bool, optional): If True, return Google encoded polylines instead of LineStrings. Defaults to False.
+
+        Returns:
+        numpy.ndarray or list: LineStrings in lon/lat (None for paths without edge), or encoded polylines.
+        """
+        with instrument.stage("query.route_geometries", mode=self.mode) as record:
+            record["rows"] = len(paths)
+            if polyline:
+                return self.geometry.route_polylines(self.nodes, self.edges, paths)
+            return self.geometry.route_geometries(self.nodes, self.edges, paths)
+
+    def write_routes(self, path, paths, properties=None, polyline=False):
+        """
+        Writes the geometries of many node paths to a GeoParquet file (.parquet) or a GeoJSON text sequence.
+
+        Args:
+        path (str): Output path.
+        paths (list): Node id paths, such as the output of get_shortest_paths.
+        properties (DataFrame, optional): Route attributes, one row per path. Defaults to None.
+        polyline (bool, optional): If True, also write the encoded polyline of every route. Defaults to False.
+        """
+        geometries = self.get_route_geometries(paths)
+        polylines = self.get_route_geometries(paths, polyline=True) if polyline else None
+        write_routes(path, geometries, properties, polylines)
+
+    def get_route_details(self, route, hour=None):
         """
         Calculates travel time and distance for the given route.
 
         Args:
         route (list): List of node IDs representing the route.
+        hour (int, optional): Departure hour, see set_speed_profiles. Defaults to None, the free flow travel times.
 
         Returns:
         dict: A dictionary containing the following keys:
@@ -132,41 +375,156 @@ class Network():
         """
         travel_time = 0
         distance = 0
+        column = "travel_time" if hour is None else self.impedence_at(hour)
         if route==[]:
             return None, None
         for i in range(len(route)-1):
             data = self.edges.loc[route[i], route[i+1], 0]
-            travel_time += data["travel_time"]
+            travel_time += data[column]
             if not np.isnan(data["length"]): #tt travels have nan distances
                 distance += data["length"]
         return {"travel_time":travel_time, "distance":distance}
 
 
-    def get_matrices(self, pois):
+    def get_pdn(self, impedence="weight"):
+        """
+        Returns the pandana graph for an impedance, building it on first use.
+
+        Args:
+        impedence (str, optional): Edge attribute used as impedance. Defaults to "weight".
+
+        Returns:
+        pdn.Network: pandana graph using the given impedance.
+        """
+        if impedence not in self.pdns:
+            self.pdns[impedence] = create_pdn_graph(self.nodes, self.edges, impedence=impedence)
+        return self.pdns[impedence]
+
+
+    def get_router(self, impedence="weight"):
+        """
+        Returns the CSR one-to-all routing backend for an impedance, building it on first use.
+
+        Args:
+        impedence (str, optional): Edge attribute used as impedance. Defaults to "weight".
+
+        Returns:
+        CSRRouter: Router using the given impedance.
+        """
+        if impedence not in self.routers:
+            self.routers[impedence] = CSRRouter(self.nodes, self.edges, impedence=impedence)
+        return self.routers[impedence]
+
+
+    def get_nodes_matrix(self, orig_nodes, dest_nodes, impedence="weight", backend="pandana"):
+        """
+        Computes the matrix of shortest path lengths between two sets of network nodes.
+
+        Args:
+        orig_nodes (array-like): pandana node IDs of the origins.
+        dest_nodes (array-like): pandana node IDs of the destinations.
+        impedence (str, optional): Edge attribute used as impedance. Defaults to "weight".
+        backend (str, optional): "pandana" for contraction hierarchy queries, or "csr" for one
+        Dijkstra tree per origin (see get_router), faster when there are many destinations. Defaults to "pandana".
+
+        Returns:
+        numpy.ndarray: (len(orig_nodes), len(dest_nodes)) matrix, unreachable pairs are set to UNREACHABLE.
+        """
+        if backend == "csr":
+            return self.get_router(impedence).nodes_matrix(orig_nodes, dest_nodes)
+        if backend != "pandana":
+            raise ValueError(f"Unknown routing backend {backend}")
+        orig_nodes = np.asarray(orig_nodes)
+        dest_nodes = np.asarray(dest_nodes)
+        origs = np.repeat(orig_nodes, len(dest_nodes))
+        dests = np.tile(dest_nodes, len(orig_nodes))
+        # this vectorized version of the shortest path computation is way more efficient than calling multiple times shortest_path_length
+        lengths = self.get_pdn(impedence).shortest_path_lengths(origs, dests, imp_name=impedence)
+        return np.asarray(lengths).reshape((len(orig_nodes), len(dest_nodes)))
+
+
+    def get_matrices(self, pois, maxtime=None, backend="pandana", hour=None):
         """
         Computes matrices of travel times and distances between given Points of Interest (POIs).
 
         Args:
         pois (DataFrame): DataFrame containing POI locations with columns 'lon' and 'lat'.
+        maxtime (float, optional): If set, only the pairs reachable within maxtime seconds
+        are computed and returned as SparseMatrix objects (see mobref.matrices). Defaults to None.
+        backend (str, optional): Routing backend of the dense matrices, "pandana" or "csr",
+        see get_nodes_matrix. Defaults to "pandana".
+        hour (int, optional): Departure hour, see set_speed_profiles. Defaults to None, the free flow travel times.
 
         Returns:
         dict: A dictionary containing the following keys:
         - "time" (DataFrame): Matrix of travel times between POIs.
         - "distance" (DataFrame): Matrix of distances between POIs.
         """
-        pois_nodes = self.pdn.get_node_ids(pois.lon, pois.lat)
-        origs = [o for o in pois_nodes.values for d in pois_nodes.values]
-        dests = [d for o in pois_nodes.values for d in pois_nodes.values]
-        # this vectorized version of the shortest path computation is way more efficient than calling multiple times shortest_path_length
-        times = self.pdn.shortest_path_lengths(origs, dests)
-        n = int(math.sqrt(len(times)))
-        a = np.array(times).reshape((n, n))
-        m_t = pd.DataFrame(a, index=pois.index, columns=pois.index)
-        pdn = create_pdn_graph(self.nodes, self.edges, impedence="length")
-        distances = pdn.shortest_path_lengths(origs, dests)
-        a = np.array(distances).reshape((n, n))
-        m_d = pd.DataFrame(a, index=pois.index, columns=pois.index)
-        return {"time": m_t, "distance": m_d}
+        with instrument.stage("query.matrices", mode=self.mode, sparse=maxtime is not None,
+                              backend=backend, hour=hour) as record:
+            record["rows"] = len(pois)**2
+            impedence = self.impedence_at(hour)
+            if maxtime is not None:
+                return get_sparse_matrices(self, pois, maxtime, impedence)
+            pois_nodes = self.pdn.get_node_ids(pois.lon, pois.lat).values
+            a = self.get_nodes_matrix(pois_nodes, pois_nodes, impedence=impedence, backend=backend)
+            m_t = pd.DataFrame(a, index=pois.index, columns=pois.index)
+            a = self.get_nodes_matrix(pois_nodes, pois_nodes, impedence="length", backend=backend)
+            m_d = pd.DataFrame(a, index=pois.index, columns=pois.index)
+            return {"time": m_t, "distance": m_d}
+
+    def get_hourly_matrices(self, pois, hours=HOURS):
+        """
+        Computes the travel time matrices between POIs for several departure hours.
+
+        POIs are snapped once and every hour is queried on the same contracted
+        graph, see set_speed_profiles.
+
+        Args:
+        pois (DataFrame): DataFrame containing POI locations with columns 'lon' and 'lat'.
+        hours (iterable, optional): Departure hours. Defaults to every hour of the day.
+
+        Returns:
+        dict: A dictionary containing the following keys:
+        - "hours" (list): Departure hours.
+        - "time" (numpy.ndarray): (hours, POIs, POIs) travel times, unreachable pairs are set to UNREACHABLE.
+        - "distance" (DataFrame): Matrix of distances between POIs, the same for every hour.
+        """
+        hours = list(hours)
+        impedences = [self.impedence_at(hour) for hour in hours]
+        n = len(pois)
+        with instrument.stage("query.hourly_matrices", mode=self.mode, hours=len(hours)) as record:
+            pois_nodes = self.pdn.get_node_ids(pois.lon, pois.lat).values
+            origs = np.repeat(pois_nodes, n)
+            dests = np.tile(pois_nodes, n)
+            times = np.empty((len(hours), n, n))
+            for i, impedence in enumerate(impedences):
+                lengths = self.get_pdn(impedence).shortest_path_lengths(origs, dests, imp_name=impedence)
+                times[i] = np.asarray(lengths).reshape((n, n))
+            distances = self.get_pdn("length").shortest_path_lengths(origs, dests, imp_name="length")
+            m_d = pd.DataFrame(np.asarray(distances).reshape((n, n)), index=pois.index, columns=pois.index)
+            record["rows"] = times.size
+        return {"hours": hours, "time": times, "distance": m_d}
+
+    def get_travel_time_trees(self, pois, impedence="weight", maxtime=None, workers=None):
+        """
+        Computes the shortest path lengths from each POI to every network node with the CSR backend.
+
+        Args:
+        pois (DataFrame): DataFrame containing POI locations with columns 'lon' and 'lat', such as the area grid.
+        impedence (str, optional): Edge attribute used as impedance. Defaults to "weight".
+        maxtime (float, optional): Nodes further than maxtime are not explored and left at NaN. Defaults to None.
+        workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+
+        Returns:
+        DataFrame: float32 lengths indexed by POI, with one column per network node, NaN when unreachable.
+        """
+        pois_nodes = self.pdn.get_node_ids(pois.lon, pois.lat).values
+        router = self.get_router(impedence)
+        limit = np.inf if maxtime is None else maxtime
+        trees = router.one_to_all(pois_nodes, limit=limit, workers=workers)
+        trees[np.isinf(trees)] = np.nan
+        return pd.DataFrame(trees, index=pois.index, columns=router.ids)
 
     def find_closest(self, pois, maxtime=600, maxitems=None):
         """
@@ -181,18 +539,39 @@ class Network():
         dict: A dictionary containing closest POIs to each location. Keys are node IDs, and values are lists of
         dictionaries containing 'poi_id', 'lon', 'lat', and 'travel_time' for each nearby POI.
         """
-        self.pdn.set_pois(category = 'pois',
-                          maxdist = maxtime,
-                          maxitems = maxitems,
-                          x_col = pois.lon,
-                          y_col = pois.lat)
-        results = self.pdn.nearest_pois(distance = maxtime,
-                                       category = 'pois',
-                                       num_pois = maxitems,
-                                       include_poi_ids = True)
+        with instrument.stage("query.find_closest", mode=self.mode) as record:
+            self.pdn.set_pois(category = 'pois',
+                              maxdist = maxtime,
+                              maxitems = maxitems,
+                              x_col = pois.lon,
+                              y_col = pois.lat)
+            results = self.pdn.nearest_pois(distance = maxtime,
+                                           category = 'pois',
+                                           num_pois = maxitems,
+                                           include_poi_ids = True)
+            record["rows"] = len(results)
         return results
 
 
+    def get_accessibility(self, pois, time=300):
+        """
+        Counts the Points of Interest (POIs) within the given time limit from each node.
+
+        Args:
+        pois (DataFrame): DataFrame containing POI locations with columns 'lon' and 'lat'.
+        time (int, optional): Maximum travel time in seconds. Defaults to 300.
+
+        Returns:
+        Series: Number of POIs reachable from each node, indexed like the pandana nodes.
+        """
+        with instrument.stage("query.accessibility", mode=self.mode) as record:
+            pois_nodes = self.pdn.get_node_ids(pois.lon, pois.lat)
+            self.pdn.set(pois_nodes, name = 'pois')
+            accessibility = self.pdn.aggregate(time, type = 'count', name = 'pois')
+            record["rows"] = len(accessibility)
+        return accessibility
+
+
     def plot_accessibility(self, pois, time=300):
         """
         Plots accessibility of Points of Interest (POIs) within the given time limit from each location.
@@ -202,9 +581,7 @@ class Network():
         time (int, optional): Maximum travel time in seconds. Defaults to 300.
         """
         #how many pois are within time seconds of each node?
-        pois_nodes = self.pdn.get_node_ids(pois.lon, pois.lat)
-        self.pdn.set(pois_nodes, name = 'pois')
-        accessibility = self.pdn.aggregate(time, type = 'count', name = 'pois')
+        accessibility = self.get_accessibility(pois, time)
         fig, ax = plt.subplots(figsize=(10,8))
         plt.title(f'Restaurants within {time/60}min by {self.mode}')
         plt.scatter(self.pdn.nodes_df.x, self.pdn.nodes_df.y,
@@ -214,14 +591,91 @@ class Network():
         plt.show()
 
 
-    def plot_net_by_travel_time(self):
+    def plot_net_by_travel_time(self, bbox=None, width=3000):
         """
         Plots the network graph with edge colors based on travel time.
+
+        Edges are drawn as a single LineCollection, decimated to the plot resolution.
+
+        Args:
+        bbox (tuple, optional): Bounding box (min_lon, min_lat, max_lon, max_lat) to plot. Defaults to the area bbox.
+        width (int, optional): Plot resolution in pixels used for decimation. Defaults to 3000.
+        """
+        bounds = render.bbox_to_bounds(bbox or self.area.bbox)
+        segments, values = render.edge_segments(self.nodes, self.edges, "weight")
+        norm = render.make_norm(values)
+        segments, values = render.decimate_segments(segments, values, bounds,
+                                                    (bounds[2]-bounds[0])/width)
+        height = 30 * (bounds[3]-bounds[1]) / (bounds[2]-bounds[0])
+        fig, ax = plt.subplots(figsize=(30, height))
+        render.plot_segments(ax, segments, values, cmap='Blues', norm=norm)
+        ax.set_xlim(bounds[0], bounds[2])
+        ax.set_ylim(bounds[1], bounds[3])
+        ax.set_aspect("equal")
+        ax.set_axis_off()
+        plt.show()
+
+
+    def render_net_by_travel_time(self, path, bbox=None, width=2048, raster=False):
+        """
+        Renders the network with edge colors based on travel time into a PNG file, without display.
+
+        Args:
+        path (str): Path of the PNG file to write.
+        bbox (tuple, optional): Bounding box (min_lon, min_lat, max_lon, max_lat) to render. Defaults to the area bbox.
+        width (int, optional): Image width in pixels. Defaults to 2048.
+        raster (bool, optional): If True, aggregate edges into a raster instead of drawing lines. Defaults to False.
+        """
+        bounds = render.bbox_to_bounds(bbox or self.area.bbox)
+        height = int(width * (bounds[3]-bounds[1]) / (bounds[2]-bounds[0]))
+        segments, values = render.edge_segments(self.nodes, self.edges, "weight")
+        render.render_png(path, bounds, width, height, segments=segments,
+                          segment_values=values, raster=raster, cmap='Blues',
+                          norm=render.make_norm(values))
+
+
+    def render_accessibility(self, pois, path, time=300, bbox=None, width=2048):
+        """
+        Renders the accessibility of Points of Interest (POIs) as a raster into a PNG file, without display.
+
+        Args:
+        pois (DataFrame): DataFrame containing POI locations with columns 'lon' and 'lat'.
+        path (str): Path of the PNG file to write.
+        time (int, optional): Maximum travel time in seconds. Defaults to 300.
+        bbox (tuple, optional): Bounding box (min_lon, min_lat, max_lon, max_lat) to render. Defaults to the area bbox.
+        width (int, optional): Image width in pixels. Defaults to 2048.
+        """
+        accessibility = self.get_accessibility(pois, time)
+        bounds = render.bbox_to_bounds(bbox or self.area.bbox)
+        height = int(width * (bounds[3]-bounds[1]) / (bounds[2]-bounds[0]))
+        x, y = render.to_mercator(self.pdn.nodes_df.x.values, self.pdn.nodes_df.y.values)
+        render.render_png(path, bounds, width, height, points=(x, y),
+                          point_values=accessibility.values, cmap='YlOrBr',
+                          norm=render.make_norm(accessibility.values, log=True))
+
+
+    def render_tiles(self, out_dir, zooms=range(10, 16), pois=None, time=300, raster=False):
+        """
+        Renders slippy map PNG tiles ({out_dir}/{z}/{x}/{y}.png) over the area, without display.
+
+        Edges are colored by travel time, or nodes by accessibility if pois are given.
+
+        Args:
+        out_dir (str): Directory where the tiles are written.
+        zooms (iterable, optional): Zoom levels to render. Defaults to 10 to 15.
+        pois (DataFrame, optional): DataFrame containing POI locations with columns 'lon' and 'lat'. Defaults to None.
+        time (int, optional): Maximum travel time in seconds for accessibility. Defaults to 300.
+        raster (bool, optional): If True, aggregate edges into a raster instead of drawing lines. Defaults to False.
+
+        Returns:
+        list: Paths of the written tiles.
         """
-        edgecolor = ua.plot.col_colors(df=self.edges, col='weight', cmap='Blues', num_bins=5)
-        ua.plot.plot_net(nodes=self.nodes,
-                         edges=self.edges,
-                         bbox=self.area.bbox,
-                         fig_height=30, margin=0.02,
-                         edge_color=edgecolor, edge_linewidth=1, edge_alpha=0.7,
-                         node_color='black', node_size=0, node_alpha=1, node_edgecolor='none', node_zorder=3, nodes_only=False)
+        if pois is None:
+            segments, values = render.edge_segments(self.nodes, self.edges, "weight")
+            return render.render_tiles(out_dir, self.area.bbox, zooms, segments=segments,
+                                       segment_values=values, raster=raster, cmap='Blues')
+        accessibility = self.get_accessibility(pois, time)
+        x, y = render.to_mercator(self.pdn.nodes_df.x.values, self.pdn.nodes_df.y.values)
+        return render.render_tiles(out_dir, self.area.bbox, zooms, points=(x, y),
+                                   point_values=accessibility.values, cmap='YlOrBr',
+                                   norm=render.make_norm(accessibility.values, log=True))
@@ -0,0 +1,161 @@
+import os
+import re
+import networkx as nx
+import osmium
+import osmnx as ox
+from osmnx import _overpass, projection, simplification, stats, truncate
+from osmnx.graph import _create_graph
+from mobref import instrument
+
+# parses kept in memory, so that every mode built in the same process shares one pass over the file,
+# until clear_cache is called
+_parse_cache = {}
+
+_FILTER_CLAUSE = re.compile(r'\["([^"]+)"(?:(!?~)"([^"]*)")?\]')
+
+
+def parse_osm_filter(osm_filter):
+    """
+    Parse an Overpass filter, as written by osmnx, into clauses evaluated in Python.
+
+    Args:
+        osm_filter (str): Overpass filter such as '["highway"]["area"!~"yes"]'.
+
+    Returns:
+        list: (key, operator, compiled regex) tuples, operator being None for a key
+        that must exist, "~" for a value that must match and "!~" for a value that
+        must not match.
+    """
+    return [(key, op or None, re.compile(pattern) if op else None)
+            for key, op, pattern in _FILTER_CLAUSE.findall(osm_filter)]
+
+
+def match_osm_filter(tags, clauses):
+    """
+    Tell if OSM tags pass the clauses of parse_osm_filter, with Overpass semantics:
+    regexes are searched anywhere in the value, and a missing key passes "!~".
+    """
+    for key, op, regex in clauses:
+        value = tags.get(key)
+        if op is None:
+            if value is None:
+                return False
+        elif op == "~":
+            if value is None or not regex.search(value):
+                return False
+        elif value is not None and regex.search(value):
+            return False
+    return True
+
+
+def read_pbf(pbf_path, bbox=None):
+    """
+    Read the highways of an OSM PBF file in one streaming pass.
+
+    Untagged nodes and objects without a highway tag are dropped by osmium
+    filters before reaching Python, and way node locations are resolved during
+    the same pass. The last parse is kept in memory, so drive, bike and walk
+    networks built in the same process share it, until clear_cache.
+
+    Args:
+        pbf_path (str): Path to the .osm.pbf file.
+        bbox (tuple, optional): (min_lon, min_lat, max_lon, max_lat), ways without
+            any node inside it are dropped. Defaults to the whole file.
+
+    Returns:
+        dict: "nodes" maps node ids to (lon, lat) of every node used by a kept way,
+        "node_tags" maps node ids to the tags of tagged highway nodes and "ways" is
+        a list of (id, node ids, tags).
+    """
+    stat = os.stat(pbf_path)
+    key = (os.path.abspath(pbf_path), stat.st_size, stat.st_mtime_ns, bbox)
+    if key in _parse_cache:
+        return _parse_cache[key]
+    if bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = bbox
+    nodes, node_tags, ways = {}, {}, []
+    with instrument.stage("pbf.read") as record:
+        processor = (osmium.FileProcessor(pbf_path, osmium.osm.NODE | osmium.osm.WAY)
+                     .with_locations()
+                     .with_filter(osmium.filter.EmptyTagFilter())
+                     .with_filter(osmium.filter.KeyFilter("highway")))
+        for obj in processor:
+            if obj.is_node():
+                node_tags[obj.id] = dict(obj.tags)
+                continue
+            refs = [(n.ref, n.lon, n.lat) for n in obj.nodes if n.location.valid()]
+            if len(refs) < 2:
+                continue
+            if bbox is not None and not any(min_lon <= lon <= max_lon and min_lat <= lat <= max_lat
+                                            for _, lon, lat in refs):
+                continue
+            for ref, lon, lat in refs:
+                nodes[ref] = (lon, lat)
+            ways.append((obj.id, [ref for ref, _, _ in refs], dict(obj.tags)))
+        record["rows"] = len(ways)
+    parsed = {"nodes": nodes, "node_tags": node_tags, "ways": ways}
+    _parse_cache.clear()
+    _parse_cache[key] = parsed
+    return parsed
+
+
+def clear_cache():
+    """
+    Free the parse kept by read_pbf, once every network of the file is built.
+    """
+    _parse_cache.clear()
+
+
+def _overpass_json(parsed, network_type):
+    """
+    Overpass-like response holding the ways of a network type and their nodes.
+    """
+    clauses = parse_osm_filter(_overpass._get_osm_filter(network_type))
+    ways, used = [], set()
+    for way_id, refs, tags in parsed["ways"]:
+        if match_osm_filter(tags, clauses):
+            ways.append({"type": "way", "id": way_id, "nodes": refs, "tags": tags})
+            used.update(refs)
+    nodes = [{"type": "node", "id": n, "lon": parsed["nodes"][n][0], "lat": parsed["nodes"][n][1],
+              "tags": parsed["node_tags"].get(n, {})} for n in used]
+    return {"elements": nodes + ways}
+
+
+def graph_from_pbf(pbf_path, polygon, network_type="drive", simplify=True, retain_all=False,
+                   truncate_by_edge=False):
+    """
+    Build an osmnx street network inside a polygon from a local OSM PBF extract.
+
+    Equivalent to ox.graph_from_polygon without any Overpass request: ways are
+    selected with the osmnx filter of the network type, the graph is built on a
+    polygon buffered by 500 m, simplified, then truncated to the polygon.
+
+    Args:
+        pbf_path (str): Path to the .osm.pbf file, it must cover the polygon.
+        polygon (shapely.geometry.Polygon): Area of the network, in lon/lat.
+        network_type (str, optional): osmnx network type (drive, bike, walk...). Default is "drive".
+        simplify (bool, optional): If True, simplify the graph topology. Default is True.
+        retain_all (bool, optional): If True, keep every connected component. Default is False.
+        truncate_by_edge (bool, optional): If True, keep nodes outside the polygon
+            that have a neighbour inside. Default is False.
+
+    Returns:
+        networkx.MultiDiGraph: Street network with osmnx attributes.
+    """
+    poly_proj, crs_utm = projection.project_geometry(polygon)
+    poly_buff, _ = projection.project_geometry(poly_proj.buffer(500), crs=crs_utm, to_latlong=True)
+    parsed = read_pbf(pbf_path, bbox=poly_buff.bounds)
+    with instrument.stage("pbf.graph", mode=network_type) as record:
+        bidirectional = network_type in ox.settings.bidirectional_network_types
+        G_buff = _create_graph([_overpass_json(parsed, network_type)], retain_all=True,
+                               bidirectional=bidirectional)
+        G_buff = truncate.truncate_graph_polygon(G_buff, poly_buff, retain_all=True,
+                                                 truncate_by_edge=truncate_by_edge)
+        if simplify:
+            G_buff = simplification.simplify_graph(G_buff)
+        G = truncate.truncate_graph_polygon(G_buff, polygon, retain_all=retain_all,
+                                            truncate_by_edge=truncate_by_edge)
+        spn = stats.count_streets_per_node(G_buff, nodes=G.nodes)
+        nx.set_node_attributes(G, values=spn, name="street_count")
+        record["rows"] = G.number_of_edges()
+    return G
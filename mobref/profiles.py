@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+HOURS = range(24)
+
+
+def profile_column(hour):
+    """
+    Name of the edge impedance column of a departure hour.
+
+    Args:
+        hour (int): Departure hour, between 0 and 23. Integral floats, such as the
+            8.0 of a JSON request, are accepted.
+
+    Returns:
+        str: Column name, such as "weight_h08".
+    """
+    if hour not in HOURS:
+        raise ValueError(f"Hour {hour} is not between 0 and 23")
+    return f"weight_h{int(hour):02d}"
+
+
+def read_table(path):
+    """
+    Read a speed table or congestion factors from a CSV or Parquet file.
+    """
+    if path.endswith(".parquet") or path.endswith(".pq"):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+def _road_class(highway):
+    # simplified osmnx edges hold lists when the merged ways differ
+    return highway[0] if isinstance(highway, list) else highway
+
+
+def profiles_from_factors(edges, factors):
+    """
+    Hourly travel times from speed factors by road class.
+
+    Args:
+        edges (pandas.DataFrame): Drive edges with 'highway' and 'travel_time' (free flow).
+        factors (pandas.DataFrame): Speed over free flow speed, indexed by road class
+            ('highway' value, or "default" for the other classes), with one column per
+            hour, usually from 0 to 23. A factor of 0.5 doubles the travel time.
+
+    Returns:
+        pandas.DataFrame: Travel times in seconds indexed like edges, one profile_column per hour.
+    """
+    factors = factors.copy()
+    factors.columns = [int(c) for c in factors.columns]
+    if "default" in factors.index:
+        default = factors.loc["default"]
+    else:
+        default = pd.Series(1.0, index=factors.columns)
+    classes = edges["highway"].map(_road_class)
+    edge_factors = factors.reindex(classes.values)
+    edge_factors = edge_factors.fillna(default).values
+    profiles = edges["travel_time"].values[:, None] / edge_factors
+    return pd.DataFrame(profiles, index=edges.index, columns=[profile_column(h) for h in factors.columns])
+
+
+def profiles_from_speed_table(edges, table):
+    """
+    Hourly travel times from a table of observed speeds per edge.
+
+    Args:
+        edges (pandas.DataFrame): Drive edges indexed by (u, v, key), with 'length' and 'travel_time' (free flow).
+        table (pandas.DataFrame): Speeds with columns 'u', 'v', 'hour' and 'speed_kph', and
+            optionally 'key'. Edges or hours missing from the table keep their free flow time.
+
+    Returns:
+        pandas.DataFrame: Travel times in seconds indexed like edges, one profile_column per hour.
+    """
+    if "key" not in table.columns:
+        table = table.assign(key=0)
+    speeds = table.pivot_table(index=["u", "v", "key"], columns="hour", values="speed_kph", aggfunc="mean")
+    speeds = speeds.reindex(index=edges.index, columns=list(HOURS))
+    times = edges["length"].values[:, None] / (speeds.values / 3.6)
+    free_flow = np.repeat(edges["travel_time"].values[:, None], 24, axis=1)
+    times = np.where(np.isfinite(times) & (times > 0), times, free_flow)
+    return pd.DataFrame(times, index=edges.index, columns=[profile_column(h) for h in HOURS])
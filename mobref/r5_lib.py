@@ -1,63 +1,139 @@
+import os
+import hashlib
+import datetime
+import pandas as pd
+import geopandas as gpd
+from concurrent.futures import ThreadPoolExecutor
 from r5py import TransportNetwork, TravelTimeMatrixComputer, TransportMode
-import utils
-
-
-if not os.path.exists(path_osm):
-    ox.save_graph_xml(graph, filepath=path_osm)
-if not os.path.exists(path_pbf):
-    utils.osm_to_pbf(path_osm, path_pbf)
-
-transport_network = TransportNetwork(path_pbf, [gtfs_file])
-
-car_tt_path = f"{processed_path}/car_tt.feather"
-if not os.path.exists(car_tt_path):
-    print("Computing car travel times matrix")
-    travel_time_matrix_computer = TravelTimeMatrixComputer(
-        transport_network,
-        origins=grid,
-        transport_modes=[TransportMode.CAR])
-    car_tt = travel_time_matrix_computer.compute_travel_times()
-    car_tt.reset_index(drop=True).to_feather(car_tt_path)
-else:
-    print("Loading car travel times matrix")
-    car_tt = pd.read_feather(car_tt_path)
-
-pt_tt_path = f"{processed_path}/pt_tt.feather"
-if not os.path.exists(pt_tt_path):
-    print("Computing public transports travel times matrix")
-    travel_time_matrix_computer = TravelTimeMatrixComputer(
-        transport_network,
-        departure=datetime.datetime(2023,7,1,8,30),
-        origins=grid,
-        transport_modes=[TransportMode.TRANSIT])
-    pt_tt = travel_time_matrix_computer.compute_travel_times()
-    pt_tt.reset_index(drop=True).to_feather(pt_tt_path)
-else:
-    print("Loading public transports travel times matrix")
-    pt_tt = pd.read_feather(pt_tt_path)
-
-walk_tt_path = f"{processed_path}/walk_tt.feather"
-if not os.path.exists(walk_tt_path):
-    print("Computing walking travel times matrix")
-    travel_time_matrix_computer = TravelTimeMatrixComputer(
-        transport_network,
-        origins=grid,
-        transport_modes=[TransportMode.WALK])
-    walk_tt = travel_time_matrix_computer.compute_travel_times()
-    walk_tt.reset_index(drop=True).to_feather(walk_tt_path)
-else:
-    print("Loading walk travel times matrix")
-    walk_tt = pd.read_feather(walk_tt_path)
-
-bike_tt_path = f"{processed_path}/bike_tt.feather"
-if not os.path.exists(bike_tt_path):
-    print("Computing bike travel times matrix")
-    travel_time_matrix_computer = TravelTimeMatrixComputer(
-        transport_network,
-        origins=grid,
-        transport_modes=[TransportMode.BICYCLE])
-    bike_tt = travel_time_matrix_computer.compute_travel_times()
-    bike_tt.reset_index(drop=True).to_feather(bike_tt_path)
-else:
-    print("Loading bike travel times matrix")
-    bike_tt = pd.read_feather(bike_tt_path)
+from mobref.network import UNREACHABLE
+from mobref import instrument
+
+R5_MODES = {"drive": [TransportMode.CAR],
+            "transit": [TransportMode.TRANSIT, TransportMode.WALK],
+            "walk": [TransportMode.WALK],
+            "bike": [TransportMode.BICYCLE]}
+
+
+def _file_signature(path):
+    """
+    Identify a file (or every file of a directory) by path, size and modification time.
+    """
+    if os.path.isdir(path):
+        return [_file_signature(f"{path}/{f}") for f in sorted(os.listdir(path))]
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+class R5Network():
+
+    def __init__(self, area, processed_path, pbf_path, gtfs_paths=(),
+                 departure=datetime.datetime(2023, 7, 1, 8, 30)):
+        """
+        Travel time matrices computed with R5 (through r5py) for every mode.
+
+        Args:
+            area: Area object representing the specified geographic area.
+            processed_path (str): Path to the processed data directory, where matrices are cached.
+            pbf_path (str): Path to a local OSM PBF extract covering the area.
+            gtfs_paths (list, optional): Paths to the GTFS zip files, required for transit.
+            departure (datetime.datetime, optional): Departure time of the trips. Defaults to 2023-07-01 08:30.
+        """
+        self.area = area
+        self.processed_path = processed_path
+        self.pbf_path = pbf_path
+        self.gtfs_paths = list(gtfs_paths)
+        self.departure = departure
+        self.transport_network = TransportNetwork(pbf_path, self.gtfs_paths)
+
+    def _cache_path(self, mode, origins):
+        """
+        Feather file caching the travel times of a mode, keyed by every input of the computation.
+        """
+        key = repr([_file_signature(self.pbf_path),
+                    [_file_signature(p) for p in self.gtfs_paths],
+                    self.departure.isoformat(), mode,
+                    origins["id"].tolist(), origins.geometry.x.round(7).tolist(),
+                    origins.geometry.y.round(7).tolist()])
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return f"{self.processed_path}/r5_{mode}_{digest}.feather"
+
+    def compute_travel_times(self, mode, origins):
+        """
+        Compute or load the travel times between all origins for a mode.
+
+        Args:
+            mode (str): Mode of transportation (transit, drive, bike, or walk).
+            origins (geopandas.GeoDataFrame): Points with an 'id' column.
+
+        Returns:
+            pandas.DataFrame: Long format travel times with columns 'from_id', 'to_id'
+            and 'travel_time' (minutes, NaN when unreachable).
+        """
+        path = self._cache_path(mode, origins)
+        if os.path.exists(path):
+            instrument.log(f"Loading {mode} travel times matrix")
+            return pd.read_feather(path)
+        instrument.log(f"Computing {mode} travel times matrix")
+        with instrument.stage("r5.travel_times", mode=mode) as record:
+            travel_time_matrix_computer = TravelTimeMatrixComputer(
+                self.transport_network,
+                departure=self.departure,
+                origins=origins,
+                transport_modes=R5_MODES[mode])
+            travel_times = travel_time_matrix_computer.compute_travel_times()
+            record["rows"] = len(travel_times)
+        travel_times.reset_index(drop=True).to_feather(path)
+        return travel_times
+
+    def _origins(self, pois):
+        if "lon" in pois.columns:
+            geometry = gpd.points_from_xy(pois.lon, pois.lat)
+        else:
+            geometry = pois.geometry
+        return gpd.GeoDataFrame({"id": pois.index}, geometry=geometry, crs=4326)
+
+    def get_matrices(self, pois, mode="drive"):
+        """
+        Computes the matrix of travel times between given Points of Interest (POIs).
+
+        Same output as Network.get_matrices. R5 travel time matrices carry no
+        distances, so "distance" is None.
+
+        Args:
+            pois (DataFrame): DataFrame containing POI locations with columns 'lon' and 'lat',
+                or a GeoDataFrame of points such as Area.grid.
+            mode (str, optional): Mode of transportation (transit, drive, bike, or walk). Defaults to "drive".
+
+        Returns:
+            dict: A dictionary containing the following keys:
+            - "time" (DataFrame): Matrix of travel times between POIs, in seconds.
+            - "distance" (None): Not available with R5.
+        """
+        travel_times = self.compute_travel_times(mode, self._origins(pois))
+        m_t = travel_times.pivot(index="from_id", columns="to_id", values="travel_time")
+        m_t = m_t.reindex(index=pois.index, columns=pois.index) * 60
+        m_t = m_t.fillna(UNREACHABLE)
+        m_t.index.name = m_t.columns.name = None
+        return {"time": m_t, "distance": None}
+
+    def get_all_matrices(self, pois=None, modes=("drive", "transit", "walk", "bike"), workers=None):
+        """
+        Computes the matrices of several modes concurrently.
+
+        The R5 computations run inside the JVM, which releases the GIL, so the
+        modes are submitted to a thread pool sharing the same TransportNetwork.
+
+        Args:
+            pois (DataFrame, optional): POIs as in get_matrices. Defaults to the area grid.
+            modes (iterable, optional): Modes to compute. Defaults to all modes.
+            workers (int, optional): Number of modes computed at once. Defaults to all of them.
+
+        Returns:
+            dict: Results of get_matrices keyed by mode.
+        """
+        if pois is None:
+            pois = self.area.grid
+        modes = list(modes)
+        with ThreadPoolExecutor(max_workers=workers or len(modes)) as executor:
+            futures = {mode: executor.submit(self.get_matrices, pois, mode) for mode in modes}
+            return {mode: future.result() for mode, future in futures.items()}
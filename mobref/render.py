@@ -0,0 +1,451 @@
+import os
+import math
+import numpy as np
+from matplotlib import pyplot as plt
+from matplotlib import colors
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+TILE_SIZE = 256
+EARTH_RADIUS = 6378137.0
+MAX_LATITUDE = 85.0511287798
+
+
+def to_mercator(lon, lat):
+    """
+    Project longitudes and latitudes to Web Mercator (EPSG:3857) coordinates.
+
+    Args:
+        lon (array-like): Longitudes in degrees.
+        lat (array-like): Latitudes in degrees.
+
+    Returns:
+        numpy.ndarray, numpy.ndarray: Projected x and y coordinates in metres.
+    """
+    lon = np.asarray(lon, dtype=float)
+    lat = np.clip(np.asarray(lat, dtype=float), -MAX_LATITUDE, MAX_LATITUDE)
+    x = np.radians(lon) * EARTH_RADIUS
+    y = np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * EARTH_RADIUS
+    return x, y
+
+
+def bbox_to_bounds(bbox):
+    """
+    Convert a (min_lon, min_lat, max_lon, max_lat) bounding box to Web Mercator bounds.
+
+    Args:
+        bbox (tuple): Bounding box in degrees, as stored in Area.bbox.
+
+    Returns:
+        tuple: (min_x, min_y, max_x, max_y) in Web Mercator metres.
+    """
+    x, y = to_mercator([bbox[0], bbox[2]], [bbox[1], bbox[3]])
+    return (x[0], y[0], x[1], y[1])
+
+
+def tile_bounds(z, x, y):
+    """
+    Compute the Web Mercator bounds of a slippy map tile.
+
+    Args:
+        z (int): Zoom level.
+        x (int): Tile column.
+        y (int): Tile row (0 is the northernmost row).
+
+    Returns:
+        tuple: (min_x, min_y, max_x, max_y) in Web Mercator metres.
+    """
+    world = 2 * math.pi * EARTH_RADIUS
+    size = world / 2**z
+    min_x = -world / 2 + x * size
+    max_y = world / 2 - y * size
+    return (min_x, max_y - size, min_x + size, max_y)
+
+
+def tiles_for_bbox(bbox, z):
+    """
+    List the slippy map tiles covering a bounding box at a given zoom level.
+
+    Args:
+        bbox (tuple): Bounding box (min_lon, min_lat, max_lon, max_lat) in degrees.
+        z (int): Zoom level.
+
+    Returns:
+        list: List of (z, x, y) tuples.
+    """
+    n = 2**z
+    def tile_x(lon):
+        return min(n - 1, max(0, int((lon + 180) / 360 * n)))
+    def tile_y(lat):
+        lat = math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, lat)))
+        return min(n - 1, max(0, int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n)))
+    xs = range(tile_x(bbox[0]), tile_x(bbox[2]) + 1)
+    ys = range(tile_y(bbox[3]), tile_y(bbox[1]) + 1)
+    return [(z, x, y) for x in xs for y in ys]
+
+
+def edge_segments(nodes, edges, column=None):
+    """
+    Build straight node-to-node segments for every edge of a network.
+
+    Segments are taken between the edge end nodes rather than from the edge
+    geometries, which works for every mode (transit edges have no geometry)
+    and is what urbanaccess plot_net draws as well.
+
+    Args:
+        nodes (pandas.DataFrame): DataFrame containing node information with 'x' and 'y' columns.
+        edges (pandas.DataFrame): DataFrame containing edge information with 'from_int' and 'to_int' columns.
+        column (str, optional): Edge column used as segment value. Default is None.
+
+    Returns:
+        numpy.ndarray, numpy.ndarray: Segments as an (n, 4) array of Web Mercator
+        x0, y0, x1, y1 and their values (None if column is None).
+    """
+    orig = nodes.index.get_indexer(edges["from_int"])
+    dest = nodes.index.get_indexer(edges["to_int"])
+    known = (orig >= 0) & (dest >= 0)
+    orig, dest = orig[known], dest[known]
+    x, y = to_mercator(nodes["x"].values, nodes["y"].values)
+    segments = np.column_stack([x[orig], y[orig], x[dest], y[dest]])
+    values = None
+    if column is not None:
+        values = edges[column].values[known].astype(float)
+    return segments, values
+
+
+def decimate_segments(segments, values, bounds, pixel_size):
+    """
+    Level of detail reduction of segments for a given view.
+
+    Segments outside the bounds are dropped, then the end points are snapped
+    to the pixel grid and segments falling on the same pixels are merged,
+    keeping the highest value. At low zoom levels this removes most of the
+    segments without any visible difference.
+
+    Args:
+        segments (numpy.ndarray): (n, 4) array of x0, y0, x1, y1.
+        values (numpy.ndarray): Segment values, or None.
+        bounds (tuple): (min_x, min_y, max_x, max_y) of the view.
+        pixel_size (float): Size of a pixel in the segments units.
+
+    Returns:
+        numpy.ndarray, numpy.ndarray: Remaining segments and values.
+    """
+    min_x, min_y, max_x, max_y = bounds
+    inside = ((np.minimum(segments[:, 0], segments[:, 2]) <= max_x) &
+              (np.maximum(segments[:, 0], segments[:, 2]) >= min_x) &
+              (np.minimum(segments[:, 1], segments[:, 3]) <= max_y) &
+              (np.maximum(segments[:, 1], segments[:, 3]) >= min_y))
+    segments = segments[inside]
+    if values is not None:
+        values = values[inside]
+        order = np.argsort(-values, kind="stable")
+        segments, values = segments[order], values[order]
+    origin = np.array([min_x, min_y, min_x, min_y])
+    snapped = np.floor((segments - origin) / pixel_size).astype(np.int64)
+    _, first = np.unique(snapped, axis=0, return_index=True)
+    first.sort()
+    segments = segments[first]
+    if values is not None:
+        values = values[first]
+    return segments, values
+
+
+def rasterize_points(x, y, values, bounds, width, height, how="max"):
+    """
+    Aggregate point values into a raster.
+
+    Args:
+        x (numpy.ndarray): X coordinates of the points.
+        y (numpy.ndarray): Y coordinates of the points.
+        values (numpy.ndarray): Values of the points.
+        bounds (tuple): (min_x, min_y, max_x, max_y) of the raster.
+        width (int): Raster width in pixels.
+        height (int): Raster height in pixels.
+        how (str, optional): Aggregation, one of 'max', 'mean' or 'count'. Default is 'max'.
+
+    Returns:
+        numpy.ndarray: (height, width) array, NaN where no point falls, row 0 on top.
+    """
+    min_x, min_y, max_x, max_y = bounds
+    col = np.floor((x - min_x) / (max_x - min_x) * width).astype(np.int64)
+    row = np.floor((max_y - y) / (max_y - min_y) * height).astype(np.int64)
+    inside = (col >= 0) & (col < width) & (row >= 0) & (row < height)
+    cell = row[inside] * width + col[inside]
+    values = np.asarray(values, dtype=float)[inside]
+    count = np.bincount(cell, minlength=width * height).astype(float)
+    if how == "count":
+        raster = count
+    elif how == "mean":
+        raster = np.bincount(cell, weights=values, minlength=width * height) / np.maximum(count, 1)
+    elif how == "max":
+        raster = np.full(width * height, -np.inf)
+        np.maximum.at(raster, cell, values)
+    else:
+        raise ValueError(f"Unknown aggregation {how}")
+    raster[count == 0] = np.nan
+    return raster.reshape((height, width))
+
+
+def rasterize_segments(segments, values, bounds, width, height, how="max"):
+    """
+    Aggregate segment values into a raster by sampling every segment once per pixel.
+
+    Args:
+        segments (numpy.ndarray): (n, 4) array of x0, y0, x1, y1.
+        values (numpy.ndarray): Segment values.
+        bounds (tuple): (min_x, min_y, max_x, max_y) of the raster.
+        width (int): Raster width in pixels.
+        height (int): Raster height in pixels.
+        how (str, optional): Aggregation, one of 'max', 'mean' or 'count'. Default is 'max'.
+
+    Returns:
+        numpy.ndarray: (height, width) array, NaN where no segment passes, row 0 on top.
+    """
+    min_x, min_y, max_x, max_y = bounds
+    pixel_size = min((max_x - min_x) / width, (max_y - min_y) / height)
+    dx = segments[:, 2] - segments[:, 0]
+    dy = segments[:, 3] - segments[:, 1]
+    samples = np.ceil(np.hypot(dx, dy) / pixel_size).astype(np.int64) + 1
+    samples = np.minimum(samples, 2 * (width + height))
+    seg = np.repeat(np.arange(len(segments)), samples)
+    offsets = np.cumsum(samples) - samples
+    step = np.arange(len(seg)) - np.repeat(offsets, samples)
+    fraction = step / np.maximum(np.repeat(samples, samples) - 1, 1)
+    x = segments[seg, 0] + fraction * dx[seg]
+    y = segments[seg, 1] + fraction * dy[seg]
+    return rasterize_points(x, y, values[seg], bounds, width, height, how=how)
+
+
+def make_norm(values, num_bins=5, log=False):
+    """
+    Build a color normalization shared by every image of a rendering.
+
+    Args:
+        values (numpy.ndarray): Values to normalize.
+        num_bins (int, optional): Number of quantile bins, as in urbanaccess col_colors. Default is 5.
+        log (bool, optional): If True, use a logarithmic normalization instead of bins. Default is False.
+
+    Returns:
+        matplotlib.colors.Normalize: Color normalization.
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if log:
+        positive = values[values > 0]
+        vmax = positive.max() if len(positive) else 1
+        return colors.LogNorm(vmin=max(positive.min() if len(positive) else 1, 1e-9), vmax=vmax)
+    boundaries = np.unique(np.quantile(values, np.linspace(0, 1, num_bins + 1)))
+    if len(boundaries) < 2:
+        return colors.Normalize(vmin=boundaries[0] - 1, vmax=boundaries[0] + 1)
+    return colors.BoundaryNorm(boundaries, ncolors=256)
+
+
+def colorize(raster, cmap, norm):
+    """
+    Convert a raster of values into RGBA pixels, transparent where the raster is NaN.
+
+    Args:
+        raster (numpy.ndarray): (height, width) array of values.
+        cmap (str): Matplotlib colormap name.
+        norm (matplotlib.colors.Normalize): Color normalization.
+
+    Returns:
+        numpy.ndarray: (height, width, 4) uint8 array.
+    """
+    empty = np.isnan(raster)
+    rgba = plt.get_cmap(cmap)(norm(np.where(empty, norm.vmin, raster)), bytes=True)
+    rgba[empty] = 0
+    return rgba
+
+
+def plot_segments(ax, segments, values, cmap="Blues", norm=None, linewidth=1, alpha=0.7):
+    """
+    Draw segments on a matplotlib axes with a single LineCollection.
+
+    Args:
+        ax (matplotlib.axes.Axes): Axes to draw on.
+        segments (numpy.ndarray): (n, 4) array of x0, y0, x1, y1.
+        values (numpy.ndarray): Segment values, or None for a uniform color.
+        cmap (str, optional): Matplotlib colormap name. Default is 'Blues'.
+        norm (matplotlib.colors.Normalize, optional): Color normalization. Default is None.
+        linewidth (float, optional): Line width in points. Default is 1.
+        alpha (float, optional): Line transparency. Default is 0.7.
+
+    Returns:
+        matplotlib.collections.LineCollection: The added collection.
+    """
+    collection = LineCollection(segments.reshape((-1, 2, 2)), linewidths=linewidth,
+                                alpha=alpha, colors="black" if values is None else None)
+    if values is not None:
+        collection.set_array(values)
+        collection.set_cmap(cmap)
+        collection.set_norm(norm)
+    ax.add_collection(collection)
+    return collection
+
+
+def render_png(path, bounds, width, height, segments=None, segment_values=None,
+               points=None, point_values=None, raster=False, cmap="Blues",
+               norm=None, linewidth=1, how="max"):
+    """
+    Render segments and/or points into a PNG file without any display.
+
+    Segments are decimated for the requested resolution and either drawn as a
+    LineCollection on an Agg canvas or aggregated into a raster. Points are
+    always aggregated into a raster.
+
+    Args:
+        path (str): Path of the PNG file to write.
+        bounds (tuple): (min_x, min_y, max_x, max_y) of the image, in the coordinates units.
+        width (int): Image width in pixels.
+        height (int): Image height in pixels.
+        segments (numpy.ndarray, optional): (n, 4) array of x0, y0, x1, y1. Default is None.
+        segment_values (numpy.ndarray, optional): Segment values. Default is None.
+        points (tuple, optional): Tuple of x and y arrays. Default is None.
+        point_values (numpy.ndarray, optional): Point values. Default is None.
+        raster (bool, optional): If True, aggregate segments into a raster instead of drawing lines. Default is False.
+        cmap (str, optional): Matplotlib colormap name. Default is 'Blues'.
+        norm (matplotlib.colors.Normalize, optional): Color normalization. Default is None.
+        linewidth (float, optional): Line width in points. Default is 1.
+        how (str, optional): Raster aggregation, one of 'max', 'mean' or 'count'. Default is 'max'.
+
+    Returns:
+        bool: False if nothing fell inside the bounds and no file was written.
+    """
+    pixel_size = min((bounds[2] - bounds[0]) / width, (bounds[3] - bounds[1]) / height)
+    layers = []
+    if segments is not None:
+        segments, segment_values = decimate_segments(segments, segment_values, bounds, pixel_size)
+        if len(segments):
+            if segment_values is None:
+                segment_values = np.ones(len(segments))
+            if norm is None:
+                norm = make_norm(segment_values)
+            if raster:
+                layers.append(rasterize_segments(segments, segment_values, bounds,
+                                                 width, height, how=how))
+    if points is not None:
+        raster_points = rasterize_points(points[0], points[1], point_values,
+                                         bounds, width, height, how=how)
+        if not np.isnan(raster_points).all():
+            if norm is None:
+                norm = make_norm(point_values)
+            layers.append(raster_points)
+    draw_lines = segments is not None and len(segments) and not raster
+    if not layers and not draw_lines:
+        return False
+
+    dpi = 100
+    fig = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    ax.set_xlim(bounds[0], bounds[2])
+    ax.set_ylim(bounds[1], bounds[3])
+    for layer in layers:
+        ax.imshow(colorize(layer, cmap, norm), extent=(bounds[0], bounds[2], bounds[1], bounds[3]),
+                  interpolation="nearest", aspect="auto")
+    if draw_lines:
+        plot_segments(ax, segments, segment_values, cmap=cmap, norm=norm, linewidth=linewidth)
+    fig.savefig(path, dpi=dpi, transparent=True)
+    return True
+
+
+def bucket_by_tile(min_x, min_y, max_x, max_y, z, tiles):
+    """
+    Assign boxes, such as segment extents or points, to the slippy map tiles they overlap, in one pass.
+
+    Args:
+        min_x, min_y, max_x, max_y (numpy.ndarray): Web Mercator extents of the boxes.
+        z (int): Zoom level.
+        tiles (list): (z, x, y) tiles to keep, such as the output of tiles_for_bbox.
+
+    Returns:
+        dict: Box positions keyed by (x, y) tile, only for tiles overlapped by a box.
+    """
+    world = 2 * math.pi * EARTH_RADIUS
+    size = world / 2**z
+    xs = [t[1] for t in tiles]
+    ys = [t[2] for t in tiles]
+    first_x = np.clip(np.floor((min_x + world / 2) / size), min(xs), max(xs)).astype(np.int64)
+    last_x = np.clip(np.floor((max_x + world / 2) / size), min(xs), max(xs)).astype(np.int64)
+    first_y = np.clip(np.floor((world / 2 - max_y) / size), min(ys), max(ys)).astype(np.int64)
+    last_y = np.clip(np.floor((world / 2 - min_y) / size), min(ys), max(ys)).astype(np.int64)
+    # a box spanning several tiles goes to each of them
+    n_x, n_y = last_x - first_x + 1, last_y - first_y + 1
+    counts = n_x * n_y
+    box = np.repeat(np.arange(len(counts)), counts)
+    step = np.arange(len(box)) - np.repeat(np.cumsum(counts) - counts, counts)
+    tile_x = first_x[box] + step % n_x[box]
+    tile_y = first_y[box] + step // n_x[box]
+    order = np.lexsort((tile_y, tile_x))
+    box, tile_x, tile_y = box[order], tile_x[order], tile_y[order]
+    starts = np.flatnonzero(np.r_[True, (tile_x[1:] != tile_x[:-1]) | (tile_y[1:] != tile_y[:-1])])
+    ends = np.r_[starts[1:], len(box)]
+    return {(int(tile_x[a]), int(tile_y[a])): box[a:b] for a, b in zip(starts, ends)}
+
+
+def render_tiles(out_dir, bbox, zooms, segments=None, segment_values=None,
+                 points=None, point_values=None, raster=False, cmap="Blues",
+                 norm=None, linewidth=1, how="max"):
+    """
+    Render slippy map PNG tiles ({out_dir}/{z}/{x}/{y}.png) covering a bounding box.
+
+    Coordinates must be in Web Mercator. The color normalization is shared by
+    all tiles so that they can be assembled into a seamless map. Segments and
+    points are assigned to their tiles once per zoom level, and tiles without
+    any of them are skipped.
+
+    Args:
+        out_dir (str): Directory where the tiles are written.
+        bbox (tuple): Bounding box (min_lon, min_lat, max_lon, max_lat) in degrees.
+        zooms (iterable): Zoom levels to render.
+        segments, segment_values, points, point_values, raster, cmap, linewidth, how:
+            see render_png.
+        norm (matplotlib.colors.Normalize, optional): Color normalization, computed
+            from the values if None. Default is None.
+
+    Returns:
+        list: Paths of the written tiles.
+    """
+    if norm is None:
+        values = segment_values if segment_values is not None else point_values
+        if values is not None:
+            norm = make_norm(values)
+    written = []
+    for zoom in zooms:
+        tiles = tiles_for_bbox(bbox, zoom)
+        # segments reaching a tile border by less than a pixel, or their line width, are drawn on both tiles
+        margin = 2 * math.pi * EARTH_RADIUS / 2**zoom / TILE_SIZE
+        segment_tiles, point_tiles = {}, {}
+        if segments is not None and len(segments):
+            segment_tiles = bucket_by_tile(np.minimum(segments[:, 0], segments[:, 2]) - margin,
+                                           np.minimum(segments[:, 1], segments[:, 3]) - margin,
+                                           np.maximum(segments[:, 0], segments[:, 2]) + margin,
+                                           np.maximum(segments[:, 1], segments[:, 3]) + margin, zoom, tiles)
+        if points is not None and len(points[0]):
+            x, y = np.asarray(points[0], dtype=float), np.asarray(points[1], dtype=float)
+            point_tiles = bucket_by_tile(x, y, x, y, zoom, tiles)
+        for x, y in sorted(set(segment_tiles) | set(point_tiles)):
+            tile_segments = tile_segment_values = tile_points = tile_point_values = None
+            if (x, y) in segment_tiles:
+                tile_segments = segments[segment_tiles[(x, y)]]
+                if segment_values is not None:
+                    tile_segment_values = np.asarray(segment_values)[segment_tiles[(x, y)]]
+            if (x, y) in point_tiles:
+                inside = point_tiles[(x, y)]
+                tile_points = (np.asarray(points[0])[inside], np.asarray(points[1])[inside])
+                tile_point_values = None if point_values is None else np.asarray(point_values)[inside]
+            tile_dir = f"{out_dir}/{zoom}/{x}"
+            os.makedirs(tile_dir, exist_ok=True)
+            path = f"{tile_dir}/{y}.png"
+            if render_png(path, tile_bounds(zoom, x, y), TILE_SIZE, TILE_SIZE,
+                          segments=tile_segments, segment_values=tile_segment_values,
+                          points=tile_points, point_values=tile_point_values, raster=raster,
+                          cmap=cmap, norm=norm, linewidth=linewidth, how=how):
+                written.append(path)
+            elif not os.listdir(tile_dir):
+                os.rmdir(tile_dir)
+    return written
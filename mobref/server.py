@@ -0,0 +1,330 @@
+import os
+os.environ['USE_PYGEOS'] = '0'
+import sys
+import json
+import socket
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from mobref import vrp, instrument
+from mobref.config import load_config, load_area, load_networks
+from mobref.network import UNREACHABLE
+
+
+def _points(items):
+    """
+    Convert a JSON list of locations, either [lon, lat] pairs or {"lon", "lat"}
+    objects, into a DataFrame with columns 'lon' and 'lat'.
+    """
+    if len(items) and isinstance(items[0], dict):
+        return pd.DataFrame(items, columns=["lon", "lat"])
+    return pd.DataFrame(np.asarray(items, dtype=float).reshape((-1, 2)), columns=["lon", "lat"])
+
+
+def _lengths(values):
+    """
+    Convert pandana path lengths into a JSON list, unreachable pairs becoming null.
+    """
+    values = np.asarray(values, dtype=float)
+    return np.where(values >= UNREACHABLE, np.nan, values).tolist()
+
+
+def _to_json(obj):
+    """
+    JSON encoder fallback for the numpy and pandas values of the responses.
+    """
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if obj is pd.NA:
+        return None
+    raise TypeError(f"{type(obj)} is not JSON serializable")
+
+
+class RoutingService():
+
+    def __init__(self, networks):
+        """
+        Answers routing requests on Networks kept in memory.
+
+        pandana networks keep query state (POIs, aggregations), so requests on
+        the same mode are serialized with one lock per Network while requests on
+        different modes run concurrently. The POI caches are kept per mode too,
+        so that they are only touched under the lock of their mode.
+
+        Args:
+            networks (dict): Network objects keyed by mode.
+        """
+        self.networks = networks
+        self.locks = {mode: threading.Lock() for mode in networks}
+        self.categories = {mode: {} for mode in networks}
+        self.aggregations = {mode: {} for mode in networks}
+        self.nearest_pois = {mode: {} for mode in networks}
+
+    def network(self, request):
+        mode = request.get("mode", "drive")
+        if mode not in self.networks:
+            raise ValueError(f"Mode {mode} is not loaded")
+        return self.networks[mode], self.locks[mode]
+
+    def route(self, request):
+        """
+        Travel times and distances between pairs of origins and destinations.
+
+        Request keys: "mode", "origins", "destinations", "hour" (departure hour
+        of the drive speed profiles), and "paths" (bool) to also return the node paths.
+        """
+        network, lock = self.network(request)
+        origins = _points(request["origins"])
+        destinations = _points(request["destinations"])
+        with lock:
+            o = network.pdn.get_node_ids(origins.lon, origins.lat).values
+            d = network.pdn.get_node_ids(destinations.lon, destinations.lat).values
+            impedence = network.impedence_at(request.get("hour"))
+            pdn = network.get_pdn(impedence)
+            response = {
+                "travel_time": _lengths(pdn.shortest_path_lengths(o, d, imp_name=impedence)),
+                "distance": _lengths(network.get_pdn("length").shortest_path_lengths(o, d, imp_name="length"))}
+            if request.get("paths"):
+                response["paths"] = [p.tolist() for p in pdn.shortest_paths(o, d, imp_name=impedence)]
+        return response
+
+    def table(self, request):
+        """
+        Travel time and distance matrices between sources and destinations.
+
+        Request keys: "mode", "sources", "destinations" (defaults to the sources),
+        and "hour" (departure hour of the drive speed profiles).
+        """
+        network, lock = self.network(request)
+        sources = _points(request["sources"])
+        destinations = _points(request.get("destinations", request["sources"]))
+        with lock:
+            o = network.pdn.get_node_ids(sources.lon, sources.lat).values
+            d = network.pdn.get_node_ids(destinations.lon, destinations.lat).values
+            impedence = network.impedence_at(request.get("hour"))
+            return {"time": _lengths(network.get_nodes_matrix(o, d, impedence=impedence)),
+                    "distance": _lengths(network.get_nodes_matrix(o, d, impedence="length"))}
+
+    def _set_category(self, network, request):
+        """
+        Register the POIs of a request on the pandana network, once per category name.
+        Anonymous POI lists are registered on every request.
+        """
+        categories = self.categories[network.mode]
+        category = request.get("category")
+        if "pois" in request:
+            pois = _points(request["pois"])
+            category = category or "pois"
+            categories[category] = pois
+            for cache in (self.aggregations[network.mode], self.nearest_pois[network.mode]):
+                for key in [k for k in cache if k[0] == category]:
+                    del cache[key]
+        elif category not in categories:
+            raise ValueError(f"Unknown POI category {category}, send its pois first")
+        return category, categories[category]
+
+    def nearest(self, request):
+        """
+        Nearest POIs from a set of points.
+
+        Request keys: "mode", "points", "pois" and/or "category", "maxtime" (s),
+        and "maxitems". Nearest POIs of every node are cached per category, maxtime and maxitems.
+        """
+        network, lock = self.network(request)
+        points = _points(request["points"])
+        maxtime = request.get("maxtime", 600)
+        maxitems = request.get("maxitems", 1)
+        with lock:
+            category, pois = self._set_category(network, request)
+            cache = self.nearest_pois[network.mode]
+            key = (category, maxtime, maxitems)
+            if key not in cache:
+                network.pdn.set_pois(category=category, maxdist=maxtime, maxitems=maxitems,
+                                     x_col=pois.lon, y_col=pois.lat)
+                cache[key] = network.pdn.nearest_pois(distance=maxtime, category=category,
+                                                      num_pois=maxitems, include_poi_ids=True)
+            nodes = network.pdn.get_node_ids(points.lon, points.lat).values
+            results = cache[key].loc[nodes]
+        times = results[list(range(1, maxitems + 1))].values
+        ids = results[[f"poi{i}" for i in range(1, maxitems + 1)]].values
+        return {"travel_time": np.where(times >= maxtime, np.nan, times).tolist(),
+                "poi": np.where(times >= maxtime, None, ids).tolist()}
+
+    def accessibility(self, request):
+        """
+        Number of POIs reachable within a time from a set of points.
+
+        Request keys: "mode", "points", "pois" and/or "category", and "time" (s).
+        Aggregations are cached per category and time.
+        """
+        network, lock = self.network(request)
+        points = _points(request["points"])
+        time = request.get("time", 300)
+        with lock:
+            category, pois = self._set_category(network, request)
+            cache = self.aggregations[network.mode]
+            key = (category, time)
+            if key not in cache:
+                cache[key] = network.get_accessibility(pois, time)
+            nodes = network.pdn.get_node_ids(points.lon, points.lat).values
+            return {"count": cache[key].loc[nodes].values.tolist()}
+
+    def vrp(self, request):
+        """
+        Solve a vehicle routing problem.
+
+        Request keys: "mode", "vehicles", "jobs", "exploration_level", "nb_threads" and "hour".
+        """
+        network, lock = self.network(request)
+        with lock:
+            solution = vrp.solve_vrp(network, _points(request["vehicles"]), _points(request["jobs"]),
+                                     exploration_level=request.get("exploration_level", 5),
+                                     nb_threads=request.get("nb_threads", 4),
+                                     hour=request.get("hour"))
+        routes = solution.routes[["vehicle_id", "type", "arrival", "location_index", "id"]]
+        return {"cost": solution.summary.cost,
+                "routes": routes.astype(object).where(routes.notna(), None).to_dict("records")}
+
+    def batch(self, request):
+        """
+        Answer a list of requests at once.
+
+        Route requests of the same mode and departure hour are merged into a
+        single vectorized query before their answers are split back, other
+        requests are answered in turn. Request keys: "requests", a list of
+        requests each holding an "endpoint" key.
+        """
+        requests = request["requests"]
+        responses = [None] * len(requests)
+        routes = {}
+        for i, r in enumerate(requests):
+            if r.get("endpoint") == "route" and not r.get("paths"):
+                routes.setdefault((r.get("mode", "drive"), r.get("hour")), []).append(i)
+            else:
+                responses[i] = self.handle(r.get("endpoint"), r)
+        for (mode, hour), indices in routes.items():
+            merged = self.route({"mode": mode, "hour": hour,
+                                 "origins": sum((list(requests[i]["origins"]) for i in indices), []),
+                                 "destinations": sum((list(requests[i]["destinations"]) for i in indices), [])})
+            start = 0
+            for i in indices:
+                end = start + len(requests[i]["origins"])
+                responses[i] = {k: v[start:end] for k, v in merged.items()}
+                start = end
+        return {"responses": responses}
+
+    def handle(self, endpoint, request):
+        handlers = {"route": self.route, "table": self.table, "nearest": self.nearest,
+                    "accessibility": self.accessibility, "vrp": self.vrp, "batch": self.batch}
+        if endpoint not in handlers:
+            raise ValueError(f"Unknown endpoint {endpoint}")
+        with instrument.stage(f"server.{endpoint}", mode=request.get("mode", "drive")):
+            return handlers[endpoint](request)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler: POST /<endpoint> with a JSON body, GET /modes lists the loaded modes.
+    """
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def send_json(self, status, body):
+        payload = json.dumps(body, default=_to_json).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path.strip("/") == "modes":
+            self.send_json(200, {"modes": list(self.server.service.networks)})
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            response = self.server.service.handle(self.path.strip("/"), request)
+        except (KeyError, ValueError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self.send_json(200, response)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def make_server(networks, host="127.0.0.1", port=8000, socket_path=None, quiet=False):
+    """
+    Create an HTTP server answering requests on Networks kept in memory.
+
+    Args:
+        networks (dict): Network objects keyed by mode.
+        host (str, optional): Address to listen on. Default is "127.0.0.1".
+        port (int, optional): TCP port to listen on. Default is 8000.
+        socket_path (str, optional): If set, listen on this Unix socket instead of TCP.
+        quiet (bool, optional): If True, do not log every request. Default is False.
+
+    Returns:
+        http.server.ThreadingHTTPServer: Server, to be run with serve_forever().
+    """
+    if socket_path is not None:
+        server = UnixHTTPServer(socket_path, RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.service = RoutingService(networks)
+    server.quiet = quiet
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve mobref networks over HTTP.")
+    parser.add_argument("configuration_file")
+    parser.add_argument("--modes", nargs="+", help="modes to load (default: all available)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--socket", help="listen on a Unix socket instead of TCP")
+    parser.add_argument("--quiet", action="store_true", help="do not log requests")
+    parser.add_argument("--trace", help="append the timing and memory of every request to this JSON lines file")
+    args = parser.parse_args(argv)
+    instrument.configure(trace_path=args.trace)
+
+    cfg = load_config(args.configuration_file)
+    area = load_area(cfg)
+    networks = load_networks(cfg, area, args.modes)
+    server = make_server(networks, args.host, args.port, args.socket, args.quiet)
+    print(f"Serving {', '.join(networks)} on {args.socket or f'{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,194 @@
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from scipy.spatial import cKDTree
+from shapely.geometry import LineString, box
+from mobref.area import Area
+from mobref.graph_utils import save_graph
+
+# meters per degree of latitude
+METERS_PER_DEGREE = 111320.0
+
+SPEEDS_KPH = {"drive": None, "bike": 20, "walk": 4.8}
+ROAD_SPEEDS_KPH = {"primary": 50, "secondary": 40, "residential": 30}
+
+
+def _degrees(meters, lat):
+    """
+    Convert a distance in meters into degrees of longitude and latitude around a latitude.
+    """
+    return meters / (METERS_PER_DEGREE * np.cos(np.radians(lat))), meters / METERS_PER_DEGREE
+
+
+def _graph(x, y, u, v, mode, seed):
+    """
+    Build osmnx-like nodes and edges GeoDataFrames, with the columns added by
+    Network.create_network, from node coordinates and directed node pairs.
+    """
+    rng = np.random.default_rng(seed)
+    ids = np.arange(len(x), dtype=np.int64) + 1
+    nodes = gpd.GeoDataFrame({"y": y, "x": x, "street_count": np.bincount(u, minlength=len(x))},
+                             geometry=gpd.points_from_xy(x, y),
+                             index=pd.Index(ids, name="osmid"), crs=4326)
+    dx, dy = _degrees(1, y.mean())
+    length = np.hypot((x[v] - x[u]) / dx, (y[v] - y[u]) / dy)
+    highway = rng.choice(list(ROAD_SPEEDS_KPH), size=len(u), p=[0.1, 0.2, 0.7])
+    edges = pd.DataFrame({"u": ids[u], "v": ids[v], "key": 0,
+                          "osmid": np.arange(len(u)), "highway": highway,
+                          "oneway": False, "service": None, "length": length})
+    if mode == "drive":
+        edges["speed_kph"] = pd.Series(highway).map(ROAD_SPEEDS_KPH).values.astype(float)
+        edges["travel_time"] = edges["length"] / (edges["speed_kph"] / 3.6)
+    else:
+        edges["travel_time"] = edges["length"] / (SPEEDS_KPH[mode] / 3.6)
+    edges["weight"] = edges["travel_time"]
+    edges["from_int"] = edges["u"]
+    edges["to_int"] = edges["v"]
+    geometry = [LineString([(x[a], y[a]), (x[b], y[b])]) for a, b in zip(u, v)]
+    edges = gpd.GeoDataFrame(edges.set_index(["u", "v", "key"]), geometry=geometry, crs=4326)
+    return nodes, edges
+
+
+def grid_network(size, spacing=150, origin=(2.30, 48.85), mode="drive", seed=0):
+    """
+    Generate a square grid street network with two-way streets.
+
+    Args:
+        size (int): Number of nodes per side, the network has size**2 nodes.
+        spacing (float, optional): Distance between neighbouring nodes in meters. Default is 150.
+        origin (tuple, optional): Longitude and latitude of the south west corner. Default is Paris.
+        mode (str, optional): Mode used for the travel times (drive, bike or walk). Default is "drive".
+        seed (int, optional): Seed of the random road classes. Default is 0.
+
+    Returns:
+        geopandas.GeoDataFrame, geopandas.GeoDataFrame: Nodes and edges, as stored by Network.
+    """
+    dx, dy = _degrees(spacing, origin[1])
+    index = np.arange(size * size)
+    row, col = np.divmod(index, size)
+    x = origin[0] + col * dx
+    y = origin[1] + row * dy
+    right = index[col < size - 1]
+    up = index[row < size - 1]
+    u = np.concatenate([right, right + 1, up, up + size])
+    v = np.concatenate([right + 1, right, up + size, up])
+    return _graph(x, y, u, v, mode, seed)
+
+
+def random_geometric_network(n, radius=250, extent=5000, origin=(2.30, 48.85), mode="drive", seed=0):
+    """
+    Generate a random geometric street network: random nodes joined by two-way
+    streets when closer than a radius.
+
+    Args:
+        n (int): Number of nodes.
+        radius (float, optional): Connection radius in meters. Default is 250.
+        extent (float, optional): Side of the square area in meters. Default is 5000.
+        origin (tuple, optional): Longitude and latitude of the south west corner. Default is Paris.
+        mode (str, optional): Mode used for the travel times (drive, bike or walk). Default is "drive".
+        seed (int, optional): Random seed. Default is 0.
+
+    Returns:
+        geopandas.GeoDataFrame, geopandas.GeoDataFrame: Nodes and edges, as stored by Network.
+    """
+    rng = np.random.default_rng(seed)
+    xy = rng.random((n, 2)) * extent
+    pairs = cKDTree(xy).query_pairs(radius, output_type="ndarray")
+    u = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    v = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    dx, dy = _degrees(1, origin[1])
+    return _graph(origin[0] + xy[:, 0] * dx, origin[1] + xy[:, 1] * dy, u, v, mode, seed)
+
+
+def write_area(processed_path, nodes):
+    """
+    Write the area covering a synthetic network and load it, without any download.
+
+    Args:
+        processed_path (str): Path to the processed data directory.
+        nodes (geopandas.GeoDataFrame): Nodes of the synthetic network.
+
+    Returns:
+        Area: Area object.
+    """
+    os.makedirs(processed_path, exist_ok=True)
+    polygon = box(nodes.x.min(), nodes.y.min(), nodes.x.max(), nodes.y.max())
+    gdf = gpd.GeoDataFrame({"insee": ["00000"]}, geometry=[polygon], crs=4326)
+    gdf.to_feather(f"{processed_path}/area.feather")
+    return Area(processed_path, None, None)
+
+
+def write_network(processed_path, nodes, edges, mode):
+    """
+    Write a synthetic network where Network expects its cached graph.
+
+    Args:
+        processed_path (str): Path to the processed data directory.
+        nodes (geopandas.GeoDataFrame): Nodes of the synthetic network.
+        edges (geopandas.GeoDataFrame): Edges of the synthetic network.
+        mode (str): Mode of transportation (drive, bike or walk).
+    """
+    save_graph(nodes, edges, f"{processed_path}/{mode}.pkl")
+
+
+def write_gtfs(gtfs_path, nodes, n_routes=10, stops_per_route=20, headway=10, speed=25, seed=0):
+    """
+    Write a synthetic GTFS feed whose stops lie on the network nodes.
+
+    Every route runs in both directions between 06:00 and 11:00 on weekdays,
+    along a random walk of nearby nodes.
+
+    Args:
+        gtfs_path (str): Directory where the GTFS text files are written.
+        nodes (geopandas.GeoDataFrame): Nodes of the synthetic network.
+        n_routes (int, optional): Number of routes. Default is 10.
+        stops_per_route (int, optional): Number of stops of each route. Default is 20.
+        headway (int, optional): Minutes between two departures. Default is 10.
+        speed (float, optional): Commercial speed in km/h. Default is 25.
+        seed (int, optional): Random seed. Default is 0.
+    """
+    os.makedirs(gtfs_path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    dx, dy = _degrees(1, nodes.y.mean())
+    xy = np.column_stack([nodes.x.values / dx, nodes.y.values / dy])
+    tree = cKDTree(xy)
+
+    routes, stops, trips, stop_times = [], {}, [], []
+    for r in range(n_routes):
+        # next stop among the nearest nodes in a persistent direction
+        current = rng.integers(len(xy))
+        heading = rng.normal(size=2)
+        sequence = [current]
+        for _ in range(stops_per_route - 1):
+            _, candidates = tree.query(xy[current] + heading / np.linalg.norm(heading) * 400, k=5)
+            candidates = [c for c in candidates if c not in sequence] or list(candidates)
+            current = rng.choice(candidates)
+            sequence.append(current)
+        routes.append({"route_id": f"R{r}", "agency_id": "SYN", "route_short_name": f"{r}",
+                       "route_long_name": f"Synthetic {r}", "route_type": 3})
+        for s in sequence:
+            stops[s] = {"stop_id": f"S{s}", "stop_name": f"Stop {s}",
+                        "stop_lat": nodes.y.values[s], "stop_lon": nodes.x.values[s]}
+        hops = np.hypot(*(np.diff(xy[sequence], axis=0).T)) / (speed / 3.6)
+        for direction, order in enumerate((sequence, sequence[::-1])):
+            offsets = np.concatenate([[0], np.cumsum(hops if direction == 0 else hops[::-1])])
+            for k, departure in enumerate(range(6 * 3600, 11 * 3600, headway * 60)):
+                trip_id = f"R{r}_{direction}_{k}"
+                trips.append({"route_id": f"R{r}", "service_id": "WEEK", "trip_id": trip_id,
+                              "direction_id": direction})
+                for seq, (s, offset) in enumerate(zip(order, offsets)):
+                    t = int(departure + offset)
+                    clock = f"{t // 3600:02d}:{t % 3600 // 60:02d}:{t % 60:02d}"
+                    stop_times.append({"trip_id": trip_id, "arrival_time": clock, "departure_time": clock,
+                                       "stop_id": f"S{s}", "stop_sequence": seq + 1})
+
+    pd.DataFrame([{"agency_id": "SYN", "agency_name": "Synthetic", "agency_url": "http://example.com",
+                   "agency_timezone": "Europe/Paris"}]).to_csv(f"{gtfs_path}/agency.txt", index=False)
+    pd.DataFrame(list(stops.values())).to_csv(f"{gtfs_path}/stops.txt", index=False)
+    pd.DataFrame(routes).to_csv(f"{gtfs_path}/routes.txt", index=False)
+    pd.DataFrame(trips).to_csv(f"{gtfs_path}/trips.txt", index=False)
+    pd.DataFrame(stop_times).to_csv(f"{gtfs_path}/stop_times.txt", index=False)
+    pd.DataFrame([{"service_id": "WEEK", "monday": 1, "tuesday": 1, "wednesday": 1, "thursday": 1,
+                   "friday": 1, "saturday": 0, "sunday": 0, "start_date": 20230101,
+                   "end_date": 20301231}]).to_csv(f"{gtfs_path}/calendar.txt", index=False)
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from scipy.optimize import brentq
+from shapely.geometry import LineString
+from mobref import synthetic
+from mobref.assignment import bpr, static_assignment
+from mobref.network import Network
+from mobref.profiles import profile_column
+
+# two routes between A and B, through M1 (2 x 60 s) or M2 (2 x 90 s), each way
+NODES = {1: (2.30, 48.85), 2: (2.32, 48.85), 3: (2.31, 48.855), 4: (2.31, 48.845)}
+ROUTES = [([1, 3, 2], 60.0), ([1, 4, 2], 90.0)]
+DEMAND = 3000
+CAPACITY = 1200
+
+
+def _two_routes():
+    nodes = gpd.GeoDataFrame({"y": [y for _, y in NODES.values()], "x": [x for x, _ in NODES.values()]},
+                             geometry=gpd.points_from_xy(*zip(*NODES.values())),
+                             index=pd.Index(list(NODES), name="osmid"), crs=4326)
+    rows = []
+    for path, time in ROUTES:
+        for a, b in zip(path[:-1], path[1:]):
+            rows += [(a, b, time), (b, a, time)]
+    edges = pd.DataFrame(rows, columns=["u", "v", "travel_time"]).assign(
+        key=0, highway="primary", lanes="1", oneway=True, length=1000.0)
+    edges["weight"] = edges["travel_time"]
+    edges["from_int"], edges["to_int"] = edges["u"], edges["v"]
+    geometry = [LineString([NODES[a], NODES[b]]) for a, b in zip(edges["u"], edges["v"])]
+    return nodes, gpd.GeoDataFrame(edges.set_index(["u", "v", "key"]), geometry=geometry, crs=4326)
+
+
+@pytest.fixture
+def network(tmp_path):
+    nodes, edges = _two_routes()
+    area = synthetic.write_area(str(tmp_path), nodes)
+    synthetic.write_network(str(tmp_path), nodes, edges, "drive")
+    return Network(area, "drive", str(tmp_path))
+
+
+@pytest.fixture(scope="module")
+def zones():
+    return pd.DataFrame({"lon": [NODES[1][0], NODES[2][0]], "lat": [NODES[1][1], NODES[2][1]]})
+
+
+def _equilibrium():
+    # flow on the fast route at which both routes take the same time
+    def route_time(flow, free_flow_time):
+        return 2 * bpr(free_flow_time, flow, CAPACITY)
+    return brentq(lambda x: route_time(x, 60) - route_time(DEMAND - x, 90), 0, DEMAND)
+
+
+def _route_flows(res):
+    flow = res["edges"]["flow"]
+    return flow.loc[(1, 3, 0)], flow.loc[(1, 4, 0)]
+
+
+@pytest.mark.parametrize("method", ["frank-wolfe", "msa"])
+def test_two_routes_equilibrium(network, zones, method):
+    demand = np.array([[0, DEMAND], [DEMAND, 0]])
+    res = static_assignment(network, zones, demand, method=method, max_iterations=200, gap=1e-6, workers=1)
+    fast, slow = _route_flows(res)
+    assert fast + slow == pytest.approx(DEMAND)
+    assert fast == pytest.approx(_equilibrium(), rel=1e-2)
+    # both directions carry the same flows
+    assert res["edges"]["flow"].loc[(3, 1, 0)] == pytest.approx(fast)
+    assert res["gaps"][-1] < res["gaps"][0]
+    assert res["unassigned"] == 0
+
+
+def test_workers_and_hour(network, zones):
+    demand = np.array([[0, DEMAND], [DEMAND, 0]])
+    expected = static_assignment(network, zones, demand, max_iterations=10, workers=1)
+    assert np.all(np.diff(expected["gaps"]) < 0)
+    # one origin per batch, loaded by two worker processes
+    res = static_assignment(network, zones, demand, max_iterations=10, batch_size=1, workers=2, hour=8)
+    np.testing.assert_allclose(res["edges"]["flow"].values, expected["edges"]["flow"].values)
+    assert res["gaps"] == pytest.approx(expected["gaps"])
+    column = network.edges[profile_column(8)].reindex(res["edges"].index)
+    np.testing.assert_allclose(column.values, res["edges"]["travel_time"].values, rtol=1e-6)
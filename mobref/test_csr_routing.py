@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from mobref.matrices import UNREACHABLE
+
+
+@pytest.fixture(scope="module", params=["grid_network", "geometric_network"])
+def network(request):
+    return request.getfixturevalue(request.param)
+
+
+@pytest.mark.parametrize("impedence", ["weight", "length"])
+def test_nodes_matrix_matches_pandana(network, impedence):
+    rng = np.random.default_rng(0)
+    nodes = network.nodes.index.values
+    origs = rng.choice(nodes, 30)
+    dests = rng.choice(nodes, 40)
+    expected = network.get_nodes_matrix(origs, dests, impedence=impedence)
+    res = network.get_nodes_matrix(origs, dests, impedence=impedence, backend="csr")
+    assert res.shape == expected.shape
+    # pandana rounds every edge impedance to 3 decimals, errors add up along paths
+    np.testing.assert_allclose(res, expected, rtol=1e-3, atol=0.05)
+    assert ((res == UNREACHABLE) == (expected == UNREACHABLE)).all()
+
+
+def test_matrices_backends_agree(network):
+    pois = network.area.random_points(25)
+    expected = network.get_matrices(pois)
+    res = network.get_matrices(pois, backend="csr")
+    for key in ("time", "distance"):
+        np.testing.assert_allclose(res[key].values, expected[key].values, rtol=1e-3, atol=0.05)
+
+
+def test_trees_in_parallel(network):
+    pois = network.area.random_points(10)
+    trees = network.get_travel_time_trees(pois, workers=1)
+    pois_nodes = network.pdn.get_node_ids(pois.lon, pois.lat).values
+    parallel = network.get_router().one_to_all(pois_nodes, batch_size=3, workers=2)
+    np.testing.assert_array_equal(np.isinf(parallel), trees.isna().values)
+    np.testing.assert_array_equal(parallel[~np.isinf(parallel)], trees.values[trees.notna().values])
+    # the tree holds the travel time to every node of the network
+    expected = network.get_nodes_matrix(pois_nodes, trees.columns.values)
+    expected[expected == UNREACHABLE] = np.nan
+    np.testing.assert_allclose(trees.values, expected, rtol=1e-3, atol=0.05)
+
+
+def test_trees_limit(network):
+    pois = network.area.random_points(5)
+    trees = network.get_travel_time_trees(pois, maxtime=60, workers=1)
+    assert np.nanmax(trees.values) <= 60
@@ -0,0 +1,21 @@
+import numpy as np
+from mobref.geometry import encode_polylines
+
+# reference example of the Google encoded polyline algorithm format, in lon/lat
+GOOGLE_COORDS = [[-120.2, 38.5], [-120.95, 40.7], [-126.453, 43.252]]
+GOOGLE_POLYLINE = "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+
+
+def test_encode_polyline():
+    coords = np.array(GOOGLE_COORDS)
+    assert encode_polylines(coords, np.zeros(len(coords), dtype=int), 1) == [GOOGLE_POLYLINE]
+
+
+def test_encode_many_polylines():
+    # every path starts over from absolute coordinates, paths without point are empty
+    coords = np.array(GOOGLE_COORDS + GOOGLE_COORDS[:2] + GOOGLE_COORDS)
+    point_path = np.array([0, 0, 0, 2, 2, 3, 3, 3])
+    polylines = encode_polylines(coords, point_path, 5)
+    assert polylines == [GOOGLE_POLYLINE, "", "_p~iF~ps|U_ulLnnqC", GOOGLE_POLYLINE, ""]
+    # a higher precision only scales the coordinates
+    assert encode_polylines(coords[:1] / 10, point_path[:1], 1, precision=6) == ["_p~iF~ps|U"]
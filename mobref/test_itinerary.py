@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+from mobref.itinerary import ItineraryDecoder
+
+# (from_int, to_int, net_type, unique_route_id, weight in minutes, distance, mean headway in minutes)
+EDGES = [(1, 2, "walk", None, 1.0, 80.0, np.nan),
+         (2, 10, "osm to transit", None, 5.5, 10.0, 10.0),
+         (10, 11, "transit", "A", 3.0, 1500.0, np.nan),
+         (11, 12, "transit", "A", 2.0, 1000.0, np.nan),
+         (12, 3, "transit to osm", None, 0.5, 10.0, np.nan),
+         (3, 21, "osm to transit", None, 3.5, 10.0, 6.0),
+         (21, 22, "transit", "B", 4.0, 2000.0, np.nan),
+         (22, 4, "transit to osm", None, 0.5, 10.0, np.nan),
+         (4, 5, "walk", None, 2.0, 160.0, np.nan),
+         # a slower parallel edge is never used
+         (4, 5, "walk", None, 9.0, 700.0, np.nan)]
+
+
+def test_decode_legs():
+    edges = pd.DataFrame(EDGES, columns=["from_int", "to_int", "net_type", "unique_route_id",
+                                         "weight", "distance", "mean"])
+    decoder = ItineraryDecoder(edges)
+    legs = decoder.decode([[1, 2, 10, 11, 12, 3, 21, 22, 4, 5], [7], [4, 5]])
+    assert list(legs["path"]) == [0] * 7 + [2]
+    assert list(legs["leg"]) == list(range(7)) + [0]
+    assert list(legs["type"]) == ["walk", "wait", "ride", "walk", "transfer", "ride", "walk", "walk"]
+    assert list(legs["route"]) == [None, "A", "A", None, "B", "B", None, None]
+    assert list(legs["from_node"]) == [1, 2, 10, 12, 3, 21, 22, 4]
+    assert list(legs["to_node"]) == [2, 10, 12, 3, 21, 22, 5, 5]
+    np.testing.assert_allclose(legs["travel_time"], [1, 5.5, 5, 0.5, 3.5, 4, 2.5, 2])
+    np.testing.assert_allclose(legs["wait"], [0, 300, 0, 0, 180, 0, 0, 0])
+    np.testing.assert_allclose(legs["distance"], [80, 10, 2500, 10, 10, 2000, 170, 160])
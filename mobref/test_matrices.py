@@ -0,0 +1,105 @@
+import os
+import random
+import numpy as np
+import pandas as pd
+import pytest
+from mobref.matrices import UNREACHABLE, MatrixStore, SparseMatrix
+from mobref.matrix_jobs import GridMatrixJob
+
+
+@pytest.fixture(scope="module")
+def network(geometric_network):
+    return geometric_network
+
+
+@pytest.fixture(scope="module")
+def pois(network):
+    # Area.random_points draws from the random module
+    random.seed(0)
+    return network.area.random_points(40)
+
+
+@pytest.fixture(scope="module")
+def matrices(network, pois):
+    matrices = network.get_matrices(pois)
+    assert (matrices["time"].values == UNREACHABLE).any()
+    return matrices
+
+
+def _expected(matrix):
+    values = np.asarray(matrix, dtype=float)
+    return np.where(values >= UNREACHABLE - 0.5, np.nan, np.rint(values))
+
+
+@pytest.mark.parametrize("time_dtype", ["uint16", "uint32"])
+def test_store_round_trip(tmp_path, matrices, time_dtype):
+    store = MatrixStore.from_matrices(str(tmp_path / "store"), matrices, time_dtype)
+    ids = matrices["time"].index
+    block = store.block(ids, ids)
+    for name in ("time", "distance"):
+        np.testing.assert_array_equal(block[name].values, _expected(matrices[name].values))
+    # pandana may return float32 lengths, whose UNREACHABLE is rounded up
+    as_float32 = {name: m.astype(np.float32) for name, m in matrices.items()}
+    store = MatrixStore.from_matrices(str(tmp_path / "float32"), as_float32, time_dtype)
+    assert np.isnan(store.block(ids, ids)["time"].values).sum() == \
+        (matrices["time"].values == UNREACHABLE).sum()
+
+
+def test_grid_job_merge(tmp_path, network, pois, matrices):
+    job = GridMatrixJob(network, str(tmp_path / "job"), origins=pois, shard_size=15)
+    assert job.run() == job.n_shards
+    store = job.merge()
+    block = store.block(pois.index, pois.index)
+    np.testing.assert_array_equal(np.isnan(block["time"].values), matrices["time"].values == UNREACHABLE)
+    reachable = matrices["time"].values != UNREACHABLE
+    np.testing.assert_allclose(block["time"].values[reachable], matrices["time"].values[reachable], atol=0.5)
+
+
+def test_sparse_round_trip(tmp_path, network, pois, matrices):
+    sparse = network.get_matrices(pois, maxtime=300)
+    path = str(tmp_path / "time.npz")
+    sparse["time"].save(path)
+    loaded = SparseMatrix.load(path)
+    dense = loaded.to_dense()
+    expected = matrices["time"].where(matrices["time"] <= 300)
+    np.testing.assert_allclose(dense.values, expected.values, rtol=1e-3, atol=0.05)
+    origin, destination = pois.index[0], pois.index[1]
+    assert np.isnan(loaded.get(origin, destination)) == np.isnan(expected.loc[origin, destination])
+    pd.testing.assert_series_equal(loaded.row(origin), dense.loc[origin].dropna(), check_names=False)
+
+
+def test_grid_job_locks(tmp_path, network, pois):
+    job = GridMatrixJob(network, str(tmp_path / "job"), origins=pois, shard_size=15, lock_timeout=60)
+    lock = job._lock_path(0)
+    with open(lock, "w") as file:
+        file.write("other worker")
+    # a lock held by another worker is left alone
+    assert job.run() == job.n_shards - 1
+    assert job.pending_shards() == [0]
+    with open(lock) as file:
+        assert file.read() == "other worker"
+    # an abandoned lock is stolen, then removed with the shard done
+    os.utime(lock, (0, 0))
+    assert job.run() == 1
+    assert job.is_complete() and not os.path.exists(lock)
+    # a restarted job must have the same points
+    with pytest.raises(ValueError):
+        GridMatrixJob(network, str(tmp_path / "job"), origins=pois.iloc[::-1], shard_size=15)
+
+
+def test_grid_job_time_dtype(tmp_path, network, pois, matrices):
+    job = GridMatrixJob(network, str(tmp_path / "job"), origins=pois, shard_size=15)
+    job.run()
+    assert job.merge().index["dtypes"]["time"] == "uint16"
+    # times beyond 18h12 fall back to uint32 instead of failing
+    with np.load(job.shard_path(1)) as shard:
+        shard = dict(shard)
+    slow = np.where(shard["time"] < UNREACHABLE, shard["time"] * 1000, shard["time"])
+    np.savez(job.shard_path(1), time=slow, distance=shard["distance"])
+    assert job.max_time() > 65535
+    with pytest.raises(ValueError):
+        job.merge("uint16")
+    store = job.merge()
+    assert store.index["dtypes"]["time"] == "uint32"
+    block = store.block(pois.index[15:30], pois.index)
+    np.testing.assert_array_equal(np.isnan(block["time"].values), slow == UNREACHABLE)
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+from mobref import synthetic
+from mobref.network import Network
+from mobref.profiles import profiles_from_factors
+from mobref.server import RoutingService
+
+
+@pytest.fixture(scope="module")
+def service(tmp_path_factory):
+    processed_path = str(tmp_path_factory.mktemp("server"))
+    nodes, edges = synthetic.grid_network(15)
+    area = synthetic.write_area(processed_path, nodes)
+    synthetic.write_network(processed_path, nodes, edges, "drive")
+    synthetic.write_network(processed_path, *synthetic.grid_network(15, mode="walk"), "walk")
+    drive = Network(area, "drive", processed_path)
+    walk = Network(area, "walk", processed_path)
+    # congestion halves the speeds at 8:00
+    factors = pd.DataFrame({8: [0.5], 9: [1.0]}, index=["default"])
+    drive.set_speed_profiles(profiles_from_factors(drive.edges, factors))
+    return RoutingService({"drive": drive, "walk": walk})
+
+
+def test_batch_route_hour(service):
+    points = service.networks["drive"].area.random_points(6)[["lon", "lat"]].values.tolist()
+    requests = [{"endpoint": "route", "origins": points[:3], "destinations": points[3:], "hour": 8},
+                {"endpoint": "route", "origins": points[3:5], "destinations": points[:2]},
+                {"endpoint": "route", "origins": points[:2], "destinations": points[4:], "hour": 8}]
+    responses = service.batch({"requests": requests})["responses"]
+    for request, response in zip(requests, responses):
+        assert response == service.route(request)
+    free_flow = service.route({**requests[0], "hour": None})
+    np.testing.assert_allclose(responses[0]["travel_time"], np.asarray(free_flow["travel_time"]) * 2, rtol=1e-3)
+
+
+def test_poi_caches_per_mode(service):
+    points = service.networks["drive"].area.random_points(10)[["lon", "lat"]].values.tolist()
+    drive = {"mode": "drive", "points": points, "pois": points[:4], "category": "shops", "time": 120}
+    counts = service.accessibility(drive)
+    del drive["pois"]
+    nearest = service.nearest({**drive, "maxtime": 300})
+    # new POIs of the same category on another mode leave the drive caches alone
+    service.accessibility({**drive, "mode": "walk", "pois": points[4:]})
+    assert list(service.aggregations["drive"]) == [("shops", 120)]
+    assert list(service.nearest_pois["drive"]) == [("shops", 300, 1)]
+    assert service.accessibility(drive) == counts
+    assert service.nearest({**drive, "maxtime": 300}) == nearest
+    # while new POIs of the drive category replace them
+    service.nearest({**drive, "pois": points[4:], "maxtime": 300})
+    assert list(service.aggregations["drive"]) == []
+
+
+def test_route_float_hour(service):
+    points = service.networks["drive"].area.random_points(4)[["lon", "lat"]].values.tolist()
+    request = {"origins": points[:2], "destinations": points[2:], "hour": 8}
+    assert service.route({**request, "hour": 8.0}) == service.route(request)
+    with pytest.raises(ValueError):
+        service.route({**request, "hour": 8.5})
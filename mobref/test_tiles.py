@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+import shapely
+from shapely.geometry import box
+from mobref import synthetic
+from mobref.network import Network
+from mobref.tiles import TiledArea, TiledNetwork
+
+
+@pytest.fixture(scope="module")
+def grid():
+    return synthetic.grid_network(30)
+
+
+@pytest.fixture(scope="module")
+def full_network(tmp_path_factory, grid):
+    processed_path = str(tmp_path_factory.mktemp("full"))
+    area = synthetic.write_area(processed_path, grid[0])
+    synthetic.write_network(processed_path, *grid, "drive")
+    return Network(area, "drive", processed_path)
+
+
+@pytest.fixture(scope="module")
+def tiled_area(tmp_path_factory, grid):
+    processed_path = str(tmp_path_factory.mktemp("tiled"))
+    nodes, edges = grid
+    x0, y0, x1, y1 = nodes.x.min() - 1e-4, nodes.y.min() - 1e-4, nodes.x.max() + 1e-4, nodes.y.max() + 1e-4
+    xm, ym = (x0 + x1) / 2, (y0 + y1) / 2
+    # one municipality, hence one tile, per quarter of the grid
+    municipalities = gpd.GeoDataFrame({"insee": ["1", "2", "3", "4"]}, crs=4326, geometry=[
+        box(x0, y0, xm, ym), box(xm, y0, x1, ym), box(x0, ym, xm, y1), box(xm, ym, x1, y1)])
+    municipalities.to_feather(f"{processed_path}/area.feather")
+    tiled_area = TiledArea(processed_path, None, None, tile_size=2000, buffer=600)
+    # the networks of the tiles are cut from the grid, as if read from a PBF
+    for tile in tiled_area.tiles.index:
+        inside = shapely.contains_xy(tiled_area.tiles.loc[tile, "buffered"], nodes.x.values, nodes.y.values)
+        tile_nodes = nodes[inside]
+        tile_edges = edges[edges["from_int"].isin(tile_nodes.index) & edges["to_int"].isin(tile_nodes.index)]
+        tiled_area.tile_area(tile)
+        synthetic.write_network(tiled_area.tile_path(tile), tile_nodes, tile_edges, "drive")
+    return tiled_area
+
+
+@pytest.fixture(scope="module")
+def pois(grid):
+    nodes = grid[0]
+    rng = np.random.default_rng(1)
+    return pd.DataFrame({"lon": rng.uniform(nodes.x.min(), nodes.x.max(), 50),
+                         "lat": rng.uniform(nodes.y.min(), nodes.y.max(), 50)})
+
+
+def test_tiled_matrices(tiled_area, full_network, pois):
+    network = TiledNetwork(tiled_area, "drive", workers=1)
+    assert len(network.tiles) == 4
+    pois_tiles = tiled_area.locate(pois.lon, pois.lat)
+    same_tile = pois_tiles[:, None] == pois_tiles[None, :]
+    assert same_tile.any() and (~same_tile).any()
+    matrices = network.get_matrices(pois)
+    nodes = full_network.pdn.get_node_ids(pois.lon, pois.lat).values
+    for key, impedence in (("time", "weight"), ("distance", "length")):
+        expected = full_network.get_nodes_matrix(nodes, nodes, impedence, backend="csr")
+        np.testing.assert_allclose(matrices[key].values[same_tile], expected[same_tile], rtol=1e-6)
+        np.testing.assert_allclose(matrices[key].values[~same_tile], expected[~same_tile], rtol=1e-6)
+
+
+def test_tiled_accessibility(tiled_area, full_network, pois):
+    network = TiledNetwork(tiled_area, "drive", workers=1)
+    # counts are exact as long as the time limit keeps trips within the buffer
+    accessibility = network.get_accessibility(pois, time=30)
+    expected = full_network.get_accessibility(pois, time=30)
+    assert accessibility.index.sort_values().equals(expected.index.sort_values())
+    pd.testing.assert_series_equal(accessibility.sort_index(), expected.reindex(accessibility.index).sort_index(),
+                                   check_names=False, check_dtype=False)
+
+
+def test_overlay_cache(tiled_area, grid):
+    ids, overlay = TiledNetwork(tiled_area, "drive", workers=1).overlay()
+    # a tile network built again invalidates the overlay cached on disk
+    tile = tiled_area.tiles.index[0]
+    path = f"{tiled_area.tile_path(tile)}/drive.pkl"
+    nodes, edges = pd.read_pickle(path).values()
+    synthetic.write_network(tiled_area.tile_path(tile), nodes, edges.assign(weight=edges["weight"] * 2), "drive")
+    rebuilt_ids, rebuilt = TiledNetwork(tiled_area, "drive", workers=1).overlay()
+    assert rebuilt_ids.equals(ids)
+    assert rebuilt.sum() > overlay.sum()
@@ -0,0 +1,56 @@
+import pandas as pd
+import pytest
+from mobref import synthetic
+from mobref.network import Network
+
+WALK_COLUMNS = ["from_int", "to_int", "weight", "distance"]
+
+
+def _transit_network(processed_path, walk, seed):
+    nodes, edges = walk
+    area = synthetic.write_area(processed_path, nodes)
+    synthetic.write_network(processed_path, nodes, edges, "walk")
+    gtfs_path = f"{processed_path}/gtfs"
+    synthetic.write_gtfs(gtfs_path, nodes, n_routes=4, stops_per_route=8, seed=seed)
+    return Network(area, "transit", processed_path, gtfs_path)
+
+
+def _walk_layer(network):
+    edges = network.edges[network.edges["net_type"] == "walk"]
+    return edges[WALK_COLUMNS].sort_values(WALK_COLUMNS).reset_index(drop=True)
+
+
+def _labelled(network):
+    # a full build and an update number the transit nodes differently, compare their GTFS ids
+    ids = network.nodes["id"].astype(str)
+    edges = network.edges.assign(from_id=ids.reindex(network.edges["from_int"]).values,
+                                 to_id=ids.reindex(network.edges["to_int"]).values)
+    return edges.drop(columns=["from_int", "to_int"]).sort_values(["from_id", "to_id", "weight"]) \
+        .reset_index(drop=True)
+
+
+@pytest.fixture(scope="module")
+def walk():
+    return synthetic.grid_network(12, mode="walk")
+
+
+@pytest.fixture(scope="module")
+def rebuilt(tmp_path_factory, walk):
+    return _transit_network(str(tmp_path_factory.mktemp("rebuilt")), walk, seed=1)
+
+
+def test_update_transit(tmp_path_factory, walk, rebuilt):
+    network = _transit_network(str(tmp_path_factory.mktemp("updated")), walk, seed=0)
+    walk_edges = _walk_layer(network)
+    walk_nodes = network.nodes[network.nodes["id"].astype(str).isin(walk[0].index.astype(str))]
+    assert len(walk_nodes) == len(walk[0])
+    old_transit = _labelled(network).query("net_type == 'transit'")
+    network.update_transit(f"{rebuilt.processed_path}/gtfs")
+    # the walk layer and its node ids are kept
+    pd.testing.assert_frame_equal(_walk_layer(network), walk_edges)
+    pd.testing.assert_frame_equal(network.nodes.loc[walk_nodes.index], walk_nodes)
+    # the transit layer is the one of a full build on the new feed
+    updated = _labelled(network)
+    assert not updated.query("net_type == 'transit'").equals(old_transit)
+    pd.testing.assert_frame_equal(updated, _labelled(rebuilt), check_like=True)
+
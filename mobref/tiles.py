@@ -0,0 +1,430 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from mobref import instrument
+from mobref.area import Area
+from mobref.network import Network
+from mobref.matrices import UNREACHABLE
+from mobref.csr_routing import _dijkstra
+from mobref.pbf import clear_cache
+
+
+class TiledArea():
+
+    def __init__(self, processed_path, municipalities_path, administrative_cutting_path, tile_size=10000, buffer=2000):
+        """
+        Partition the municipalities of an area into square tiles, each one with an overlap buffer.
+
+        Every municipality goes to the tile of its centroid. The core of a tile is the
+        union of its municipalities, and the area of its network is this core grown by
+        the buffer, so that trips starting in a tile and ending close to it stay in its
+        network. Tiles are saved under processed_path, one directory per tile.
+
+        Args:
+        processed_path (str): Path to processed data.
+        municipalities_path (str): Path to municipalities data.
+        administrative_cutting_path (str): Path to administrative cutting.
+        tile_size (float, optional): Side of the tiles in meters. Defaults to 10000.
+        buffer (float, optional): Width of the overlap around each tile in meters. Defaults to 2000.
+        """
+        self.processed_path = processed_path
+        self.area = Area(processed_path, municipalities_path, administrative_cutting_path)
+        self.tile_size = tile_size
+        self.buffer = buffer
+        self.tiles_path = f"{processed_path}/tiles_{tile_size:g}_{buffer:g}"
+        self.make_tiles()
+        self.tree = shapely.STRtree(self.tiles.geometry.values)
+
+    def make_tiles(self):
+        """
+        Load or compute the tiles, stored in `self.tiles` as a GeoDataFrame indexed by tile
+        with the 'insee' codes of its municipalities, its core geometry and its 'buffered' geometry.
+        """
+        path = f"{self.tiles_path}/tiles.feather"
+        if os.path.exists(path):
+            tiles = gpd.read_feather(path)
+        else:
+            with instrument.stage("area.tiles", tile_size=self.tile_size) as record:
+                municipalities = self.area.gdf.to_crs(self.area.gdf.estimate_utm_crs())
+                centroids = municipalities.geometry.centroid
+                keys = pd.DataFrame({"i": np.floor((centroids.x - centroids.x.min()) / self.tile_size),
+                                     "j": np.floor((centroids.y - centroids.y.min()) / self.tile_size)})
+                tile = keys.groupby(["i", "j"]).ngroup().values
+                core = municipalities.geometry.groupby(tile).agg(shapely.union_all)
+                tiles = gpd.GeoDataFrame(
+                    {"insee": municipalities["insee"].astype(str).groupby(tile).agg(",".join)},
+                    geometry=gpd.GeoSeries(core, crs=municipalities.crs).to_crs(4326))
+                tiles["buffered"] = gpd.GeoSeries(core.buffer(self.buffer), crs=municipalities.crs).to_crs(4326)
+                tiles.index.name = "tile"
+                os.makedirs(self.tiles_path, exist_ok=True)
+                tiles.to_feather(path)
+                record["rows"] = len(tiles)
+        self.tiles = tiles
+
+    def tile_path(self, tile):
+        return f"{self.tiles_path}/{tile}"
+
+    def tile_area(self, tile):
+        """
+        Area of the network of a tile: the municipalities of the region clipped to the buffered tile.
+
+        Args:
+        tile (int): Tile id.
+
+        Returns:
+        Area: Area object, saved in the directory of the tile.
+        """
+        gdf = gpd.clip(self.area.gdf.to_crs(4326), self.tiles.loc[tile, "buffered"])
+        return Area.from_gdf(self.tile_path(tile), gdf)
+
+    def locate(self, lon, lat):
+        """
+        Tile whose core contains each point, the closest one for points outside every tile.
+
+        Args:
+        lon (array-like): Longitudes.
+        lat (array-like): Latitudes.
+
+        Returns:
+        numpy.ndarray: Tile id of every point.
+        """
+        points = shapely.points(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+        found = np.full(len(points), -1)
+        point, tile = self.tree.query(points, predicate="within")
+        # points on the border of two tiles keep the first one
+        found[point[::-1]] = tile[::-1]
+        missing = np.flatnonzero(found < 0)
+        if len(missing):
+            point, tile = self.tree.query_nearest(points[missing])
+            found[missing[point]] = tile
+        return self.tiles.index.values[found]
+
+
+def _build_tile(tiled_area, tile, mode, pbf_path, dem_path):
+    # the network is only built for its cache, workers never send it back
+    Network(tiled_area.tile_area(tile), mode, tiled_area.tile_path(tile), None, pbf_path, dem_path)
+    # workers run several tiles before Python 3.11
+    clear_cache()
+    return tile
+
+
+def _tile_accessibility(tiled_area, tile, mode, pois, time):
+    network = Network(tiled_area.tile_area(tile), mode, tiled_area.tile_path(tile))
+    inside = shapely.contains_xy(tiled_area.tiles.loc[tile, "buffered"], pois.lon.values, pois.lat.values)
+    accessibility = network.get_accessibility(pois[inside], time)
+    # nodes of the buffer are counted by the tile they belong to
+    nodes = network.nodes.reindex(accessibility.index)
+    core = shapely.contains_xy(tiled_area.tiles.geometry[tile], nodes.x.values, nodes.y.values)
+    return accessibility[core]
+
+
+def _isolated_pool(workers):
+    """
+    Pool of processes running one task each, so that the memory of a tile goes back
+    to the system. Before Python 3.11, processes are reused for several tasks.
+    """
+    if sys.version_info >= (3, 11):
+        # forces the spawn start method
+        return ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=1)
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def _min_plus(a, b, chunk_size=2**24):
+    """
+    Min-plus product of two matrices, by chunks of rows to bound the memory used.
+    """
+    res = np.empty((a.shape[0], b.shape[1]))
+    rows = max(1, chunk_size // max(1, a.shape[1] * b.shape[1]))
+    for start in range(0, a.shape[0], rows):
+        res[start:start + rows] = np.min(a[start:start + rows, :, None] + b[None, :, :], axis=1, initial=np.inf)
+    return res
+
+
+class TiledNetwork():
+
+    def __init__(self, tiled_area, mode, pbf_path=None, dem_path=None, max_loaded=2, workers=None):
+        """
+        Street network of a TiledArea, made of one network per tile.
+
+        Tile networks are built and cached in parallel worker processes, each process
+        building one tile at a time, then loaded on demand, at most max_loaded at once.
+        Queries between two points of the same tile, or of its buffer, are answered by
+        the network of the tile. Longer trips are stitched through the boundary nodes of
+        the tiles, the nodes of the edges crossing their borders: the cost between any
+        two boundary nodes of a tile is computed once in its network, which gives an
+        overlay graph covering the whole region (see overlay).
+
+        Stitching matches the nodes of the tiles on their OSM ids, so transit, whose
+        node ids are numbered per network, cannot be tiled.
+
+        Builds and accessibility start a fresh worker process per tile with the spawn
+        start method, so scripts using several workers need an
+        `if __name__ == "__main__":` guard. Matrix queries share one pool of worker
+        processes, kept until close is called.
+
+        Args:
+        tiled_area (TiledArea): Tiles of the area.
+        mode (str): Mode of transportation (drive, bike, or walk).
+        pbf_path, dem_path: See Network. With a pbf_path, every tile is read
+        from the extract, within its own bounding box.
+        max_loaded (int, optional): Maximum number of tile networks kept in memory. Defaults to 2.
+        workers (int, optional): Number of worker processes, 1 runs everything in this
+        process. Defaults to the number of CPUs.
+        """
+        if mode == "transit":
+            raise ValueError("Transit networks cannot be tiled, their node ids differ between tiles")
+        self.tiled_area = tiled_area
+        self.mode = mode
+        self.pbf_path = pbf_path
+        self.dem_path = dem_path
+        self.max_loaded = max_loaded
+        self.workers = workers or os.cpu_count()
+        self.loaded = OrderedDict()
+        self.boundaries = {}
+        self.overlays = {}
+        self.executor = None
+        self.build()
+
+    @property
+    def tiles(self):
+        return self.tiled_area.tiles.index
+
+    def build(self):
+        """
+        Build and cache the networks of the tiles that have none yet.
+        """
+        missing = [t for t in self.tiles
+                   if not os.path.exists(f"{self.tiled_area.tile_path(t)}/{self.mode}.pkl")]
+        if not missing:
+            return
+        with instrument.stage("tiles.build", mode=self.mode, tiles=len(missing)) as record:
+            args = [(self.tiled_area, t, self.mode, self.pbf_path, self.dem_path) for t in missing]
+            if self.workers > 1 and len(missing) > 1:
+                # a fresh process per tile gives its memory back to the system
+                with _isolated_pool(self.workers) as executor:
+                    for tile in executor.map(_build_tile, *zip(*args)):
+                        instrument.log(f"Tile {tile} {self.mode} network built")
+            else:
+                for arg in args:
+                    _build_tile(*arg)
+            record["rows"] = len(missing)
+
+    def close(self):
+        """
+        Shut down the worker processes of the matrix queries.
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def _dijkstra(self, network, impedence, orig_nodes, dest_nodes):
+        """
+        Shortest path costs between nodes of a tile network, inf when unreachable, computed
+        in the pool of the matrix queries so that tiles run concurrently.
+
+        Returns:
+        concurrent.futures.Future: (len(orig_nodes), len(dest_nodes)) costs.
+        """
+        router = network.get_router(impedence)
+        args = (router.matrix, router.positions(orig_nodes), router.positions(dest_nodes), np.inf, np.float64)
+        if self.workers == 1:
+            future = Future()
+            future.set_result(_dijkstra(*args))
+            return future
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self.executor.submit(_dijkstra, *args)
+
+    def stamps(self):
+        """
+        Size and modification time of the cached network of every tile, which tell
+        if the overlays cached on disk were computed on the current tile networks.
+
+        Returns:
+        numpy.ndarray: (n_tiles, 2) stamps.
+        """
+        stats = [os.stat(f"{self.tiled_area.tile_path(t)}/{self.mode}.pkl") for t in self.tiles]
+        return np.array([(s.st_size, s.st_mtime_ns) for s in stats], dtype=np.int64).reshape(-1, 2)
+
+    def network(self, tile):
+        """
+        Network of a tile, loaded from its cache, the least recently used one being released
+        when more than max_loaded networks are in memory.
+        """
+        if tile in self.loaded:
+            self.loaded.move_to_end(tile)
+        else:
+            self.loaded[tile] = Network(self.tiled_area.tile_area(tile), self.mode, self.tiled_area.tile_path(tile),
+                                        None, self.pbf_path, self.dem_path)
+            while len(self.loaded) > self.max_loaded:
+                self.loaded.popitem(last=False)
+        return self.loaded[tile]
+
+    def boundary(self, tile):
+        """
+        Boundary nodes of a tile: both ends of the edges of its network crossing the border of its core.
+
+        Returns:
+        numpy.ndarray: Node ids.
+        """
+        if tile not in self.boundaries:
+            network = self.network(tile)
+            nodes, edges = network.nodes, network.edges
+            core = self.tiled_area.tiles.geometry[tile]
+            inside = pd.Series(shapely.contains_xy(core, nodes.x.values, nodes.y.values), index=nodes.index)
+            edges = edges[edges["from_int"].isin(nodes.index) & edges["to_int"].isin(nodes.index)]
+            crossing = inside[edges["from_int"]].values != inside[edges["to_int"]].values
+            self.boundaries[tile] = np.unique(np.r_[edges["from_int"].values[crossing],
+                                                    edges["to_int"].values[crossing]])
+        return self.boundaries[tile]
+
+    def overlay(self, impedence="weight"):
+        """
+        Overlay graph of the boundary nodes, where every tile links each of its boundary
+        nodes to the other ones with their shortest path cost in its network.
+
+        The overlay is computed tile by tile and cached next to the tiles, until one
+        of the tile networks is built again.
+
+        Args:
+        impedence (str, optional): Edge attribute used as impedance. Defaults to "weight".
+
+        Returns:
+        pandas.Index, scipy.sparse.csr_matrix: Boundary node ids and the overlay graph between them.
+        """
+        if impedence in self.overlays:
+            return self.overlays[impedence]
+        path = f"{self.tiled_area.tiles_path}/{self.mode}_overlay_{impedence}.npz"
+        stamps = self.stamps()
+        cached = None
+        if os.path.exists(path):
+            with np.load(path) as cache:
+                if "stamps" in cache.files and np.array_equal(cache["stamps"], stamps):
+                    cached = cache["ids"], cache["u"], cache["v"], cache["w"]
+        if cached is not None:
+            ids, u, v, w = pd.Index(cached[0]), *cached[1:]
+        else:
+            with instrument.stage("tiles.overlay", mode=self.mode, impedence=impedence) as record:
+                futures = []
+                for tile in self.tiles:
+                    boundary = self.boundary(tile)
+                    futures.append((boundary, self._dijkstra(self.network(tile), impedence, boundary, boundary)))
+                links = []
+                for boundary, future in futures:
+                    costs = future.result()
+                    i, j = np.nonzero(np.isfinite(costs) & ~np.eye(len(boundary), dtype=bool))
+                    links.append(pd.DataFrame({"u": boundary[i], "v": boundary[j], "w": costs[i, j]}))
+                # tiles sharing a pair of nodes keep the cheapest link
+                links = pd.concat(links).groupby(["u", "v"], as_index=False)["w"].min()
+                ids = pd.Index(np.unique(np.r_[links["u"].values, links["v"].values]))
+                u, v, w = ids.get_indexer(links["u"]), ids.get_indexer(links["v"]), links["w"].values
+                np.savez(path, ids=ids.values, u=u, v=v, w=w, stamps=stamps)
+                record["rows"] = len(links)
+        self.overlays[impedence] = ids, csr_matrix((w, (u, v)), shape=(len(ids), len(ids)))
+        return self.overlays[impedence]
+
+    def get_matrix(self, pois, impedence="weight"):
+        """
+        Computes the matrix of shortest path costs between POIs across the tiles.
+
+        A pair is routed in the network of the origin tile when the destination lies in
+        its buffered area, and stitched through the overlay otherwise, keeping the cheapest
+        of both. Stitched costs are exact when the shortest paths between boundary nodes
+        stay within the buffers.
+
+        Args:
+        pois (DataFrame): DataFrame containing POI locations with columns 'lon' and 'lat'.
+        impedence (str, optional): Edge attribute used as impedance. Defaults to "weight".
+
+        Returns:
+        DataFrame: Matrix of costs between POIs, unreachable pairs are set to UNREACHABLE.
+        """
+        with instrument.stage("query.tiled_matrix", mode=self.mode, impedence=impedence) as record:
+            lon, lat = pois.lon.values, pois.lat.values
+            pois_tiles = self.tiled_area.locate(lon, lat)
+            used = np.unique(pois_tiles)
+            res = np.full((len(pois), len(pois)), np.inf)
+            ids, overlay = self.overlay(impedence)
+            futures = {}
+            for tile in used:
+                network = self.network(tile)
+                members = np.flatnonzero(pois_tiles == tile)
+                # POIs outside every tile are routed from the closest one
+                near = np.union1d(members, np.flatnonzero(
+                    shapely.contains_xy(self.tiled_area.tiles.loc[tile, "buffered"], lon, lat)))
+                nodes = network.pdn.get_node_ids(lon[near], lat[near]).values
+                origins = nodes[np.searchsorted(near, members)]
+                boundary = self.boundary(tile)
+                futures[tile] = (members, near,
+                                 self._dijkstra(network, impedence, origins, np.r_[nodes, boundary]),
+                                 self._dijkstra(network, impedence, boundary, origins))
+            to_boundary, from_boundary = {}, {}
+            for tile, (members, near, outgoing, incoming) in futures.items():
+                costs = outgoing.result()
+                res[np.ix_(members, near)] = costs[:, :len(near)]
+                to_boundary[tile] = costs[:, len(near):]
+                from_boundary[tile] = incoming.result()
+            for tile in used:
+                # boundary nodes of a tile that no other tile reaches are not in the overlay
+                sources = self.boundary(tile)
+                known = ids.get_indexer(sources) >= 0
+                between = dijkstra(overlay, indices=ids.get_indexer(sources[known]))
+                origins = np.flatnonzero(pois_tiles == tile)
+                via = _min_plus(to_boundary[tile][:, known], between)
+                # pairs of the same tile may also be shorter through the overlay, out of its buffer
+                for other in used:
+                    targets = ids.get_indexer(self.boundary(other))
+                    reached = targets >= 0
+                    stitched = _min_plus(via[:, targets[reached]], from_boundary[other][reached])
+                    block = np.ix_(origins, np.flatnonzero(pois_tiles == other))
+                    res[block] = np.minimum(res[block], stitched)
+            res[np.isinf(res)] = UNREACHABLE
+            record["rows"] = res.size
+        return pd.DataFrame(res, index=pois.index, columns=pois.index)
+
+    def get_matrices(self, pois):
+        """
+        Computes matrices of travel times and distances between POIs across the tiles, see get_matrix.
+
+        Returns:
+        dict: A dictionary containing the following keys:
+        - "time" (DataFrame): Matrix of travel times between POIs.
+        - "distance" (DataFrame): Matrix of distances between POIs.
+        """
+        return {"time": self.get_matrix(pois, "weight"), "distance": self.get_matrix(pois, "length")}
+
+    def get_accessibility(self, pois, time=300):
+        """
+        Counts the POIs within the given time limit from each node of the region, tile by tile.
+
+        Each tile counts, from the nodes of its core, the POIs of its buffered area, in a
+        worker process that only holds the network of this tile. Counts are exact when
+        the buffer is wider than the distance travelled in the time limit.
+
+        Args:
+        pois (DataFrame): DataFrame containing POI locations with columns 'lon' and 'lat'.
+        time (int, optional): Maximum travel time in seconds. Defaults to 300.
+
+        Returns:
+        Series: Number of POIs reachable from each node, indexed by node id.
+        """
+        with instrument.stage("query.tiled_accessibility", mode=self.mode, tiles=len(self.tiles)) as record:
+            pois = pd.DataFrame({"lon": pois.lon.values, "lat": pois.lat.values})
+            args = [(self.tiled_area, t, self.mode, pois, time) for t in self.tiles]
+            if self.workers > 1 and len(args) > 1:
+                with _isolated_pool(self.workers) as executor:
+                    parts = list(executor.map(_tile_accessibility, *zip(*args)))
+            else:
+                parts = [_tile_accessibility(*arg) for arg in args]
+            accessibility = pd.concat(parts)
+            # nodes on the border of two tiles are counted once
+            accessibility = accessibility[~accessibility.index.duplicated()]
+            record["rows"] = len(accessibility)
+        return accessibility
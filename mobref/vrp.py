@@ -1,7 +1,93 @@
 import vroom
+import os
+import time
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from mobref.network import UNREACHABLE
+from mobref import instrument
 
-def solve_vrp(network, vehicles, jobs):
+
+def to_vroom_matrix(matrix):
+    """
+    Convert a matrix of pandana shortest path lengths into a VROOM cost matrix.
+
+    Costs are rounded to integers and unreachable pairs are capped so that the
+    cost of any route visiting every location still fits in VROOM's uint32 costs.
+
+    Args:
+        matrix (numpy.ndarray): Square matrix of travel times (seconds) or distances (meters).
+
+    Returns:
+        numpy.ndarray: Contiguous uint32 matrix.
+    """
+    cap = np.iinfo(np.uint32).max // max(len(matrix), 1)
+    matrix = np.where(matrix >= UNREACHABLE, cap, np.rint(matrix))
+    return np.ascontiguousarray(np.minimum(matrix, cap), dtype=np.uint32)
+
+
+def get_vrp_matrices(network, pois, distances=False, hour=None):
+    """
+    Compute the integer cost matrices needed by VROOM between locations.
+
+    Only the travel time matrix is computed unless distances are requested, in
+    which case the length impedance network of the Network is used as well.
+
+    Args:
+        network: Network object representing the transportation network.
+        pois (pandas.DataFrame): DataFrame containing locations with columns 'lon' and 'lat'.
+        distances (bool, optional): If True, also compute the distance matrix. Default is False.
+        hour (int, optional): Departure hour of the drive speed profiles, see
+            Network.set_speed_profiles. Defaults to None, the free flow travel times.
+
+    Returns:
+        dict: A dictionary containing the following keys:
+        - "durations" (numpy.ndarray): uint32 matrix of travel times in seconds.
+        - "distances" (numpy.ndarray): uint32 matrix of distances in meters, or None.
+    """
+    nodes = network.pdn.get_node_ids(pois.lon, pois.lat).values
+    durations = network.get_nodes_matrix(nodes, nodes, impedence=network.impedence_at(hour))
+    matrices = {"durations": to_vroom_matrix(durations),
+                "distances": None}
+    if distances:
+        matrices["distances"] = to_vroom_matrix(network.get_nodes_matrix(nodes, nodes,
+                                                                         impedence="length"))
+    return matrices
+
+
+def build_problem(durations, vehicles_locations, jobs_locations, distances=None,
+                  vehicles_ids=None, jobs_ids=None, profile="car"):
+    """
+    Build a VROOM problem from cost matrices and location indices.
+
+    Args:
+        durations (numpy.ndarray): uint32 matrix of travel times between locations.
+        vehicles_locations (array-like): Matrix index of the start (and end) location of each vehicle.
+        jobs_locations (array-like): Matrix index of the location of each job.
+        distances (numpy.ndarray, optional): uint32 matrix of distances between locations. Default is None.
+        vehicles_ids (array-like, optional): Vehicle ids, defaults to their rank.
+        jobs_ids (array-like, optional): Job ids, defaults to their rank.
+        profile (str, optional): VROOM profile name. Default is "car".
+
+    Returns:
+        vroom.Input: Problem instance ready to be solved.
+    """
+    if vehicles_ids is None:
+        vehicles_ids = range(len(vehicles_locations))
+    if jobs_ids is None:
+        jobs_ids = range(len(jobs_locations))
+    problem_instance = vroom.Input()
+    problem_instance.set_durations_matrix(profile=profile, matrix_input=durations)
+    if distances is not None:
+        problem_instance.set_distances_matrix(profile=profile, matrix_input=distances)
+    problem_instance.add_vehicle([vroom.Vehicle(int(i), start=int(l), end=int(l), profile=profile)
+                                  for i, l in zip(vehicles_ids, vehicles_locations)])
+    problem_instance.add_job([vroom.Job(int(i), location=int(l))
+                              for i, l in zip(jobs_ids, jobs_locations)])
+    return problem_instance
+
+
+def solve_vrp(network, vehicles, jobs, distances=False, exploration_level=5, nb_threads=4, hour=None):
     """
     Solve the Vehicle Routing Problem (VRP) for a given network, vehicles, and jobs.
 
@@ -9,24 +95,263 @@ def solve_vrp(network, vehicles, jobs):
         network: Network object representing the transportation network.
         vehicles (pandas.DataFrame): DataFrame containing vehicle information.
         jobs (pandas.DataFrame): DataFrame containing job (delivery point) information.
+        distances (bool, optional): If True, also give VROOM the distance matrix so that
+            routes report distances. Default is False.
+        exploration_level (int, optional): VROOM exploration level, between 1 and 5. Default is 5.
+        nb_threads (int, optional): Number of threads used by VROOM. Default is 4.
+        hour (int, optional): Departure hour of the drive speed profiles. Defaults to None, the free flow travel times.
 
     Returns:
         vroom.Solution: Solution object containing the optimized VRP solution.
     """
-    jobs["id"] = ["job_" + str(i) for i in range(len(jobs))]
-    vehicles["id"] = ["vehicle_" + str(i) for i in range(len(vehicles))]
     pois = pd.concat([jobs, vehicles])
     pois.index = pd.RangeIndex(start=0, stop=len(pois), step=1)
-    matrix = network.get_matrices(pois)["time"]
-    problem_instance = vroom.Input()
-    problem_instance.set_durations_matrix(profile="car",
-                                          matrix_input=matrix.values.tolist())
-    for index, v in pois.iterrows():
-        type, n = v.id.split("_")
-        n = int(n)
-        if type == "vehicle":
-            problem_instance.add_vehicle([vroom.Vehicle(n, start=index, end=index)])
-        elif type == "job":
-            problem_instance.add_job([vroom.Job(n, location=index)])
-    solution = problem_instance.solve(exploration_level=5, nb_threads=4)
+    with instrument.stage("vrp.matrices", mode=network.mode) as record:
+        matrices = get_vrp_matrices(network, pois, distances=distances, hour=hour)
+        record["rows"] = len(pois)**2
+    with instrument.stage("vrp.solve", mode=network.mode) as record:
+        problem_instance = build_problem(matrices["durations"],
+                                         np.arange(len(jobs), len(pois)),
+                                         np.arange(len(jobs)),
+                                         distances=matrices["distances"])
+        solution = problem_instance.solve(exploration_level=exploration_level, nb_threads=nb_threads)
+        record["rows"] = len(jobs)
     return solution
+
+
+def _kmeans(points, k, iterations=20):
+    """
+    Minimal k-means used to group vehicles, seeded with evenly spaced points.
+
+    Args:
+        points (numpy.ndarray): (n, 2) array of coordinates.
+        k (int): Number of clusters.
+        iterations (int, optional): Number of Lloyd iterations. Default is 20.
+
+    Returns:
+        numpy.ndarray: Cluster label of each point.
+    """
+    centers = points[np.linspace(0, len(points) - 1, k).astype(int)]
+    for _ in range(iterations):
+        labels = ((points[:, None, :] - centers[None, :, :])**2).sum(axis=2).argmin(axis=1)
+        for c in range(k):
+            if (labels == c).any():
+                centers[c] = points[labels == c].mean(axis=0)
+    return labels
+
+
+def cluster_jobs(network, vehicles, jobs, n_clusters, method="spatial", hour=None):
+    """
+    Partition vehicles and jobs into independent sub-problems.
+
+    Vehicles are grouped into n_clusters with k-means on their locations, then
+    each job joins the cluster of its closest vehicle, either as the crow flies
+    ("spatial") or by network travel time ("time", which only needs a
+    vehicles x jobs matrix).
+
+    Args:
+        network: Network object representing the transportation network.
+        vehicles (pandas.DataFrame): DataFrame containing vehicle locations with columns 'lon' and 'lat'.
+        jobs (pandas.DataFrame): DataFrame containing job locations with columns 'lon' and 'lat'.
+        n_clusters (int): Number of clusters, capped by the number of vehicles.
+        method (str, optional): "spatial" or "time". Default is "spatial".
+        hour (int, optional): Departure hour of the drive speed profiles. Defaults to None, the free flow travel times.
+
+    Returns:
+        numpy.ndarray, numpy.ndarray: Cluster label of each vehicle and of each job.
+    """
+    scale = np.cos(np.radians(vehicles.lat.mean()))
+    v_xy = np.column_stack([vehicles.lon.values * scale, vehicles.lat.values])
+    j_xy = np.column_stack([jobs.lon.values * scale, jobs.lat.values])
+    vehicles_labels = _kmeans(v_xy.copy(), min(n_clusters, len(vehicles)))
+    if method == "spatial":
+        cost = ((j_xy[None, :, :] - v_xy[:, None, :])**2).sum(axis=2)
+    elif method == "time":
+        v_nodes = network.pdn.get_node_ids(vehicles.lon, vehicles.lat).values
+        j_nodes = network.pdn.get_node_ids(jobs.lon, jobs.lat).values
+        cost = network.get_nodes_matrix(v_nodes, j_nodes, impedence=network.impedence_at(hour))
+    else:
+        raise ValueError(f"Unknown clustering method {method}")
+    jobs_labels = vehicles_labels[cost.argmin(axis=0)]
+    return vehicles_labels, jobs_labels
+
+
+def _solve_problem(durations, vehicles_locations, jobs_locations, vehicles_ids, jobs_ids,
+                   exploration_level, nb_threads):
+    """
+    Solve one sub-problem, run in a worker process.
+
+    Returns:
+        pandas.DataFrame, int: Routes and total cost of the sub-problem.
+    """
+    problem_instance = build_problem(durations, vehicles_locations, jobs_locations,
+                                     vehicles_ids=vehicles_ids, jobs_ids=jobs_ids)
+    solution = problem_instance.solve(exploration_level=exploration_level, nb_threads=nb_threads)
+    return solution.routes, solution.summary.cost
+
+
+def solve_vrp_clustered(network, vehicles, jobs, n_clusters=None, max_cluster_size=1000,
+                        method="spatial", exploration_level=5, nb_threads=1, workers=None, hour=None):
+    """
+    Solve a large VRP by cluster-first decomposition.
+
+    Jobs are partitioned around the vehicles (see cluster_jobs), the travel time
+    matrix of each cluster is computed on its own, and the sub-problems are
+    solved in parallel worker processes before their routes are merged. Only
+    the per-cluster matrices are ever built, so memory grows with the square of
+    the cluster size instead of the total number of jobs. Routes never cross
+    cluster boundaries, so the solution can be worse than the monolithic one.
+
+    Args:
+        network: Network object representing the transportation network.
+        vehicles (pandas.DataFrame): DataFrame containing vehicle information.
+        jobs (pandas.DataFrame): DataFrame containing job (delivery point) information.
+        n_clusters (int, optional): Number of clusters. Defaults to enough clusters to
+            keep about max_cluster_size jobs per cluster.
+        max_cluster_size (int, optional): Target number of jobs per cluster. Default is 1000.
+        method (str, optional): Job assignment, "spatial" or "time". Default is "spatial".
+        exploration_level (int, optional): VROOM exploration level, between 1 and 5. Default is 5.
+        nb_threads (int, optional): Number of VROOM threads per sub-problem. Default is 1.
+        workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+        hour (int, optional): Departure hour of the drive speed profiles. Defaults to None, the free flow travel times.
+
+    Returns:
+        dict: A dictionary containing the following keys:
+        - "routes" (DataFrame): Merged routes, job and vehicle ids and location indices
+          numbered as in solve_vrp (jobs first, then vehicles).
+        - "cost" (int): Total cost of the merged solution.
+        - "unassigned" (list): Ids of the jobs left unassigned.
+        - "clusters" (numpy.ndarray): Cluster label of each job.
+    """
+    if n_clusters is None:
+        n_clusters = int(np.ceil(len(jobs) / max_cluster_size))
+    impedence = network.impedence_at(hour)
+    vehicles_labels, jobs_labels = cluster_jobs(network, vehicles, jobs, n_clusters, method, hour)
+    nodes = network.pdn.get_node_ids(pd.concat([jobs.lon, vehicles.lon]),
+                                     pd.concat([jobs.lat, vehicles.lat])).values
+    futures = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for c in np.unique(vehicles_labels):
+            jobs_ids = np.flatnonzero(jobs_labels == c)
+            vehicles_ids = np.flatnonzero(vehicles_labels == c)
+            if len(jobs_ids) == 0:
+                continue
+            # location indices of the cluster, jobs first then vehicles
+            locations = np.concatenate([jobs_ids, len(jobs) + vehicles_ids])
+            durations = to_vroom_matrix(network.get_nodes_matrix(nodes[locations], nodes[locations],
+                                                                 impedence=impedence))
+            future = executor.submit(_solve_problem, durations,
+                                     np.arange(len(jobs_ids), len(locations)),
+                                     np.arange(len(jobs_ids)),
+                                     vehicles_ids, jobs_ids, exploration_level, nb_threads)
+            futures.append((future, locations))
+        routes = []
+        cost = 0
+        for future, locations in futures:
+            cluster_routes, cluster_cost = future.result()
+            cluster_routes["location_index"] = locations[cluster_routes["location_index"].values]
+            routes.append(cluster_routes)
+            cost += cluster_cost
+    routes = pd.concat(routes, ignore_index=True) if routes else pd.DataFrame()
+    assigned = routes.loc[routes["type"] == "job", "id"].astype(int) if len(routes) else []
+    unassigned = sorted(set(range(len(jobs))) - set(assigned))
+    return {"routes": routes, "cost": cost, "unassigned": unassigned, "clusters": jobs_labels}
+
+
+def compare_vrp(network, vehicles, jobs, **kwargs):
+    """
+    Compare the monolithic and the clustered VRP solves on the same instance.
+
+    Args:
+        network: Network object representing the transportation network.
+        vehicles (pandas.DataFrame): DataFrame containing vehicle information.
+        jobs (pandas.DataFrame): DataFrame containing job (delivery point) information.
+        **kwargs: Arguments passed to solve_vrp_clustered. exploration_level,
+            nb_threads and hour are also used for the monolithic solve.
+
+    Returns:
+        pandas.DataFrame: Cost, number of unassigned jobs and wall time of each
+        strategy, plus the cost gap of the clustered solve relative to the monolithic one.
+    """
+    start = time.perf_counter()
+    # both solves get the same number of threads, so that their times compare
+    solution = solve_vrp(network, vehicles, jobs,
+                         exploration_level=kwargs.get("exploration_level", 5),
+                         nb_threads=kwargs.get("nb_threads", 1),
+                         hour=kwargs.get("hour"))
+    monolithic_time = time.perf_counter() - start
+    routes = solution.routes
+    monolithic_unassigned = len(jobs) - (routes["type"] == "job").sum()
+
+    start = time.perf_counter()
+    clustered = solve_vrp_clustered(network, vehicles, jobs, **kwargs)
+    clustered_time = time.perf_counter() - start
+
+    report = pd.DataFrame({"cost": [solution.summary.cost, clustered["cost"]],
+                           "unassigned": [monolithic_unassigned, len(clustered["unassigned"])],
+                           "seconds": [monolithic_time, clustered_time]},
+                          index=["monolithic", "clustered"])
+    report["cost_gap"] = report["cost"] / report.loc["monolithic", "cost"] - 1
+    instrument.log(report.to_string())
+    return report
+
+
+def solve_vrp_batch(network, instances, output_path, exploration_level=5, nb_threads=1, workers=None,
+                    hour=None):
+    """
+    Solve many VRP instances sharing the same network.
+
+    The locations of all the instances are snapped together and a single travel
+    time matrix is computed over the union of their network nodes. Each
+    instance then gets its matrix as a slice of the shared one, and the
+    instances are solved concurrently by a bounded pool of worker processes.
+    Solutions are written to disk as soon as they complete, as
+    {output_path}/{name}.feather route tables.
+
+    Args:
+        network: Network object representing the transportation network.
+        instances (list): List of dictionaries with keys "name" (str), "vehicles" and
+            "jobs" (DataFrames with columns 'lon' and 'lat').
+        output_path (str): Directory where the solutions are written.
+        exploration_level (int, optional): VROOM exploration level, between 1 and 5. Default is 5.
+        nb_threads (int, optional): Number of VROOM threads per instance. Default is 1.
+        workers (int, optional): Maximum number of instances solved at once. Defaults to the number of CPUs.
+        hour (int, optional): Departure hour of the drive speed profiles. Defaults to None, the free flow travel times.
+
+    Returns:
+        pandas.DataFrame: One row per instance with its cost, number of unassigned
+        jobs and the path of its routes, in completion order.
+    """
+    os.makedirs(output_path, exist_ok=True)
+    # jobs first then vehicles, as in solve_vrp
+    locations = pd.concat([pd.concat([i["jobs"][["lon", "lat"]], i["vehicles"][["lon", "lat"]]])
+                           for i in instances])
+    nodes, inverse = np.unique(network.pdn.get_node_ids(locations.lon, locations.lat).values,
+                               return_inverse=True)
+    instrument.log(f"Computing shared matrix between {len(nodes)} nodes for {len(instances)} instances...")
+    with instrument.stage("vrp.matrices", mode=network.mode) as record:
+        shared = network.get_nodes_matrix(nodes, nodes, impedence=network.impedence_at(hour))
+        record["rows"] = len(nodes)**2
+
+    summary = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        offset = 0
+        for instance in instances:
+            n_jobs, n_vehicles = len(instance["jobs"]), len(instance["vehicles"])
+            index = inverse[offset:offset + n_jobs + n_vehicles]
+            offset += n_jobs + n_vehicles
+            durations = to_vroom_matrix(shared[np.ix_(index, index)])
+            future = executor.submit(_solve_problem, durations,
+                                     np.arange(n_jobs, n_jobs + n_vehicles), np.arange(n_jobs),
+                                     np.arange(n_vehicles), np.arange(n_jobs),
+                                     exploration_level, nb_threads)
+            futures[future] = (instance["name"], n_jobs)
+        for future in as_completed(futures):
+            name, n_jobs = futures[future]
+            routes, cost = future.result()
+            path = f"{output_path}/{name}.feather"
+            routes.to_feather(path)
+            unassigned = n_jobs - (routes["type"] == "job").sum()
+            summary.append({"name": name, "cost": cost, "unassigned": unassigned, "path": path})
+    return pd.DataFrame(summary)
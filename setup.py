@@ -10,17 +10,22 @@ setup(
     author='Matthieu Mastio',
     url='https://github.com/odyssee-co/mobility-referential',
     packages=["mobref"],
+    entry_points={
+        'console_scripts': ['mobref=mobref.cli:main'],
+    },
     install_requires=[
         'geopandas>=0.10.2',
         'matplotlib>=3.1.2',
         'numpy>=1.17.4',
-        'osmium>=3.6.0',
-        'osmnx>=1.4.0',
+        'osmium>=4.0',
+        'osmnx>=1.9,<2',
         'pandana>=0.6.1',
         'pandas==1.5.3',
         'pyvroom>=1.13.2',
+        'scipy>=1.5.0',
         'PyYAML>=6.0.1',
-        'Shapely>=1.7.0',
+        'rasterio>=1.3.0',
+        'Shapely>=2.0.0',
         'urbanaccess>=0.2.2',
         'vroom>=1.0.2',
         'pyarrow>=12.0.1'